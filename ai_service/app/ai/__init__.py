@@ -1 +1,8 @@
+from .aggregation import AGGREGATIONS
+from .backends import BACKENDS
+from .batcher import MicroBatcher, QueueFull
+from .build_jobs import BuildCancelled, BuildJob, BuildJobManager
 from .caps_recognizer import CapsRecognizer
+from .index_factory import INDEX_TYPES, IndexConfig
+from .indexer import IncrementalIndexer
+from .thumbnails import ThumbnailStore
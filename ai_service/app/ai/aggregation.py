@@ -0,0 +1,110 @@
+import faiss
+import numpy as np
+
+# none     — строки индекса как есть (по top_k на каждую найденную кепку);
+# max      — группа оценивается лучшим совпадением;
+# mean     — средним по mean_top_n лучшим совпадениям группы;
+# vote     — числом попаданий группы в выдачу (при равенстве — лучшим совпадением);
+# centroid — поиск по центроидам групп вместо отдельных изображений.
+AGGREGATIONS = ('none', 'max', 'mean', 'vote', 'centroid')
+
+
+def aggregate_by_group(metadata, row_ids, row_scores, top_k, mode='max', mean_top_n=3):
+    """
+    Схлопывает результаты FAISS (по всем кепкам одного запроса) до top_k различных групп.
+    Представителем группы выбирается её изображение с наибольшей схожестью.
+    """
+    groups = {}
+    for ids, scores in zip(row_ids, row_scores):
+        for idx, score in zip(ids, scores):
+            if not 0 <= idx < len(metadata):
+                continue
+            group_id = metadata.group_id(idx)
+            if group_id < 0:
+                continue
+            hits = groups.setdefault(group_id, [])
+            hits.append((float(score), int(idx)))
+
+    ranked = []
+    for group_id, hits in groups.items():
+        hits.sort(reverse=True)
+        best_score, best_row = hits[0]
+        if mode == 'mean':
+            group_score = sum(score for score, _ in hits[:mean_top_n]) / min(len(hits), mean_top_n)
+            key = (group_score,)
+        elif mode == 'vote':
+            group_score = float(len(hits))
+            key = (group_score, best_score)
+        else:
+            group_score = best_score
+            key = (group_score,)
+        ranked.append((key, group_score, best_score, best_row, len(hits)))
+
+    ranked.sort(key=lambda item: item[0], reverse=True)
+    return [
+        {
+            'cap_name': metadata.cap_name(best_row),
+            'image_path': metadata.image_path(best_row),
+            'similarity_score': best_score,
+            'group_score': group_score,
+            'hits': hits_count,
+        }
+        for _, group_score, best_score, best_row, hits_count in ranked[:top_k]
+    ]
+
+
+def build_centroid_index(vectors, ids, group_ids):
+    """
+    Строит индекс центроидов групп: нормализованное среднее векторов группы с id = номер группы.
+    """
+    row_groups = group_ids[ids]
+    valid = row_groups >= 0
+    vectors, row_groups = vectors[valid], row_groups[valid]
+
+    group_count = int(row_groups.max()) + 1 if len(row_groups) else 0
+    centroids = np.zeros((group_count, vectors.shape[1]), dtype='float32')
+    np.add.at(centroids, row_groups, vectors)
+    present = np.flatnonzero(np.bincount(row_groups, minlength=group_count))
+    centroids = np.ascontiguousarray(centroids[present])
+    faiss.normalize_L2(centroids)
+
+    index = faiss.IndexIDMap2(faiss.IndexFlatIP(vectors.shape[1]))
+    index.add_with_ids(centroids, present.astype('int64'))
+    return index
+
+
+def search_centroids(centroids, metadata, index, features, top_k):
+    """
+    Быстрый поиск по центроидам групп для всех кепок одного запроса.
+    Группы ранжируются по центроидам, а представителем группы берётся её изображение,
+    ближайшее к кепкам запроса: векторы строк группы восстанавливаются из индекса поиска.
+    """
+    query_features = np.array(features, dtype='float32')
+    faiss.normalize_L2(query_features)
+    D, I = centroids.search(query_features, top_k)
+    best = {}
+    for group_ids, scores in zip(I, D):
+        for group_id, score in zip(group_ids, scores):
+            if group_id >= 0 and score > best.get(group_id, -np.inf):
+                best[int(group_id)] = float(score)
+
+    results = []
+    for group_id, group_score in sorted(best.items(), key=lambda item: item[1], reverse=True)[:top_k]:
+        rows = metadata.group_rows(group_id)
+        if not len(rows):
+            continue
+        try:
+            row_scores = (index.reconstruct_batch(rows) @ query_features.T).max(axis=1)
+            best_row = int(rows[int(np.argmax(row_scores))])
+            score = float(row_scores.max())
+        except RuntimeError:
+            # Индекс не умеет восстанавливать векторы — берём первое изображение группы
+            best_row, score = int(rows[0]), group_score
+        results.append({
+            'cap_name': metadata.cap_names[group_id],
+            'image_path': metadata.image_path(best_row),
+            'similarity_score': score,
+            'group_score': group_score,
+            'hits': 1,
+        })
+    return results
@@ -0,0 +1,125 @@
+import os
+
+import numpy as np
+import torch
+
+BACKENDS = ('torch', 'torch_int8', 'onnx', 'onnx_int8')
+
+
+def configure_torch_threads(intra_op_threads=None, inter_op_threads=None):
+    """
+    Ограничивает число потоков PyTorch, чтобы несколько моделей и воркеров не делили ядра вслепую.
+    """
+    if intra_op_threads:
+        torch.set_num_threads(intra_op_threads)
+    if inter_op_threads:
+        try:
+            torch.set_num_interop_threads(inter_op_threads)
+        except RuntimeError:
+            # Межоперационный пул можно настроить только до первого параллельного вызова
+            print("Число inter-op потоков PyTorch уже зафиксировано, настройка пропущена.")
+
+
+class TorchClipEncoder:
+    """
+    Кодировщик изображений CLIP на PyTorch, опционально с динамической int8 квантизацией линейных слоёв.
+    """
+
+    def __init__(self, clip_model, device='cpu', quantize=False):
+        self.device = device
+        self.visual = clip_model.visual
+        if quantize:
+            self.visual = torch.quantization.quantize_dynamic(self.visual, {torch.nn.Linear}, dtype=torch.qint8)
+        self.dtype = clip_model.dtype
+
+    def encode(self, input_tensor):
+        with torch.no_grad():
+            features = self.visual(input_tensor.to(self.device).type(self.dtype))
+        return features.float().cpu().numpy()
+
+
+class OnnxClipEncoder:
+    """
+    Кодировщик изображений CLIP на ONNX Runtime. При первом запуске экспортирует визуальную часть CLIP
+    в ONNX (и, если нужно, квантизует веса в int8), затем переиспользует готовый файл.
+    """
+
+    def __init__(self, clip_model, onnx_file, quantize=False, intra_op_threads=None, inter_op_threads=None):
+        import onnxruntime as ort
+
+        if not os.path.exists(onnx_file):
+            export_clip_visual(clip_model, onnx_file)
+
+        model_file = onnx_file
+        if quantize:
+            model_file = f"{os.path.splitext(onnx_file)[0]}_int8.onnx"
+            if not os.path.exists(model_file):
+                from onnxruntime.quantization import QuantType, quantize_dynamic
+                print(f"Квантизация {onnx_file} в int8...")
+                quantize_dynamic(onnx_file, model_file, weight_type=QuantType.QInt8)
+
+        options = ort.SessionOptions()
+        if intra_op_threads:
+            options.intra_op_num_threads = intra_op_threads
+        if inter_op_threads:
+            options.inter_op_num_threads = inter_op_threads
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+
+        self.session = ort.InferenceSession(model_file, options, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def encode(self, input_tensor):
+        batch = input_tensor.cpu().numpy().astype(np.float32)
+        return self.session.run(None, {self.input_name: batch})[0]
+
+
+def export_clip_visual(clip_model, onnx_file):
+    """
+    Экспортирует визуальную часть CLIP в ONNX с динамическим размером батча.
+    """
+    print(f"Экспорт CLIP в ONNX: {onnx_file}")
+    os.makedirs(os.path.dirname(onnx_file) or '.', exist_ok=True)
+    resolution = clip_model.visual.input_resolution
+    dummy_input = torch.randn(1, 3, resolution, resolution, dtype=clip_model.dtype)
+    tmp_file = f"{onnx_file}.tmp"
+    torch.onnx.export(
+        clip_model.visual.float(),
+        dummy_input.float(),
+        tmp_file,
+        input_names=['image'],
+        output_names=['features'],
+        dynamic_axes={'image': {0: 'batch'}, 'features': {0: 'batch'}},
+        opset_version=17,
+    )
+    os.replace(tmp_file, onnx_file)
+
+
+def create_clip_encoder(backend, clip_model, clip_model_name, device='cpu', weights_dir='static/weights',
+                        intra_op_threads=None, inter_op_threads=None):
+    """
+    Создаёт кодировщик CLIP для выбранного бэкенда (см. BACKENDS).
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Неизвестный бэкенд инференса: {backend}. Допустимые: {', '.join(BACKENDS)}")
+
+    if backend.startswith('onnx'):
+        onnx_file = os.path.join(weights_dir, f"clip_{clip_model_name.replace('/', '_')}.onnx")
+        return OnnxClipEncoder(clip_model, onnx_file, quantize=backend == 'onnx_int8',
+                               intra_op_threads=intra_op_threads, inter_op_threads=inter_op_threads)
+    return TorchClipEncoder(clip_model, device=device, quantize=backend == 'torch_int8')
+
+
+def yolo_weights_for_backend(backend, yolo_weights):
+    """
+    Для ONNX бэкендов экспортирует веса YOLO в ONNX рядом с .pt (один раз) и возвращает путь к ним.
+    ultralytics сам запускает .onnx модели через ONNX Runtime.
+    """
+    if not backend.startswith('onnx') or yolo_weights.endswith('.onnx'):
+        return yolo_weights
+
+    onnx_file = f"{os.path.splitext(yolo_weights)[0]}.onnx"
+    if not os.path.exists(onnx_file):
+        from ultralytics import YOLO
+        print(f"Экспорт YOLO в ONNX: {onnx_file}")
+        YOLO(yolo_weights).export(format='onnx', imgsz=640, dynamic=True)
+    return onnx_file
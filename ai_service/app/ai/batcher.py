@@ -0,0 +1,119 @@
+import math
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+
+class QueueFull(Exception):
+    """
+    Очередь запросов переполнена; retry_after — через сколько секунд стоит повторить запрос.
+    """
+
+    def __init__(self, retry_after):
+        super().__init__(f"Очередь запросов переполнена, повторите через {retry_after} с")
+        self.retry_after = retry_after
+
+
+class MicroBatcher:
+    """
+    Динамический батчинг запросов между потоками.
+
+    Запросы, пришедшие в течение окна window_ms (но не больше max_batch_size),
+    объединяются и передаются в handler одним списком. handler обязан вернуть
+    список результатов той же длины; каждый результат отдаётся в Future своего запроса.
+
+    Батчи обрабатывают workers потоков. Они запускаются при первом запросе или вызове start(),
+    поэтому объект можно создать в мастер-процессе до fork воркеров.
+    Если в очереди уже max_pending запросов (0 — без ограничения), новый запрос сразу
+    отклоняется с QueueFull, а не ждёт в растущей очереди.
+    """
+
+    def __init__(self, handler, window_ms=10, max_batch_size=16, workers=1, max_pending=0, name="micro-batcher"):
+        self.handler = handler
+        self.window = window_ms / 1000
+        self.max_batch_size = max_batch_size
+        self.workers = workers
+        self.max_pending = max_pending
+
+        # Скользящее среднее времени обработки батча — для оценки Retry-After
+        self.batch_seconds = None
+
+        self.name = name
+        self._queue = queue.Queue()
+        self._workers = []
+        self._start_lock = threading.Lock()
+
+    def start(self):
+        """
+        Запускает потоки обработки (повторный вызов ничего не делает).
+        """
+        with self._start_lock:
+            if self._workers:
+                return
+            self._workers = [
+                threading.Thread(target=self._run, name=f"{self.name}-{number}", daemon=True)
+                for number in range(self.workers)
+            ]
+            for worker in self._workers:
+                worker.start()
+
+    @property
+    def pending(self):
+        return self._queue.qsize()
+
+    def retry_after(self):
+        """
+        Оценка времени, за которое освободится очередь, в целых секундах.
+        """
+        batches = self.pending / (self.max_batch_size * self.workers)
+        return max(1, math.ceil(batches * (self.batch_seconds or 1.0)))
+
+    def submit(self, item):
+        """
+        Ставит запрос в очередь и возвращает Future с его результатом.
+        """
+        if self.max_pending and self.pending >= self.max_pending:
+            raise QueueFull(self.retry_after())
+        if not self._workers:
+            self.start()
+        future = Future()
+        self._queue.put((item, future))
+        return future
+
+    def __call__(self, item):
+        return self.submit(item).result()
+
+    def _collect_batch(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect_batch()
+            batch = [(item, future) for item, future in batch if future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+
+            started = time.monotonic()
+            try:
+                results = self.handler([item for item, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            finally:
+                elapsed = time.monotonic() - started
+                self.batch_seconds = elapsed if self.batch_seconds is None else 0.8 * self.batch_seconds + 0.2 * elapsed
+
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
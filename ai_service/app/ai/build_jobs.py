@@ -0,0 +1,255 @@
+import fcntl
+import json
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+ACTIVE_STATUSES = ("queued", "running")
+
+
+class BuildCancelled(Exception):
+    """
+    Сборка индекса остановлена по запросу пользователя.
+    """
+
+
+class BuildJob:
+    """
+    Состояние фоновой сборки индекса: этап, прогресс, скорость и оценка оставшегося времени.
+
+    Состояние пишется в state_file (JSON), чтобы его видели все воркеры gunicorn, а не только тот,
+    который запустил сборку. Отмена из другого воркера приходит файлом cancel_file.
+    """
+
+    # Прогресс сохраняется на диск не чаще раза в столько секунд
+    SAVE_INTERVAL = 1.0
+
+    def __init__(self, state_dir, full=False):
+        self.id = uuid.uuid4().hex
+        self.full = full
+        self.status = "queued"
+        self.stage = "queued"
+        self.processed = 0
+        self.total = 0
+        self.stats = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.state_file = os.path.join(state_dir, f"{self.id}.json")
+        self.cancel_file = os.path.join(state_dir, f"{self.id}.cancel")
+
+        self._stage_started_at = None
+        self._saved_at = 0.0
+        self._cancel_event = threading.Event()
+
+    @property
+    def cancelled(self):
+        return self._cancel_event.is_set() or os.path.exists(self.cancel_file)
+
+    def cancel(self):
+        self._cancel_event.set()
+
+    def check_cancelled(self):
+        """
+        Вызывается сборкой между порциями изображений.
+        """
+        if self.cancelled:
+            raise BuildCancelled()
+
+    def set_stage(self, stage, total=0):
+        self.stage = stage
+        self.processed = 0
+        self.total = total
+        self._stage_started_at = time.monotonic()
+        self.save()
+
+    def advance(self, count):
+        self.processed += count
+        if time.monotonic() - self._saved_at >= self.SAVE_INTERVAL:
+            self.save()
+
+    def save(self):
+        """
+        Атомарно записывает состояние сборки в state_file.
+        """
+        self._saved_at = time.monotonic()
+        tmp_file = f"{self.state_file}.tmp"
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(self.to_dict(), f, ensure_ascii=False)
+        os.replace(tmp_file, self.state_file)
+
+    def to_dict(self):
+        throughput = None
+        eta = None
+        if self._stage_started_at is not None and self.processed:
+            elapsed = time.monotonic() - self._stage_started_at
+            throughput = self.processed / elapsed if elapsed > 0 else None
+            if throughput and self.status == "running":
+                eta = max(self.total - self.processed, 0) / throughput
+
+        return {
+            "job_id": self.id,
+            "full": self.full,
+            "status": self.status,
+            "stage": self.stage,
+            "processed": self.processed,
+            "total": self.total,
+            "images_per_second": round(throughput, 2) if throughput else None,
+            "eta_seconds": round(eta, 1) if eta is not None else None,
+            "stats": self.stats,
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class BuildJobManager:
+    """
+    Запускает сборки индекса в фоновом потоке, по одной за раз на все воркеры gunicorn.
+    Поиск в это время обслуживается предыдущим опубликованным индексом.
+
+    Общее состояние лежит в state_dir: сборку выполняет воркер, захвативший блокировку fcntl на build.lock
+    (она держится всё время сборки и освобождается ОС, если воркер умер), id идущей сборки записан в active,
+    а состояние каждой сборки — в <job_id>.json. Поэтому запуск, статус и отмена работают из любого воркера.
+    """
+
+    def __init__(self, build, state_dir, max_history=20):
+        self.build = build
+        self.state_dir = state_dir
+        self.max_history = max_history
+        os.makedirs(state_dir, exist_ok=True)
+        self.lock_file = os.path.join(state_dir, "build.lock")
+        self.active_file = os.path.join(state_dir, "active")
+
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="build-db")
+        self._jobs = {}
+
+    def _try_lock(self):
+        """
+        Пытается захватить межпроцессную блокировку сборки. Возвращает открытый файл блокировки или None.
+        """
+        lock = open(self.lock_file, 'a')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock.close()
+            return None
+        return lock
+
+    def start(self, full=False):
+        """
+        Ставит сборку в очередь и возвращает (состояние сборки, создана ли новая).
+        Если сборка уже идёт в любом воркере, возвращает её вместо новой.
+        """
+        with self._lock:
+            lock = self._try_lock()
+            if lock is None:
+                active = self.get(self._read_active())
+                if active is not None:
+                    return active, False
+                # Блокировку держит сборка, ещё не записавшая свой id, — отвечаем как о запущенной
+                return {"job_id": None, "status": "running", "stage": "queued"}, False
+
+            try:
+                job = BuildJob(self.state_dir, full=full)
+                job.save()
+                self._write_active(job.id)
+                self._jobs[job.id] = job
+                self._trim_history()
+                self._executor.submit(self._run, job, lock)
+            except BaseException:
+                lock.close()
+                raise
+            return job.to_dict(), True
+
+    def get(self, job_id):
+        """
+        Состояние сборки из любого воркера (None, если сборки нет).
+        Сборка, воркер которой умер, не освободив блокировку штатно, отдаётся как failed.
+        """
+        if not job_id:
+            return None
+        job = self._jobs.get(job_id)
+        if job is not None:
+            return job.to_dict()
+        try:
+            with open(os.path.join(self.state_dir, f"{job_id}.json"), encoding='utf-8') as f:
+                state = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        if state["status"] in ACTIVE_STATUSES:
+            lock = self._try_lock()
+            if lock is not None:
+                lock.close()
+                state.update(status="failed", error="Воркер, выполнявший сборку, завершился.")
+        return state
+
+    def cancel(self, job_id):
+        """
+        Отменяет сборку. Сборка другого воркера увидит файл отмены между порциями изображений.
+        """
+        state = self.get(job_id)
+        if state is None or state["status"] not in ACTIVE_STATUSES:
+            return state
+        job = self._jobs.get(job_id)
+        if job is not None:
+            job.cancel()
+        else:
+            open(os.path.join(self.state_dir, f"{job_id}.cancel"), 'w').close()
+        return state
+
+    def _read_active(self):
+        try:
+            with open(self.active_file, encoding='utf-8') as f:
+                return f.read().strip()
+        except FileNotFoundError:
+            return None
+
+    def _write_active(self, job_id):
+        tmp_file = f"{self.active_file}.tmp"
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            f.write(job_id)
+        os.replace(tmp_file, self.active_file)
+
+    def _run(self, job, lock):
+        job.status = "running"
+        job.started_at = time.time()
+        try:
+            job.save()
+            job.check_cancelled()
+            job.stats = self.build(job)
+            job.status = "done"
+            job.stage = "done"
+        except BuildCancelled:
+            job.status = "cancelled"
+            print(f"Сборка {job.id} отменена.")
+        except Exception as e:
+            job.status = "failed"
+            job.error = str(e)
+            print(f"Ошибка сборки {job.id}: {e}")
+        finally:
+            job.finished_at = time.time()
+            try:
+                job.save()
+                if os.path.exists(job.cancel_file):
+                    os.remove(job.cancel_file)
+            finally:
+                lock.close()
+
+    def _trim_history(self):
+        """
+        Оставляет на диске состояние последних max_history сборок.
+        """
+        states = sorted(
+            (entry for entry in os.scandir(self.state_dir) if entry.name.endswith(".json")),
+            key=lambda entry: entry.stat().st_mtime
+        )
+        for entry in states[:max(len(states) - self.max_history, 0)]:
+            job_id = entry.name[:-len(".json")]
+            os.remove(entry.path)
+            self._jobs.pop(job_id, None)
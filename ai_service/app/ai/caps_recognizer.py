@@ -1,7 +1,13 @@
+import hashlib
+import json
 import os
-import pickle
+import queue
+import re
 import shutil
-import zipfile
+import time
+import uuid
+from contextlib import contextmanager
+from io import BytesIO
 
 import clip
 import faiss
@@ -12,23 +18,87 @@ from PIL import Image
 from tqdm import tqdm
 from ultralytics import YOLO
 
+from .aggregation import aggregate_by_group, build_centroid_index, search_centroids
+from .backends import configure_torch_threads, create_clip_encoder, yolo_weights_for_backend
+from .cache import LRUCache
+from .index_factory import IndexConfig, configure_search, enable_reconstruct
+from .index_holder import IndexHolder, read_generation, write_generation
+from .metadata_store import MetadataStore
+from .metrics import CACHE_REQUESTS, STAGE_SECONDS
+
 
 class CapsRecognizer:
-    def __init__(self, device='cpu', yolo_weights='static/weights/best.pt', clip_model_name="ViT-L/14"):
+    def __init__(self, device='cpu', yolo_weights='static/weights/best.pt', clip_model_name="ViT-L/14",
+                 index_config=None, overfetch=10, mean_top_n=3, backend='torch', intra_op_threads=None,
+                 inter_op_threads=None, index_root='static/indexes', result_cache_size=1024, result_cache_ttl=3600,
+                 embedding_cache_size=1024, decode_max_side=1280, yolo_instances=1):
+        started = time.perf_counter()
+        self.startup_timings = {}
+        self.warm = False
         self.device = device
+        self.backend = backend
+        self.clip_model_name = clip_model_name
+        self.index_config = index_config or IndexConfig()
+        # Во сколько раз больше строк запрашивать у FAISS при группировке результатов по моделям кепок
+        self.overfetch = overfetch
+        self.mean_top_n = mean_top_n
+        # Большие JPEG декодируются сразу в уменьшенном масштабе (Image.draft): обе стороны не меньше этого размера
+        self.decode_max_side = decode_max_side
         self.zip_folder = 'static/zip_files'
         self.data_dir = 'static/zip_files'
-        self.index_file = 'static/faiss_index.bin'
-        self.metadata_file = 'static/metadata.pkl'
         self.excel_file = 'static/Кепки.xlsx'
 
-        # Инициализация YOLO
-        self.yolo_model = YOLO(yolo_weights)
-        self.yolo_model.to(self.device)
+        # Индекс, метаданные и отпечаток модели лежат в отдельном каталоге для каждой модели CLIP,
+        # чтобы смена модели не подсовывала ей векторы другой размерности или другого пространства
+        self.index_dir = os.path.join(index_root, clip_model_name.replace('/', '-'))
+        os.makedirs(self.index_dir, exist_ok=True)
+        # Файл поколения называет файлы опубликованной сборки (индекс, метаданные, центроиды) и отпечаток модели
+        self.generation_file = os.path.join(self.index_dir, 'index_generation.json')
+        self.manifest_file = os.path.join(self.index_dir, 'index_manifest.json')
+
+        # Кэши по хэшу изображения: готовые результаты (сбрасываются при смене поколения индекса)
+        # и эмбеддинги кепок (не зависят от индекса)
+        self.result_cache = LRUCache(result_cache_size, ttl=result_cache_ttl)
+        self.embedding_cache = LRUCache(embedding_cache_size)
+        self._cache_generation = None
+
+        # Необязательный наблюдатель этапов поиска: observer(stage, seconds) вызывается вместе с записью метрики
+        # (так замеры этапов получает app.tools.stage_benchmark)
+        self.stage_observer = None
+
+        # Индекс держится в памяти и перечитывается только при публикации нового поколения
+        self.index_holder = IndexHolder(self.generation_file, self.load_faiss_index)
+
+        configure_torch_threads(intra_op_threads, inter_op_threads)
+
+        # Инициализация YOLO (для ONNX бэкендов — экспортированная в ONNX модель)
+        stage_started = time.perf_counter()
+        yolo_weights = yolo_weights_for_backend(backend, yolo_weights)
+        # Предиктор ultralytics хранит состояние между вызовами, поэтому один экземпляр модели
+        # не вызывается из разных потоков одновременно: каждый поток берёт свободный экземпляр из пула
+        self.yolo_models = queue.Queue()
+        for _ in range(max(1, yolo_instances)):
+            yolo_model = YOLO(yolo_weights, task='detect')
+            if yolo_weights.endswith('.pt'):
+                yolo_model.to(self.device)
+            self.yolo_models.put(yolo_model)
+        self.yolo_model = yolo_model
+        self.startup_timings['yolo'] = time.perf_counter() - stage_started
 
         # Инициализация CLIP
+        stage_started = time.perf_counter()
         self.clip_model, self.preprocess_clip = clip.load(clip_model_name, device=self.device)
         self.clip_model.eval()
+        self.embedding_dim = self.clip_model.visual.output_dim
+        self.startup_timings['clip'] = time.perf_counter() - stage_started
+
+        stage_started = time.perf_counter()
+        self.clip_encoder = create_clip_encoder(
+            backend, self.clip_model, clip_model_name, device=self.device,
+            weights_dir=os.path.dirname(yolo_weights), intra_op_threads=intra_op_threads,
+            inter_op_threads=inter_op_threads
+        )
+        self.startup_timings['clip_backend'] = time.perf_counter() - stage_started
 
         # Определяем метод ресэмплинга для Pillow
         try:
@@ -37,9 +107,43 @@ class CapsRecognizer:
         except ImportError:
             self.resample_method = Image.LANCZOS
 
+        stage_started = time.perf_counter()
+        self.adopt_legacy_index()
+        self.index_holder.load()
+        self.startup_timings['index'] = time.perf_counter() - stage_started
+        self.startup_timings['total'] = time.perf_counter() - started
+        print("Время запуска CapsRecognizer: " + ", ".join(
+            f"{stage} {seconds:.2f} с" for stage, seconds in self.startup_timings.items()
+        ))
+
+    def warmup(self):
+        """
+        Прогоняет пустое изображение через YOLO, CLIP и FAISS, чтобы первый настоящий запрос
+        не платил за ленивую инициализацию. Выполняется в каждом воркере после fork.
+        """
+        started = time.perf_counter()
+        image = Image.new("RGB", (640, 640), (128, 128, 128))
+        yolo_models = [self.yolo_models.get() for _ in range(self.yolo_models.qsize())]
+        try:
+            for yolo_model in yolo_models:
+                yolo_model.predict(image, imgsz=640, verbose=False)
+        finally:
+            for yolo_model in yolo_models:
+                self.yolo_models.put(yolo_model)
+
+        features = self.extract_features_clip_batch([image.resize((224, 224))])
+        snapshot = self.index_holder.get()
+        if snapshot is not None:
+            self.search_index(snapshot.index, features, 1)
+
+        self.startup_timings['warmup'] = time.perf_counter() - started
+        self.warm = True
+        print(f"Прогрев моделей завершён за {self.startup_timings['warmup']:.2f} с")
+
     def organize_zip_files(self):
         """
         Организует zip файлы по группам на основе Excel файла.
+        Архивы не распаковываются: сборка индекса читает изображения прямо из них.
         """
         df = pd.read_excel(self.excel_file)
         zip_files = [f for f in os.listdir(self.zip_folder) if f.endswith('.zip')]
@@ -55,9 +159,7 @@ class CapsRecognizer:
                     matched = True
                     zip_file_path = os.path.join(self.zip_folder, zip_file)
                     shutil.move(zip_file_path, group_folder)
-                    with zipfile.ZipFile(os.path.join(group_folder, zip_file), 'r') as zip_ref:
-                        zip_ref.extractall(group_folder)
-                    print(f"Файл {zip_file} перемещен и разархивирован в {group_folder}.")
+                    print(f"Файл {zip_file} перемещен в {group_folder}.")
                     break
 
             if not matched:
@@ -83,56 +185,93 @@ class CapsRecognizer:
             print(f"Размер изображения подходит: {image.size}")
         return image
 
+    def extract_features_clip_batch(self, images):
+        """
+        Извлекает векторы признаков сразу для списка изображений одним проходом CLIP.
+        Возвращает нормализованную матрицу размера (len(images), dim).
+        """
+        input_tensor = torch.stack([self.preprocess_clip(image) for image in images])
+        features = self.clip_encoder.encode(input_tensor).astype('float32')
+        features /= np.linalg.norm(features, axis=1, keepdims=True)  # Нормализация
+        return features
+
     def extract_features_clip(self, image):
         """
         Извлекает вектор признаков из изображения с помощью модели CLIP.
         """
-        input_tensor = self.preprocess_clip(image).unsqueeze(0).to(self.device)
-        with torch.no_grad():
-            features = self.clip_model.encode_image(input_tensor)
-        features = features.cpu().numpy().flatten()
-        features = features / np.linalg.norm(features)  # Нормализация
-        return features.astype('float32')
+        return self.extract_features_clip_batch([image])[0]
 
-    def detect_and_extract_features(self, image_path):
+    def load_image(self, source):
         """
-        Детектирует кепку на изображении и извлекает признаки с помощью CLIP.
+        Открывает изображение и приводит его к размеру, подходящему для YOLO.
+        source — путь, байты, файловый объект или уже открытое изображение PIL.
+        """
+        if isinstance(source, Image.Image):
+            image = source
+        else:
+            if isinstance(source, str):
+                print(f"\nОбрабатываем изображение: {source}")
+            elif isinstance(source, (bytes, bytearray)):
+                source = BytesIO(source)
+            image = Image.open(source)
+            if self.decode_max_side:
+                # Для JPEG декодер сразу масштабирует в 1/2, 1/4 или 1/8, не опускаясь ниже запрошенного размера
+                image.draft("RGB", (self.decode_max_side, self.decode_max_side))
+        return self.resize_image_if_needed(image.convert("RGB"))
+
+    def detect_caps_batch(self, images):
+        """
+        Детектирует кепки сразу на списке изображений одним вызовом YOLO.
+        Возвращает для каждого изображения список вырезанных кепок.
         """
+        if not images:
+            return []
+
+        yolo_model = self.yolo_models.get()
         try:
-            print(f"\nОбрабатываем изображение: {image_path}")
-            image = Image.open(image_path).convert("RGB")
-            image = self.resize_image_if_needed(image)
-
-            # Детекция с помощью YOLO
-            results = self.yolo_model.predict(image, imgsz=640)
-            print(f"Количество детектированных объектов: {len(results[0].boxes)}")
-
-            if results and len(results) > 0:
-                result = results[0]
-                if result.boxes is not None and len(result.boxes) > 0:
-                    features_list = []
-                    for box in result.boxes.xyxy.cpu().numpy():
-                        x1, y1, x2, y2 = map(int, box)
-                        print(f"Координаты обнаруженной кепки: {(x1, y1, x2, y2)}")
-                        cropped_image = image.crop((x1, y1, x2, y2))
-                        print("Кепка обрезана из изображения.")
-
-                        # Извлечение признаков с помощью CLIP
-                        features = self.extract_features_clip(cropped_image)
-                        print("Признаки извлечены с помощью CLIP.")
-                        features_list.append(features)
-
-                    return features_list
+            results = yolo_model.predict(images, imgsz=640)
+        finally:
+            self.yolo_models.put(yolo_model)
+        crops_per_image = []
+        for image, result in zip(images, results):
+            crops = []
+            if result.boxes is not None and len(result.boxes) > 0:
+                print(f"Количество детектированных объектов: {len(result.boxes)}")
+                for box in result.boxes.xyxy.cpu().numpy():
+                    x1, y1, x2, y2 = map(int, box)
+                    print(f"Координаты обнаруженной кепки: {(x1, y1, x2, y2)}")
+                    crops.append(image.crop((x1, y1, x2, y2)))
             else:
                 print("Не обнаружено ни одного объекта на изображении.")
+            crops_per_image.append(crops)
+        return crops_per_image
+
+    def detect_caps(self, image_path):
+        """
+        Детектирует кепки на изображении и возвращает список вырезанных кепок.
+        """
+        return self.detect_caps_batch([self.load_image(image_path)])[0]
+
+    def detect_and_extract_features(self, image_path):
+        """
+        Детектирует кепку на изображении и извлекает признаки с помощью CLIP.
+        Все найденные кепки кодируются одним батчем; возвращает матрицу признаков или None.
+        """
+        try:
+            crops = self.detect_caps(image_path)
+            if crops:
+                features = self.extract_features_clip_batch(crops)
+                print(f"Признаки извлечены с помощью CLIP для {len(crops)} кепок.")
+                return features
         except Exception as e:
             print(f"Ошибка при обработке изображения {image_path}: {e}")
 
         return None
 
-    def build_feature_database(self):
+    def build_feature_database(self, clip_batch_size=32):
         """
         Создаёт базу признаков и метаданных.
+        Кепки с разных изображений накапливаются и кодируются CLIP батчами по clip_batch_size.
         """
         feature_list = []
         metadata = []
@@ -147,70 +286,310 @@ class CapsRecognizer:
 
         print(f"Найдено {len(image_paths)} изображений для обработки.")
 
+        pending_crops = []
+        pending_metadata = []
+
+        def flush():
+            if pending_crops:
+                feature_list.append(self.extract_features_clip_batch(pending_crops))
+                metadata.extend(pending_metadata)
+                pending_crops.clear()
+                pending_metadata.clear()
+
         for image_path in tqdm(image_paths):
             cap_name = os.path.basename(os.path.dirname(image_path))
-            features = self.detect_and_extract_features(image_path)
-            if features:
-                for feature in features:
-                    feature_list.append(feature)
-                    metadata.append({
-                        'cap_name': cap_name,
-                        'image_path': image_path
-                    })
+            try:
+                crops = self.detect_caps(image_path)
+            except Exception as e:
+                print(f"Ошибка при обработке изображения {image_path}: {e}")
+                continue
+
+            for crop in crops:
+                pending_crops.append(crop)
+                pending_metadata.append({
+                    'cap_name': cap_name,
+                    'image_path': image_path
+                })
+            if len(pending_crops) >= clip_batch_size:
+                flush()
+        flush()
 
         if feature_list:
             features_matrix = np.vstack(feature_list)
-            with open(self.metadata_file, 'wb') as f:
-                pickle.dump(metadata, f)
             return features_matrix, metadata
         else:
             return None, None
 
-    def create_faiss_index(self, features_matrix):
+    def create_faiss_index(self, features_matrix, metadata):
         """
-        Создаёт FAISS индекс.
+        Создаёт FAISS индекс по признакам build_feature_database и публикует его вместе с метаданными.
         """
         dimension = features_matrix.shape[1]
-        index = faiss.IndexFlatIP(dimension)
+        index = faiss.IndexIDMap2(faiss.IndexFlatIP(dimension))
         faiss.normalize_L2(features_matrix)
-        index.add(features_matrix)
-        faiss.write_index(index, self.index_file)
+        ids = np.arange(len(features_matrix), dtype='int64')
+        index.add_with_ids(features_matrix, ids)
+        self.publish_index(index, metadata, features_matrix, ids)
         return index
 
-    def load_faiss_index(self):
+    def model_fingerprint(self):
         """
-        Загружает FAISS индекс и метаданные.
+        Отпечаток модели, векторами которой построен индекс.
         """
-        if not os.path.exists(self.index_file) or not os.path.exists(self.metadata_file):
-            return None, None
-        index = faiss.read_index(self.index_file)
-        with open(self.metadata_file, 'rb') as f:
-            metadata = pickle.load(f)
-        return index, metadata
+        return {'clip_model': self.clip_model_name, 'dimension': self.embedding_dim}
 
-    def search_similar_cap(self, uploaded_image_path, top_k=1):
+    def index_path(self, name):
+        return os.path.join(self.index_dir, name)
+
+    def publish_index(self, search_index, metadata, vectors=None, ids=None):
         """
-        Поиск похожей кепки.
+        Публикует новую сборку индекса и возвращает её id.
+
+        Индекс для поиска, метаданные и центроиды групп (строятся, если переданы точные векторы и их id)
+        записываются под именами с id сборки, и только затем атомарно подменяется файл поколения.
+        Воркеры видят либо старую сборку целиком, либо новую целиком.
         """
-        index, metadata = self.load_faiss_index()
-        if not index or not metadata:
-            return "Индекс или метаданные отсутствуют."
+        build_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        generation = {
+            'build_id': build_id,
+            'model': self.model_fingerprint(),
+            'index': f'faiss_index.{build_id}.bin',
+            'metadata': f'metadata.{build_id}.bin',
+            'centroids': None,
+        }
+        metadata_file = self.index_path(generation['metadata'])
+        MetadataStore.write(metadata_file, metadata)
+        if vectors is not None:
+            # Номера групп центроидов берутся из только что записанных метаданных этой же сборки
+            centroids = build_centroid_index(vectors, ids, MetadataStore.open(metadata_file).group_ids)
+            generation['centroids'] = f'faiss_centroids.{build_id}.bin'
+            faiss.write_index(centroids, self.index_path(generation['centroids']))
+        faiss.write_index(search_index, self.index_path(generation['index']))
+
+        previous = read_generation(self.generation_file)
+        write_generation(self.generation_file, generation)
+        self.remove_stale_builds(generation, previous)
+        self.index_holder.load()
+        return build_id
 
-        features = self.detect_and_extract_features(uploaded_image_path)
-        if not features:
-            return "Не удалось извлечь признаки."
+    def remove_stale_builds(self, *keep):
+        """
+        Удаляет файлы сборок, кроме перечисленных поколений. Предыдущую сборку оставляем:
+        воркер, прочитавший файл поколения до подмены, может ещё открывать её файлы.
+        """
+        kept = {generation[key] for generation in keep if generation
+                for key in ('index', 'metadata', 'centroids') if generation.get(key)}
+        for name in os.listdir(self.index_dir):
+            if re.fullmatch(r'(faiss_index|metadata|faiss_centroids)\.[\w-]+\.bin', name) and name not in kept:
+                os.remove(self.index_path(name))
 
+    def adopt_legacy_index(self):
+        """
+        Индекс, собранный до появления файла поколения (faiss_index.bin, metadata.bin и model.json),
+        публикуется одним поколением без центроидов. id сборки выводится из файлов, поэтому одинаков везде.
+        """
+        legacy_files = [self.index_path(name) for name in ('faiss_index.bin', 'metadata.bin', 'model.json')]
+        if os.path.exists(self.generation_file) or not all(os.path.exists(path) for path in legacy_files):
+            return
+        with open(legacy_files[2], encoding='utf-8') as f:
+            model = json.load(f)
+        signature = [(os.stat(path).st_mtime_ns, os.stat(path).st_size) for path in legacy_files[:2]]
+        write_generation(self.generation_file, {
+            'build_id': 'legacy-' + hashlib.sha1(repr(signature).encode()).hexdigest()[:8],
+            'model': model,
+            'index': 'faiss_index.bin',
+            'metadata': 'metadata.bin',
+            'centroids': None,
+        })
+        print(f"Индекс {legacy_files[0]} опубликован как поколение {self.generation_file}.")
+
+    def load_faiss_index(self, generation):
+        """
+        Загружает FAISS индекс, метаданные и (если есть) индекс центроидов групп сборки,
+        названной в файле поколения. Индекс, построенный другой моделью CLIP, не загружается.
+        """
+        expected = self.model_fingerprint()
+        if generation.get('model') != expected:
+            print(f"Индекс сборки {generation['build_id']} не загружен: построен моделью {generation.get('model')}, "
+                  f"а загружена {expected}.")
+            return None, None, None
+        index = faiss.read_index(self.index_path(generation['index']))
+        index = enable_reconstruct(configure_search(index, self.index_config))
+        metadata = MetadataStore.open(self.index_path(generation['metadata']))
+
+        centroids = None
+        if generation.get('centroids'):
+            centroids = faiss.read_index(self.index_path(generation['centroids']))
+        return index, metadata, centroids
+
+    def search_similar_cap(self, image, top_k=1, aggregate='none'):
+        """
+        Поиск похожей кепки. image — путь, байты, файловый объект или изображение PIL.
+        """
+        return self.search_similar_caps_batch([(image, top_k, aggregate)])[0]
+
+    def search_similar_caps_batch(self, queries, snapshot=None):
+        """
+        Поиск похожих кепок сразу для нескольких запросов [(изображение, top_k, aggregate), ...].
+
+        Все изображения проходят через один вызов YOLO, все найденные кепки — через один
+        батч CLIP и один index.search; результаты раскладываются обратно по запросам.
+        Для каждого запроса возвращает список результатов или строку с ошибкой.
+
+        aggregate (см. aggregation.AGGREGATIONS) задаёт группировку: при значении, отличном от 'none',
+        из FAISS запрашивается в overfetch раз больше строк и возвращается top_k различных моделей кепок.
+        snapshot — снимок индекса, по которому искать (по умолчанию текущий).
+        """
+        if snapshot is None:
+            snapshot = self.index_holder.get()
+        if snapshot is None:
+            return ["Индекс или метаданные отсутствуют."] * len(queries)
+        index, metadata, centroids = snapshot.index, snapshot.metadata, snapshot.centroids
+        generation = snapshot.generation
+        if generation != self._cache_generation:
+            # Индекс пересобран — старые результаты больше не действительны, эмбеддинги остаются верными
+            self.result_cache.clear()
+            self._cache_generation = generation
+
+        responses = ["Не удалось извлечь признаки."] * len(queries)
+        query_features = {}
+        pending = []
+        # Время декодирования, хэширования и обращения к кэшам суммируется по всем запросам батча
+        stage_seconds = {'decode': 0.0, 'hash': 0.0, 'cache': 0.0}
+        for position, (source, top_k, aggregate) in enumerate(queries):
+            started = time.perf_counter()
+            try:
+                image = self.load_image(source)
+            except Exception as e:
+                print(f"Ошибка при обработке изображения в запросе {position}: {e}")
+                continue
+            decoded = time.perf_counter()
+            stage_seconds['decode'] += decoded - started
+
+            image_hash = self.image_hash(image)
+            hashed = time.perf_counter()
+            stage_seconds['hash'] += hashed - decoded
+
+            cached_results = self.result_cache.get((image_hash, generation, top_k, aggregate))
+            CACHE_REQUESTS.labels('result', 'miss' if cached_results is None else 'hit').inc()
+            cached_features = None
+            if cached_results is None:
+                cached_features = self.embedding_cache.get(image_hash)
+                CACHE_REQUESTS.labels('embedding', 'miss' if cached_features is None else 'hit').inc()
+            stage_seconds['cache'] += time.perf_counter() - hashed
+
+            if cached_results is not None:
+                responses[position] = cached_results
+            elif cached_features is not None:
+                query_features[position] = (image_hash, cached_features)
+            else:
+                pending.append((position, image_hash, image))
+        for stage, seconds in stage_seconds.items():
+            self.observe_stage(stage, seconds)
+
+        if pending:
+            try:
+                with self.stage('detect'):
+                    crops_per_image = self.detect_caps_batch([image for _, _, image in pending])
+            except Exception as e:
+                print(f"Ошибка при детекции кепок: {e}")
+                crops_per_image = [[] for _ in pending]
+
+            crops = [crop for image_crops in crops_per_image for crop in image_crops]
+            features = np.empty((0, self.embedding_dim), dtype='float32')
+            if crops:
+                with self.stage('embed'):
+                    features = self.extract_features_clip_batch(crops)
+                print(f"Признаки извлечены с помощью CLIP для {len(crops)} кепок.")
+
+            offset = 0
+            for (position, image_hash, _), image_crops in zip(pending, crops_per_image):
+                image_features = features[offset:offset + len(image_crops)]
+                offset += len(image_crops)
+                self.embedding_cache.put(image_hash, image_features)
+                query_features[position] = (image_hash, image_features)
+
+        positions = [position for position, (_, features) in query_features.items() if len(features)]
+        if not positions:
+            return responses
+
+        features = np.vstack([query_features[position][1] for position in positions])
+        crop_owners = np.repeat(positions, [len(query_features[position][1]) for position in positions])
+
+        fetch_k = max(
+            top_k if aggregate == 'none' else top_k * self.overfetch
+            for position, (_, top_k, aggregate) in enumerate(queries)
+            if position in positions
+        )
+        with self.stage('search'):
+            D, I = self.search_index(index, features, fetch_k)
+
+        aggregate_started = time.perf_counter()
+        for position in positions:
+            _, top_k, aggregate = queries[position]
+            rows = np.flatnonzero(crop_owners == position)
+            if aggregate == 'none':
+                responses[position] = [
+                    result
+                    for row in rows
+                    for result in self.collect_results(metadata, I[row][:top_k], D[row][:top_k])
+                ]
+            elif aggregate == 'centroid' and centroids is not None:
+                responses[position] = search_centroids(centroids, metadata, index, features[rows], top_k)
+            else:
+                mode = 'max' if aggregate == 'centroid' else aggregate
+                responses[position] = aggregate_by_group(metadata, I[rows], D[rows], top_k, mode, self.mean_top_n)
+            self.result_cache.put((query_features[position][0], generation, top_k, aggregate), responses[position])
+        self.observe_stage('aggregate', time.perf_counter() - aggregate_started)
+        return responses
+
+    def observe_stage(self, stage, seconds):
+        STAGE_SECONDS.labels(stage).observe(seconds)
+        if self.stage_observer is not None:
+            self.stage_observer(stage, seconds)
+
+    @contextmanager
+    def stage(self, stage):
+        """
+        Замеряет этап поиска (метрика caps_search_stage_seconds и stage_observer).
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe_stage(stage, time.perf_counter() - started)
+
+    @staticmethod
+    def image_hash(image):
+        """
+        Хэш декодированного изображения: одинаковые фото совпадают, даже если файлы отличаются метаданными.
+        """
+        digest = hashlib.blake2b(image.tobytes(), digest_size=16)
+        digest.update(f"{image.size}".encode())
+        return digest.hexdigest()
+
+    @staticmethod
+    def search_index(index, features, top_k):
+        """
+        Ищет ближайших соседей для всей матрицы запросов одним вызовом index.search.
+        """
+        query_features = np.ascontiguousarray(features, dtype='float32')
+        faiss.normalize_L2(query_features)
+        return index.search(query_features, top_k)
+
+    @staticmethod
+    def collect_results(metadata, row_ids, row_scores):
+        """
+        Превращает строку результатов FAISS в список найденных кепок.
+        """
         results = []
-        for feature in features:
-            query_features = feature / np.linalg.norm(feature)
-            query_features = query_features.reshape(1, -1).astype('float32')
-            D, I = index.search(query_features, top_k)
-            for idx, score in zip(I[0], D[0]):
-                if idx < len(metadata):
-                    cap_info = metadata[idx]
-                    results.append({
-                        'cap_name': cap_info['cap_name'],
-                        'image_path': cap_info['image_path'],
-                        'similarity_score': float(score)
-                    })
+        for idx, score in zip(row_ids, row_scores):
+            # Удалённые строки инкрементального индекса хранятся в метаданных как None
+            cap_info = metadata[idx] if 0 <= idx < len(metadata) else None
+            if cap_info is not None:
+                results.append({
+                    'cap_name': cap_info['cap_name'],
+                    'image_path': cap_info['image_path'],
+                    'similarity_score': float(score)
+                })
         return results
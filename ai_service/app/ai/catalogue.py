@@ -0,0 +1,178 @@
+import os
+import shutil
+import tempfile
+import threading
+import zipfile
+
+SUPPORTED_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.webp', '.tiff')
+
+# Разделитель архива и файла внутри него в ссылке на изображение: "Группа/Группа.zip!/Группа/1.webp"
+ARCHIVE_SEPARATOR = '!/'
+
+
+class CatalogueImage:
+    """
+    Изображение каталога: обычный файл или файл внутри zip архива.
+
+    reference — ключ изображения в манифесте и основа image_path в метаданных.
+    version вместе с size позволяет понять, что изображение не изменилось, не читая его:
+    для файлов это mtime_ns, для файлов в архиве — CRC32 из оглавления архива.
+    """
+
+    __slots__ = ('reference', 'path', 'member', 'size', 'version')
+
+    def __init__(self, path, size, version, member=None):
+        self.path = path
+        self.member = member
+        self.size = size
+        self.version = version
+        self.reference = join_reference(path, member)
+
+    @classmethod
+    def from_reference(cls, reference, size=None, version=None):
+        path, member = split_reference(reference)
+        return cls(path, size, version, member=member)
+
+    @property
+    def cap_name(self):
+        """
+        Группа изображения — имя папки, в которой оно лежит (в архиве или на диске).
+        Для файлов в корне архива — имя папки группы, в которой лежит сам архив.
+        """
+        folder = os.path.basename(os.path.dirname(self.path))
+        if self.member is None:
+            return folder
+        return os.path.basename(os.path.dirname(self.member)) or folder
+
+
+def join_reference(path, member=None):
+    return path if member is None else f"{path}{ARCHIVE_SEPARATOR}{member}"
+
+
+def split_reference(reference):
+    """
+    Возвращает (путь к файлу, имя файла в архиве или None).
+    """
+    path, separator, member = reference.partition(ARCHIVE_SEPARATOR)
+    return (path, member) if separator else (path, None)
+
+
+def is_image(name):
+    return os.path.splitext(name)[1].lower() in SUPPORTED_EXTENSIONS
+
+
+def scan_catalogue(data_dir):
+    """
+    Находит все изображения каталога: файлы на диске и файлы внутри zip архивов.
+    Файл архива, уже распакованный рядом с архивом, берётся с диска, а не из архива.
+    """
+    found = []
+    for root, _, files in os.walk(data_dir):
+        for file in files:
+            path = os.path.join(root, file)
+            if is_image(file):
+                stat = os.stat(path)
+                found.append(CatalogueImage(path, stat.st_size, stat.st_mtime_ns))
+            elif file.lower().endswith('.zip'):
+                found.extend(scan_archive(path))
+    return sorted(found, key=lambda image: image.reference)
+
+
+def scan_archive(path):
+    """
+    Перечисляет изображения в zip архиве по его оглавлению, не распаковывая их.
+    """
+    root = os.path.dirname(path)
+    try:
+        with zipfile.ZipFile(path) as archive:
+            members = archive.infolist()
+    except zipfile.BadZipFile as e:
+        print(f"Повреждённый архив {path}: {e}")
+        return []
+    return [
+        CatalogueImage(path, info.file_size, info.CRC, member=info.filename)
+        for info in members
+        if not info.is_dir() and is_image(info.filename)
+        and not os.path.exists(os.path.join(root, info.filename))
+    ]
+
+
+class ArchiveReader:
+    """
+    Читает изображения каталога. Открытые архивы переиспользуются между вызовами;
+    zipfile сам синхронизирует чтение разных файлов одного архива из нескольких потоков.
+    """
+
+    def __init__(self):
+        self._archives = {}
+        self._lock = threading.Lock()
+
+    def read(self, image):
+        if image.member is None:
+            with open(image.path, 'rb') as f:
+                return f.read()
+        return self._archive(image.path).read(image.member)
+
+    def _archive(self, path):
+        with self._lock:
+            archive = self._archives.get(path)
+            if archive is None:
+                archive = self._archives[path] = zipfile.ZipFile(path)
+            return archive
+
+    def close(self):
+        with self._lock:
+            for archive in self._archives.values():
+                archive.close()
+            self._archives.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def read_archive_member(path, member):
+    """
+    Читает один файл из zip архива. KeyError, если такого файла в архиве нет.
+    """
+    with zipfile.ZipFile(path) as archive:
+        return archive.read(member)
+
+
+def store_archive(source, filename, data_dir, group=None):
+    """
+    Сохраняет загруженный zip архив в папку группы каталога, не распаковывая его.
+    source — файловый объект с архивом; группа по умолчанию — имя архива. Файлы в корне архива
+    относятся к этой группе, файлы во вложенных папках — к группе по имени своей папки.
+    Архив проверяется по оглавлению до того, как появится в каталоге. Возвращает (путь, число изображений).
+    """
+    filename = os.path.basename(filename or '')
+    if not filename.lower().endswith('.zip'):
+        raise ValueError("Ожидается zip архив")
+    group = os.path.basename(group or os.path.splitext(filename)[0])
+    if group in ('', '.', '..'):
+        raise ValueError("Недопустимое имя группы")
+
+    group_folder = os.path.join(data_dir, group)
+    os.makedirs(group_folder, exist_ok=True)
+    path = os.path.join(group_folder, filename)
+    # Уникальное имя: одновременные загрузки архивов с одинаковым именем не пишут в один файл
+    with tempfile.NamedTemporaryFile(dir=group_folder, suffix='.tmp', delete=False) as f:
+        tmp_file = f.name
+    try:
+        with open(tmp_file, 'wb') as f:
+            shutil.copyfileobj(source, f, 1024 * 1024)
+        try:
+            with zipfile.ZipFile(tmp_file) as archive:
+                images = sum(1 for info in archive.infolist() if not info.is_dir() and is_image(info.filename))
+        except zipfile.BadZipFile:
+            raise ValueError("Файл не является zip архивом")
+        if not images:
+            raise ValueError("В архиве нет изображений")
+        os.replace(tmp_file, path)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+    return path, images
@@ -0,0 +1,112 @@
+import math
+import os
+from dataclasses import dataclass
+
+import faiss
+import numpy as np
+
+INDEX_TYPES = ('flat', 'ivf_flat', 'ivf_pq', 'hnsw')
+
+
+@dataclass
+class IndexConfig:
+    """
+    Тип FAISS индекса, параметры его построения и параметры поиска.
+
+    flat     — точный перебор (IndexFlatIP), базовый вариант;
+    ivf_flat — инвертированные списки, nlist кластеров, при поиске просматривается nprobe;
+    ivf_pq   — то же с продуктовым квантованием векторов (pq_m подвекторов по pq_nbits бит);
+    hnsw     — граф HNSW с hnsw_m связями, глубина поиска ef_search.
+    """
+    index_type: str = 'flat'
+    nlist: int = 256
+    pq_m: int = 64
+    pq_nbits: int = 8
+    hnsw_m: int = 32
+    nprobe: int = 16
+    ef_search: int = 64
+
+    def __post_init__(self):
+        if self.index_type not in INDEX_TYPES:
+            raise ValueError(f"Неизвестный тип индекса: {self.index_type}. Допустимые: {', '.join(INDEX_TYPES)}")
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            index_type=os.getenv("INDEX_TYPE", "flat"),
+            nlist=int(os.getenv("INDEX_NLIST", "256")),
+            pq_m=int(os.getenv("INDEX_PQ_M", "64")),
+            pq_nbits=int(os.getenv("INDEX_PQ_NBITS", "8")),
+            hnsw_m=int(os.getenv("INDEX_HNSW_M", "32")),
+            nprobe=int(os.getenv("SEARCH_NPROBE", "16")),
+            ef_search=int(os.getenv("SEARCH_EF", "64")),
+        )
+
+    def factory_string(self, dimension, count):
+        """
+        Строка для faiss.index_factory с учётом размера обучающей выборки.
+        """
+        if self.index_type == 'flat':
+            return "IDMap2,Flat"
+        if self.index_type == 'hnsw':
+            return f"IDMap2,HNSW{self.hnsw_m}"
+
+        # FAISS рекомендует не меньше ~39 обучающих векторов на кластер
+        nlist = max(1, min(self.nlist, count // 39))
+        if self.index_type == 'ivf_flat':
+            return f"IDMap2,IVF{nlist},Flat"
+
+        if dimension % self.pq_m != 0:
+            raise ValueError(f"Размерность {dimension} не делится на pq_m={self.pq_m}")
+        # Для обучения кодовой книги нужно не меньше 2**nbits векторов
+        nbits = max(1, min(self.pq_nbits, int(math.log2(max(count, 2)))))
+        return f"IDMap2,IVF{nlist},PQ{self.pq_m}x{nbits}"
+
+
+def build_index(vectors, ids, config):
+    """
+    Строит и обучает индекс выбранного типа на матрице нормализованных векторов.
+    """
+    vectors = np.ascontiguousarray(vectors, dtype='float32')
+    dimension = vectors.shape[1]
+    index = faiss.index_factory(dimension, config.factory_string(dimension, len(vectors)), faiss.METRIC_INNER_PRODUCT)
+    if not index.is_trained:
+        index.train(vectors)
+    index.add_with_ids(vectors, np.ascontiguousarray(ids, dtype='int64'))
+    configure_search(index, config)
+    return index
+
+
+def configure_search(index, config):
+    """
+    Выставляет параметры поиска (nprobe для IVF, efSearch для HNSW) загруженному индексу.
+    """
+    base_index = faiss.downcast_index(index.index) if hasattr(index, 'id_map') else index
+
+    ivf = faiss.try_extract_index_ivf(base_index)
+    if ivf is not None:
+        ivf.nprobe = min(config.nprobe, ivf.nlist)
+    elif isinstance(base_index, faiss.IndexHNSW):
+        base_index.hnsw.efSearch = config.ef_search
+    return index
+
+
+def enable_reconstruct(index):
+    """
+    Включает восстановление векторов по id (index.reconstruct) для IVF индексов: им нужна прямая карта
+    id → позиция в инвертированных списках. Flat и HNSW восстанавливают векторы и без неё.
+    """
+    base_index = faiss.downcast_index(index.index) if hasattr(index, 'id_map') else index
+    ivf = faiss.try_extract_index_ivf(base_index)
+    if ivf is not None:
+        ivf.make_direct_map()
+    return index
+
+
+def flat_vectors(index):
+    """
+    Возвращает (векторы, id) из точного индекса IndexIDMap2(IndexFlat).
+    """
+    ids = faiss.vector_to_array(index.id_map)
+    vectors = faiss.downcast_index(index.index).reconstruct_n(0, index.ntotal)
+    return vectors, ids
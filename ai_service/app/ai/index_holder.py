@@ -0,0 +1,158 @@
+import json
+import os
+import threading
+import time
+from dataclasses import dataclass
+
+from .metrics import INDEX_GENERATION, INDEX_VECTORS
+
+
+def read_generation(path):
+    """
+    Читает файл поколения индекса: {'build_id', 'model', 'index', 'metadata', 'centroids'}
+    (имена файлов — относительно каталога индекса). Возвращает None, если файла нет.
+    """
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def write_generation(path, generation):
+    """
+    Публикует поколение: файл подменяется атомарно и пишется последним, после всех файлов, которые он называет.
+    """
+    tmp_file = f"{path}.tmp"
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump(generation, f, ensure_ascii=False)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, path)
+
+
+@dataclass(frozen=True)
+class IndexSnapshot:
+    """
+    Неизменяемый снимок индекса: FAISS индекс, метаданные и индекс центроидов групп одной сборки.
+    """
+    index: object
+    metadata: object
+    generation: int
+    build_id: str = None
+    centroids: object = None
+
+    @property
+    def version(self):
+        """
+        Устойчивая версия индекса: id сборки одинаков во всех воркерах и после перезапуска
+        (generation — лишь счётчик перезагрузок в процессе).
+        """
+        return self.build_id
+
+
+class IndexHolder:
+    """
+    Держит FAISS индекс и метаданные в памяти процесса.
+
+    Сборка публикует индекс, метаданные и центроиды под именами с id сборки, а затем атомарно
+    подменяет файл поколения, который их называет. Холдер следит только за файлом поколения
+    и загружает ровно тот набор файлов, который в нём записан, поэтому индекс одной сборки
+    никогда не смешивается с метаданными другой. Читатель берёт снимок один раз на запрос
+    и работает с ним до конца.
+    """
+
+    def __init__(self, generation_file, loader, check_interval=1.0):
+        self.generation_file = generation_file
+        self.loader = loader
+        self.check_interval = check_interval
+
+        self._snapshot = None
+        self._generation = 0
+        self._file_stat = None
+        self._last_check = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def generation(self):
+        snapshot = self._snapshot
+        return snapshot.generation if snapshot else 0
+
+    @property
+    def version(self):
+        snapshot = self._snapshot
+        return snapshot.version if snapshot else None
+
+    def _stat(self):
+        """
+        (mtime_ns, size, inode) файла поколения: меняется при каждой публикации через os.replace.
+        """
+        try:
+            stat = os.stat(self.generation_file)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+    def load(self):
+        """
+        Принудительно перечитывает индекс с диска и публикует новый снимок.
+        """
+        with self._lock:
+            return self._reload_locked(self._stat())
+
+    def _reload_locked(self, file_stat):
+        self._last_check = time.monotonic()
+        if file_stat is None:
+            return self._snapshot
+
+        generation = read_generation(self.generation_file)
+        snapshot = self._snapshot
+        if generation is None:
+            return snapshot
+        if snapshot is not None and snapshot.build_id == generation['build_id']:
+            self._file_stat = file_stat
+            return snapshot
+
+        try:
+            index, metadata, centroids = self.loader(generation)
+        except (OSError, RuntimeError) as e:
+            # Файлы поколения могли удалить две публикации подряд — перечитаем при следующей проверке
+            print(f"Не удалось загрузить индекс сборки {generation['build_id']}: {e}")
+            return snapshot
+        self._file_stat = file_stat
+        if index is None or metadata is None:
+            return snapshot
+
+        self._generation += 1
+        self._snapshot = IndexSnapshot(index, metadata, self._generation, generation['build_id'], centroids)
+        INDEX_GENERATION.set(self._generation)
+        INDEX_VECTORS.set(index.ntotal)
+        print(f"Загружен индекс сборки {generation['build_id']} (поколение {self._generation}): "
+              f"{index.ntotal} векторов.")
+        return self._snapshot
+
+    def get(self):
+        """
+        Возвращает актуальный снимок индекса (или None, если индекса нет).
+
+        Не чаще раза в check_interval секунд сверяет файл поколения на диске
+        и перезагружает индекс, если его опубликовали заново.
+        """
+        snapshot = self._snapshot
+        if snapshot is not None:
+            if time.monotonic() - self._last_check < self.check_interval:
+                return snapshot
+            # Пока другой поток перечитывает индекс, продолжаем отвечать из текущего снимка
+            if not self._lock.acquire(blocking=False):
+                return snapshot
+        else:
+            self._lock.acquire()
+
+        try:
+            file_stat = self._stat()
+            if self._snapshot is not None and file_stat == self._file_stat:
+                self._last_check = time.monotonic()
+                return self._snapshot
+            return self._reload_locked(file_stat)
+        finally:
+            self._lock.release()
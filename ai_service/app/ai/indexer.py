@@ -0,0 +1,353 @@
+import hashlib
+import json
+import os
+from io import BytesIO
+
+import faiss
+import numpy as np
+from PIL import Image
+
+from .catalogue import ArchiveReader, CatalogueImage, join_reference, scan_catalogue
+from .index_factory import build_index, flat_vectors
+from .index_holder import read_generation
+from .metadata_store import MetadataStore
+from .pipeline import pipeline_stage
+
+
+def replace_atomically(path, write):
+    """
+    Записывает файл через временный файл и os.replace, чтобы читатели не увидели его наполовину.
+    """
+    tmp_file = f"{path}.tmp"
+    write(tmp_file)
+    os.replace(tmp_file, path)
+
+
+class IncrementalIndexer:
+    """
+    Инкрементальная сборка FAISS индекса.
+
+    Манифест хранит для каждого изображения (размер, версию, sha1) и id его строк в индексе;
+    изображения в zip архивах адресуются как "архив.zip!/файл" и читаются без распаковки.
+    При запуске заново кодируются только новые и изменившиеся изображения, строки удалённых
+    изображений убираются из индекса. Векторы хранятся в точном IndexIDMap2(IndexFlatIP), поэтому строки
+    добавляются и удаляются по id, а metadata — список, где metadata[id] описывает строку (None для удалённых).
+    Индекс для поиска (тип задаётся recognizer.index_config) и центроиды групп строятся из этих векторов
+    при публикации и публикуются вместе с метаданными одним поколением (recognizer.publish_index).
+    После каждых checkpoint_every изображений векторы, метаданные и манифест сохраняются в контрольную точку,
+    и упавшая сборка продолжается с места остановки.
+    """
+
+    def __init__(self, recognizer, manifest_file=None, workers=4, chunk_size=16, checkpoint_every=256,
+                 thumbnails=None):
+        self.recognizer = recognizer
+        # ThumbnailStore: JPEG копии для выдачи строятся на этапе decode из уже декодированного изображения
+        self.thumbnails = thumbnails
+        self.manifest_file = manifest_file or recognizer.manifest_file
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.checkpoint_every = checkpoint_every
+
+        # Точная копия всех векторов, из которой строится и обучается индекс для поиска
+        self.vectors_file = recognizer.index_path('faiss_index_vectors.bin')
+
+        # Пути в метаданных хранятся относительно static/, как их ожидает эндпоинт /images
+        self.static_dir = os.path.dirname(os.path.normpath(recognizer.data_dir))
+
+    def scan(self):
+        """
+        Находит все изображения каталога, включая изображения внутри zip архивов.
+        """
+        return scan_catalogue(self.recognizer.data_dir)
+
+    def image_path(self, image):
+        """
+        Путь изображения в метаданных: относительно static/, как его ожидают эндпоинты /images и /thumbnails.
+        """
+        return join_reference(os.path.relpath(image.path, self.static_dir), image.member)
+
+    def state_files(self, checkpoint=False):
+        """
+        Пути (векторы, метаданные, манифест) опубликованного состояния или контрольной точки.
+        Метаданные опубликованного состояния — метаданные текущего поколения индекса (None, если его нет).
+        Контрольные точки пишутся в отдельные файлы, чтобы поиск до конца сборки
+        обслуживался предыдущим индексом.
+        """
+        if checkpoint:
+            return (f"{self.vectors_file}.checkpoint", self.recognizer.index_path('metadata.bin.checkpoint'),
+                    f"{self.manifest_file}.checkpoint")
+        generation = read_generation(self.recognizer.generation_file)
+        metadata_file = self.recognizer.index_path(generation['metadata']) if generation else None
+        return self.vectors_file, metadata_file, self.manifest_file
+
+    def load_state(self):
+        """
+        Загружает манифест, векторы и метаданные: из контрольной точки прерванной сборки, если она есть,
+        иначе из опубликованного состояния. Строки, которых нет в манифесте, удаляются.
+        """
+        checkpoint = os.path.exists(self.state_files(checkpoint=True)[2])
+        vectors_file, metadata_file, manifest_file = self.state_files(checkpoint)
+        if checkpoint:
+            print("Найдена контрольная точка, продолжаем прерванную сборку.")
+        if not all(path and os.path.exists(path) for path in (vectors_file, metadata_file, manifest_file)):
+            return self.empty_manifest(), None, []
+
+        with open(manifest_file, encoding='utf-8') as f:
+            manifest = json.load(f)
+        index = faiss.read_index(vectors_file)
+        metadata = MetadataStore.open(metadata_file).to_list()
+
+        known_ids = {row_id for entry in manifest['images'].values() for row_id in entry['ids']}
+        index_ids = faiss.vector_to_array(index.id_map)
+        orphan_ids = [int(row_id) for row_id in index_ids if row_id not in known_ids]
+        if orphan_ids:
+            print(f"Удаляем {len(orphan_ids)} строк индекса, отсутствующих в манифесте.")
+            self._remove_rows(index, metadata, orphan_ids)
+        return manifest, index, metadata
+
+    @staticmethod
+    def empty_manifest():
+        return {'next_id': 0, 'images': {}}
+
+    def save_state(self, manifest, index, metadata, checkpoint=False):
+        """
+        Сохраняет состояние. Манифест пишется последним: всё, что в нём есть, уже в индексе.
+        При публикации сначала строится индекс для поиска, затем индекс, метаданные и центроиды
+        публикуются одним поколением, и только после этого обновляются точные векторы и манифест.
+        """
+        vectors_file, metadata_file, manifest_file = self.state_files(checkpoint)
+
+        def write_manifest(path):
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(manifest, f, ensure_ascii=False)
+
+        if checkpoint:
+            replace_atomically(metadata_file, lambda path: MetadataStore.write(path, metadata))
+        else:
+            vectors, ids = flat_vectors(index)
+            search_index = self.build_search_index(index, vectors, ids)
+            self.recognizer.publish_index(search_index, metadata, vectors, ids)
+        replace_atomically(vectors_file, lambda path: faiss.write_index(index, path))
+        replace_atomically(manifest_file, write_manifest)
+
+    def build_search_index(self, index, vectors, ids):
+        """
+        Строит индекс для поиска из точных векторов согласно recognizer.index_config.
+        """
+        config = self.recognizer.index_config
+        if config.index_type == 'flat':
+            return index
+
+        print(f"Обучаем индекс {config.index_type} на {index.ntotal} векторах...")
+        return build_index(vectors, ids, config)
+
+    def discard_checkpoint(self):
+        for path in self.state_files(checkpoint=True):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def prepare(self, image, entry, reader):
+        """
+        Читает изображение каталога (файл или файл в архиве): считает хэш и, если содержимое изменилось,
+        декодирует его прямо из памяти и обновляет JPEG копию для выдачи.
+        Возвращает (sha1, изображение PIL или None, если содержимое не изменилось).
+        """
+        data = reader.read(image)
+        sha1 = hashlib.sha1(data).hexdigest()
+        unchanged = entry is not None and entry['sha1'] == sha1
+        if unchanged and not self._thumbnail_missing(image):
+            return sha1, None
+
+        decoded = Image.open(BytesIO(data)).convert("RGB")
+        if self.thumbnails is not None:
+            self.thumbnails.write(self.image_path(image), decoded)
+        if unchanged:
+            return sha1, None
+        return sha1, self.recognizer.resize_image_if_needed(decoded)
+
+    def _thumbnail_missing(self, image):
+        return self.thumbnails is not None and not self.thumbnails.exists(self.image_path(image))
+
+    def run(self, full=False, job=None):
+        """
+        Обновляет индекс по текущему содержимому каталога и возвращает статистику.
+
+        Изменившиеся изображения проходят конвейер decode → detect → embed: каждый этап работает
+        в своём потоке, а между этапами стоят ограниченные очереди, так что в памяти одновременно
+        лишь несколько порций изображений. Изображения из zip архивов читаются без распаковки на диск.
+        Если передан job (BuildJob), в него пишется прогресс, а между порциями проверяется отмена;
+        при отмене прогресс сохраняется в контрольную точку.
+        """
+        if job is not None:
+            job.set_stage("scanning")
+        if full:
+            self.discard_checkpoint()
+            manifest, index, metadata = self.empty_manifest(), None, []
+        else:
+            manifest, index, metadata = self.load_state()
+        images = manifest['images']
+
+        catalogue = self.scan()
+        present = {image.reference for image in catalogue}
+        stats = {'total': len(catalogue), 'added': 0, 'updated': 0, 'removed': 0, 'unchanged': 0, 'failed': 0}
+
+        # Удалённые изображения
+        removed = [reference for reference in images if reference not in present]
+        for reference in removed:
+            self._remove_rows(index, metadata, images.pop(reference)['ids'])
+            if self.thumbnails is not None:
+                self.thumbnails.remove(self.image_path(CatalogueImage.from_reference(reference)))
+        stats['removed'] = len(removed)
+
+        # Изображения с тем же размером и версией (mtime или CRC в архиве) считаем неизменившимися без чтения,
+        # если для них уже есть JPEG копия
+        candidates = []
+        for image in catalogue:
+            entry = images.get(image.reference)
+            if (entry is not None and entry['size'] == image.size and entry.get('version') == image.version
+                    and not self._thumbnail_missing(image)):
+                stats['unchanged'] += 1
+            else:
+                candidates.append(image)
+
+        print(f"Найдено {len(catalogue)} изображений: {len(candidates)} новых или изменённых, "
+              f"{len(removed)} удалённых.")
+        if job is not None:
+            job.set_stage("embedding", total=len(candidates))
+
+        processed_since_checkpoint = 0
+        with ArchiveReader() as reader:
+            decoded = pipeline_stage(
+                candidates, lambda image: self._decode(image, images.get(image.reference), reader),
+                workers=self.workers, maxsize=self.chunk_size * 2, name="index-decode"
+            )
+            detected = pipeline_stage(decoded, self._detect, batch_size=self.chunk_size, name="index-detect")
+            embedded = pipeline_stage(detected, self._embed, name="index-embed")
+            try:
+                for records, features in embedded:
+                    index = self._apply_chunk(records, features, manifest, index, metadata, stats)
+
+                    processed_since_checkpoint += len(records)
+                    if job is not None:
+                        job.advance(len(records))
+                        if job.cancelled and index is not None:
+                            self.save_state(manifest, index, metadata, checkpoint=True)
+                        job.check_cancelled()
+                    if processed_since_checkpoint >= self.checkpoint_every and index is not None:
+                        self.save_state(manifest, index, metadata, checkpoint=True)
+                        processed_since_checkpoint = 0
+                        print(f"Контрольная точка: обработано {stats['added'] + stats['updated']} изображений.")
+            finally:
+                # Останавливает все этапы конвейера до закрытия архивов
+                embedded.close()
+
+        stats['vectors'] = index.ntotal if index is not None else 0
+        if job is not None:
+            job.set_stage("publishing")
+        if index is not None:
+            self.save_state(manifest, index, metadata)
+        self.discard_checkpoint()
+        print(f"Индекс обновлён: {stats}")
+        return stats
+
+    def _decode(self, image, entry, reader):
+        """
+        Этап decode: возвращает (изображение каталога, sha1, изображение PIL или None, ошибка).
+        """
+        try:
+            sha1, decoded = self.prepare(image, entry, reader)
+        except Exception as e:
+            return image, None, None, e
+        return image, sha1, decoded, None
+
+    def _detect(self, prepared):
+        """
+        Этап detect: одним вызовом YOLO вырезает кепки на всех изменившихся изображениях порции.
+        Возвращает записи (изображение каталога, sha1, кепки или None, ошибка).
+        Если YOLO упал на порции, её изменившиеся изображения помечаются ошибкой, а сборка продолжается.
+        """
+        to_detect = [decoded for _, _, decoded, error in prepared if decoded is not None]
+        try:
+            crops_per_image = iter(self.recognizer.detect_caps_batch(to_detect))
+        except Exception as e:
+            return [
+                (image, sha1, None, e if decoded is not None else error)
+                for image, sha1, decoded, error in prepared
+            ]
+        return [
+            (image, sha1, next(crops_per_image) if decoded is not None else None, error)
+            for image, sha1, decoded, error in prepared
+        ]
+
+    def _embed(self, records):
+        """
+        Этап embed: кодирует CLIP все кепки порции одним батчем.
+        Если CLIP упал на порции, изображения с кепками помечаются ошибкой и попадут в следующую сборку.
+        """
+        crops = [crop for _, _, image_crops, _ in records if image_crops for crop in image_crops]
+        try:
+            features = self.recognizer.extract_features_clip_batch(crops) if crops else None
+        except Exception as e:
+            records = [
+                (image, sha1, None, e) if image_crops else (image, sha1, image_crops, error)
+                for image, sha1, image_crops, error in records
+            ]
+            return records, None
+        return records, features
+
+    def _apply_chunk(self, records, features, manifest, index, metadata, stats):
+        """
+        Добавляет векторы порции в индекс и обновляет манифест и метаданные (в потоке сборки).
+        """
+        images = manifest['images']
+        if index is None and features is not None:
+            index = faiss.IndexIDMap2(faiss.IndexFlatIP(features.shape[1]))
+
+        row = 0
+        new_ids, new_rows = [], []
+        for image, sha1, image_crops, error in records:
+            if error is not None:
+                print(f"Ошибка при обработке изображения {image.reference}: {error}")
+                stats['failed'] += 1
+                continue
+
+            entry = images.get(image.reference)
+            if image_crops is None:
+                # Содержимое не изменилось, поменялись только атрибуты файла
+                entry.update(size=image.size, version=image.version)
+                stats['unchanged'] += 1
+                continue
+
+            if entry is not None:
+                self._remove_rows(index, metadata, entry['ids'])
+                stats['updated'] += 1
+            else:
+                stats['added'] += 1
+
+            ids = list(range(manifest['next_id'], manifest['next_id'] + len(image_crops)))
+            manifest['next_id'] += len(image_crops)
+            metadata.extend([None] * (manifest['next_id'] - len(metadata)))
+            for row_id in ids:
+                metadata[row_id] = {
+                    'cap_name': image.cap_name,
+                    'image_path': self.image_path(image)
+                }
+            new_ids.extend(ids)
+            new_rows.extend(range(row, row + len(image_crops)))
+            row += len(image_crops)
+
+            images[image.reference] = {'size': image.size, 'version': image.version, 'sha1': sha1, 'ids': ids}
+
+        if new_ids:
+            vectors = np.ascontiguousarray(features[new_rows], dtype='float32')
+            faiss.normalize_L2(vectors)
+            index.add_with_ids(vectors, np.array(new_ids, dtype='int64'))
+        return index
+
+    @staticmethod
+    def _remove_rows(index, metadata, ids):
+        if index is not None and ids:
+            index.remove_ids(np.array(ids, dtype='int64'))
+        for row_id in ids:
+            if row_id < len(metadata):
+                metadata[row_id] = None
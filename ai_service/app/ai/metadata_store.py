@@ -0,0 +1,152 @@
+import os
+import struct
+
+import numpy as np
+
+MAGIC = b'CAPSMETA'
+VERSION = 1
+# magic, версия, число строк, число групп, длина блоба имён, длина блоба путей
+HEADER = struct.Struct('<8sIQQQQ')
+
+
+def _align(offset):
+    return (offset + 7) & ~7
+
+
+class MetadataStore:
+    """
+    Колоночное хранилище метаданных индекса в одном файле, открываемое через mmap.
+
+    Строка индекса с id row описывается номером группы group_ids[row] (-1 — строка удалена)
+    и путём к изображению, лежащим в блобе путей между path_offsets[row] и path_offsets[row + 1].
+    Названия групп хранятся один раз в отдельной таблице. Файл открывается за константное время,
+    страницы разделяются между процессами uvicorn, а объекты Python создаются только для найденных строк.
+    Для совместимости с кодом, работавшим со списком словарей, metadata[row] возвращает
+    {'cap_name', 'image_path'} или None.
+
+    Формат файла: заголовок HEADER, затем выровненные по 8 байт секции
+    group_ids (int32[rows]), path_offsets (int64[rows + 1]), name_offsets (int64[groups + 1]),
+    блоб имён групп и блоб путей в UTF-8.
+    """
+
+    def __init__(self, group_ids, path_offsets, paths_blob, cap_names):
+        self.group_ids = group_ids
+        self.path_offsets = path_offsets
+        self.paths_blob = paths_blob
+        self.cap_names = cap_names
+        # Строки по группам в формате CSR: (строки, упорядоченные по группе; границы групп), строится при первом запросе
+        self._group_index = None
+        # Множество путей неудалённых строк, строится при первом запросе
+        self._image_paths = None
+
+    @classmethod
+    def open(cls, path):
+        """
+        Открывает файл метаданных через mmap.
+        """
+        buffer = np.memmap(path, dtype=np.uint8, mode='r')
+        magic, version, rows, groups, names_length, paths_length = HEADER.unpack_from(buffer, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"Неизвестный формат файла метаданных: {path}")
+
+        offset = _align(HEADER.size)
+        group_ids = np.frombuffer(buffer, dtype='<i4', count=rows, offset=offset)
+        offset = _align(offset + group_ids.nbytes)
+        path_offsets = np.frombuffer(buffer, dtype='<i8', count=rows + 1, offset=offset)
+        offset = _align(offset + path_offsets.nbytes)
+        name_offsets = np.frombuffer(buffer, dtype='<i8', count=groups + 1, offset=offset)
+        offset = _align(offset + name_offsets.nbytes)
+        names_blob = bytes(buffer[offset:offset + names_length])
+        offset += names_length
+        paths_blob = buffer[offset:offset + paths_length]
+
+        cap_names = [
+            names_blob[start:end].decode('utf-8')
+            for start, end in zip(name_offsets[:-1], name_offsets[1:])
+        ]
+        return cls(group_ids, path_offsets, paths_blob, cap_names)
+
+    @staticmethod
+    def write(path, records):
+        """
+        Записывает список {'cap_name', 'image_path'} (или None для удалённых строк) в файл.
+        """
+        group_by_name = {}
+        group_ids = np.full(len(records), -1, dtype='<i4')
+        path_offsets = np.zeros(len(records) + 1, dtype='<i8')
+        encoded_paths = []
+        position = 0
+        for row, record in enumerate(records):
+            if record is not None:
+                group_ids[row] = group_by_name.setdefault(record['cap_name'], len(group_by_name))
+                encoded = record['image_path'].encode('utf-8')
+                encoded_paths.append(encoded)
+                position += len(encoded)
+            path_offsets[row + 1] = position
+
+        encoded_names = [name.encode('utf-8') for name in group_by_name]
+        name_offsets = np.zeros(len(encoded_names) + 1, dtype='<i8')
+        name_offsets[1:] = np.cumsum([len(name) for name in encoded_names], dtype='<i8')
+        names_blob = b''.join(encoded_names)
+        paths_blob = b''.join(encoded_paths)
+
+        with open(path, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, VERSION, len(records), len(encoded_names), len(names_blob), len(paths_blob)))
+            for array in (group_ids, path_offsets, name_offsets):
+                f.write(b'\0' * (_align(f.tell()) - f.tell()))
+                f.write(array.tobytes())
+            f.write(b'\0' * (_align(f.tell()) - f.tell()))
+            f.write(names_blob)
+            f.write(paths_blob)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def __len__(self):
+        return len(self.group_ids)
+
+    def group_id(self, row):
+        return int(self.group_ids[row])
+
+    def cap_name(self, row):
+        group_id = self.group_ids[row]
+        return self.cap_names[group_id] if group_id >= 0 else None
+
+    def image_path(self, row):
+        start, end = self.path_offsets[row], self.path_offsets[row + 1]
+        return bytes(self.paths_blob[start:end]).decode('utf-8')
+
+    def group_rows(self, group_id):
+        """
+        id строк группы без прохода по всем строкам: CSR индекс групп строится один раз на файл.
+        """
+        group_index = self._group_index
+        if group_index is None:
+            valid = np.flatnonzero(self.group_ids >= 0)
+            rows = valid[np.argsort(self.group_ids[valid], kind='stable')]
+            offsets = np.searchsorted(self.group_ids[rows], np.arange(len(self.cap_names) + 1))
+            # Пара присваивается одной ссылкой, поэтому параллельные потоки видят индекс целиком
+            group_index = self._group_index = (rows, offsets)
+        rows, offsets = group_index
+        return rows[offsets[group_id]:offsets[group_id + 1]]
+
+    def has_image_path(self, image_path):
+        """
+        Есть ли изображение с таким путём среди неудалённых строк.
+        """
+        image_paths = self._image_paths
+        if image_paths is None:
+            image_paths = self._image_paths = frozenset(
+                self.image_path(row) for row in np.flatnonzero(self.group_ids >= 0)
+            )
+        return image_path in image_paths
+
+    def __getitem__(self, row):
+        if self.group_ids[row] < 0:
+            return None
+        return {'cap_name': self.cap_name(row), 'image_path': self.image_path(row)}
+
+    def to_list(self):
+        """
+        Разворачивает хранилище в изменяемый список словарей (нужно только при сборке индекса).
+        """
+        return [self[row] for row in range(len(self))]
@@ -0,0 +1,59 @@
+"""
+Метрики сервиса поиска в формате Prometheus.
+
+Под gunicorn с несколькими воркерами значения пишутся в файлы каталога PROMETHEUS_MULTIPROC_DIR
+(его задаёт gunicorn.conf.py до импорта приложения), а /metrics собирает их со всех воркеров.
+Без этой переменной (uvicorn в одном процессе) используется обычный реестр процесса.
+"""
+import os
+
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram,
+                               generate_latest)
+
+# Длительности от миллисекунд (кэш, FAISS) до десятков секунд (YOLO + CLIP на большом батче)
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+HTTP_REQUESTS = Counter(
+    'caps_http_requests', "Запросы к API по маршруту и коду ответа", ['method', 'route', 'status']
+)
+HTTP_REQUEST_SECONDS = Histogram(
+    'caps_http_request_seconds', "Время обработки запроса к API", ['route'], buckets=LATENCY_BUCKETS
+)
+HTTP_IN_FLIGHT = Gauge(
+    'caps_http_requests_in_flight', "Запросы к API, обрабатываемые сейчас", multiprocess_mode='livesum'
+)
+
+STAGE_SECONDS = Histogram(
+    'caps_search_stage_seconds',
+    "Время этапов поиска на батч запросов: decode, hash, cache, detect, embed, search, aggregate",
+    ['stage'], buckets=LATENCY_BUCKETS
+)
+SEARCH_BATCH_SIZE = Histogram(
+    'caps_search_batch_size', "Число запросов в батче поиска", buckets=(1, 2, 4, 8, 16, 32, 64)
+)
+SEARCH_QUEUE_DEPTH = Gauge(
+    'caps_search_queue_depth', "Запросы в очереди поиска", multiprocess_mode='livesum'
+)
+SEARCH_REJECTED = Counter('caps_search_rejected', "Запросы поиска, отклонённые из-за переполнения очереди")
+CACHE_REQUESTS = Counter(
+    'caps_cache_requests', "Обращения к кэшам результатов и эмбеддингов", ['cache', 'result']
+)
+
+INDEX_VECTORS = Gauge('caps_index_vectors', "Число векторов в загруженном индексе", multiprocess_mode='max')
+INDEX_GENERATION = Gauge(
+    'caps_index_generation', "Поколение загруженного индекса в процессе", multiprocess_mode='liveall'
+)
+
+
+def render_metrics():
+    """
+    Возвращает (тело ответа /metrics, Content-Type).
+    """
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
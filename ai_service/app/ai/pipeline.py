@@ -0,0 +1,78 @@
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+_DONE = object()
+
+
+def pipeline_stage(items, func, workers=1, batch_size=None, maxsize=2, name="stage"):
+    """
+    Этап конвейера: генератор, который применяет func к элементам items в фоновом потоке
+    (workers > 1 — в пуле потоков) и отдаёт результаты в исходном порядке.
+
+    Между этапом и потребителем стоит очередь на maxsize результатов, поэтому этап уходит вперёд
+    не больше чем на maxsize результатов и память не растёт, если потребитель медленнее.
+    С batch_size func получает списки до batch_size элементов.
+    Исключение в func или в items останавливает этап и пробрасывается потребителю.
+    Если потребитель закрывает генератор, этап останавливается и закрывает items.
+    """
+    results = queue.Queue(maxsize)
+    stop = threading.Event()
+
+    def put(value):
+        while not stop.is_set():
+            try:
+                results.put(value, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        source = _batches(items, batch_size) if batch_size else items
+        executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name)
+        in_flight = deque()
+        try:
+            for item in source:
+                if stop.is_set():
+                    break
+                in_flight.append(executor.submit(func, item))
+                if len(in_flight) > workers and not put((in_flight.popleft().result(), None)):
+                    break
+            while in_flight and not stop.is_set():
+                put((in_flight.popleft().result(), None))
+            put(_DONE)
+        except Exception as e:
+            put((None, e))
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+            close = getattr(items, 'close', None)
+            if close is not None:
+                close()
+
+    thread = threading.Thread(target=produce, name=name, daemon=True)
+    thread.start()
+    try:
+        while True:
+            value = results.get()
+            if value is _DONE:
+                return
+            result, error = value
+            if error is not None:
+                raise error
+            yield result
+    finally:
+        stop.set()
+        thread.join()
+
+
+def _batches(items, batch_size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
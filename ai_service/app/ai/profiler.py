@@ -0,0 +1,102 @@
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+
+
+class SamplingProfiler:
+    """
+    Сэмплирующий профилировщик без внешних зависимостей.
+
+    Фоновый поток раз в interval секунд снимает стеки всех потоков процесса (sys._current_frames)
+    и считает одинаковые стеки. Снимаются все потоки, поэтому в профиль попадает и работа запроса
+    в потоках инференса, и то, что в это время делали остальные потоки; корень каждого стека — имя потока.
+    Результат в формате folded stacks открывается в speedscope или flamegraph.pl.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.samples = Counter()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        return self.samples
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                self.samples[";".join(reversed(stack))] += 1
+
+    def folded(self):
+        return "".join(f"{stack} {count}\n" for stack, count in self.samples.most_common())
+
+
+class RequestProfiler:
+    """
+    Профилирование части запросов по запросу оператора (по умолчанию выключено).
+
+    Каждый запрос с вероятностью sample_rate профилируется SamplingProfiler; профиль сохраняется
+    в output_dir, только если запрос шёл дольше min_ms — так на диск попадают именно медленные запросы.
+    Профилировщик снимает стеки всего процесса, поэтому одновременно профилируется не больше одного запроса.
+    """
+
+    def __init__(self, sample_rate=0.0, min_ms=0.0, output_dir="profiles", interval=0.005):
+        self.sample_rate = sample_rate
+        self.min_ms = min_ms
+        self.output_dir = output_dir
+        self.interval = interval
+        self._busy = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.sample_rate > 0
+
+    def begin(self):
+        """
+        Решает, профилировать ли запрос. Возвращает запущенный SamplingProfiler или None.
+        """
+        if not self.enabled or random.random() >= self.sample_rate or not self._busy.acquire(blocking=False):
+            return None
+        profiler = SamplingProfiler(self.interval)
+        profiler.start()
+        return profiler
+
+    def finish(self, profiler, name, elapsed):
+        """
+        Останавливает профилировщик и, если запрос был медленным, сохраняет профиль. Возвращает путь или None.
+        """
+        try:
+            profiler.stop()
+        finally:
+            self._busy.release()
+        elapsed_ms = elapsed * 1000
+        if elapsed_ms < self.min_ms or not profiler.samples:
+            return None
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        safe_name = "".join(char if char.isalnum() else "_" for char in name).strip("_") or "request"
+        filename = f"{time.strftime('%Y%m%d-%H%M%S')}_{os.getpid()}_{safe_name}_{elapsed_ms:.0f}ms.folded"
+        path = os.path.join(self.output_dir, filename)
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(profiler.folded())
+        return path
@@ -0,0 +1,65 @@
+import hashlib
+import os
+import threading
+from io import BytesIO
+
+from PIL import Image
+
+
+class ThumbnailStore:
+    """
+    Хранилище уменьшенных JPEG копий изображений каталога для выдачи в результатах поиска.
+
+    Копии строятся при сборке индекса из уже декодированного изображения, поэтому при выдаче
+    не нужно ни декодировать оригинал, ни перекодировать WEBP. Ключ — image_path из метаданных,
+    файл лежит в root/<первые 2 символа sha1>/<sha1 от image_path>.jpg.
+    """
+
+    def __init__(self, root='static/thumbnails', max_side=800, quality=85):
+        self.root = root
+        self.max_side = max_side
+        self.quality = quality
+
+    def path(self, image_path):
+        key = hashlib.sha1(image_path.replace('\\', '/').encode('utf-8')).hexdigest()
+        return os.path.join(self.root, key[:2], f"{key}.jpg")
+
+    def exists(self, image_path):
+        return os.path.exists(self.path(image_path))
+
+    def encode(self, image):
+        """
+        Уменьшает изображение так, чтобы большая сторона не превышала max_side, и кодирует его в JPEG.
+        """
+        thumbnail = image.convert("RGB")
+        if thumbnail is image:
+            thumbnail = image.copy()
+        thumbnail.thumbnail((self.max_side, self.max_side), Image.LANCZOS)
+        buffer = BytesIO()
+        thumbnail.save(buffer, "JPEG", quality=self.quality, optimize=True, progressive=True)
+        return buffer.getvalue()
+
+    def write(self, image_path, image):
+        """
+        Сохраняет копию изображения PIL (атомарно, через временный файл) и возвращает путь к ней.
+        """
+        path = self.path(image_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_file = f"{path}.tmp.{os.getpid()}.{threading.get_ident()}"
+        with open(tmp_file, 'wb') as f:
+            f.write(self.encode(image))
+        os.replace(tmp_file, path)
+        return path
+
+    def remove(self, image_path):
+        path = self.path(image_path)
+        if os.path.exists(path):
+            os.remove(path)
+
+    @staticmethod
+    def etag(path):
+        """
+        ETag по размеру и времени изменения файла копии: меняется при каждой пересборке копии.
+        """
+        stat = os.stat(path)
+        return f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
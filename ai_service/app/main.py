@@ -1,102 +1,338 @@
+import asyncio
 import logging
 import mimetypes
 import os
-import shutil
+import posixpath
+import time
+import uuid
+from contextlib import asynccontextmanager
+from io import BytesIO
 from pathlib import Path
+from urllib.parse import quote
 
-from fastapi import FastAPI, File, HTTPException, UploadFile
-from starlette.responses import FileResponse
+from fastapi import Body, FastAPI, File, HTTPException, Query, Request, UploadFile
+from fastapi.responses import JSONResponse
+from PIL import Image
+from starlette.responses import FileResponse, Response
 
-from .ai import CapsRecognizer
+from .ai import (AGGREGATIONS, BuildJobManager, CapsRecognizer, IncrementalIndexer, IndexConfig, MicroBatcher,
+                 QueueFull, ThumbnailStore)
+from .ai.catalogue import join_reference, read_archive_member, split_reference, store_archive
+from .ai.metrics import (HTTP_IN_FLIGHT, HTTP_REQUEST_SECONDS, HTTP_REQUESTS, SEARCH_BATCH_SIZE, SEARCH_QUEUE_DEPTH,
+                         SEARCH_REJECTED, render_metrics)
+from .ai.profiler import RequestProfiler
 
 logger = logging.getLogger(__name__)
 
 os.environ["KMP_DUPLICATE_LIB_OK"] = "TRUE"
 # Импортируем CapsRecognizer из вашего модуля
 
-app = FastAPI(title="Caps FAISS Search API")
+# Потоки инференса поиска. Пул потоков PyTorch общий на процесс, поэтому по умолчанию ядра делятся
+# поровну между процессами (WEB_CONCURRENCY) и потоками инференса в них, а не каждый пытается занять все ядра
+inference_workers = int(os.getenv("INFERENCE_WORKERS", "1"))
+web_concurrency = int(os.getenv("WEB_CONCURRENCY", "1"))
+intra_op_threads = int(os.getenv("INTRA_OP_THREADS", "0")) or max(
+    1, (os.cpu_count() or 1) // (inference_workers * web_concurrency)
+)
 
 # Инициализация CapsRecognizer
 caps_recognizer = CapsRecognizer(
     device='cpu',
     yolo_weights='static/weights/best.pt',
-    clip_model_name="ViT-L/14"
+    clip_model_name=os.getenv("CLIP_MODEL_NAME", "ViT-L/14"),
+    index_config=IndexConfig.from_env(),
+    overfetch=int(os.getenv("SEARCH_OVERFETCH", "10")),
+    backend=os.getenv("INFERENCE_BACKEND", "torch"),
+    intra_op_threads=intra_op_threads,
+    inter_op_threads=int(os.getenv("INTER_OP_THREADS", "0")) or None,
+    result_cache_size=int(os.getenv("AI_RESULT_CACHE_SIZE", "1024")),
+    result_cache_ttl=float(os.getenv("AI_RESULT_CACHE_TTL", "3600")),
+    embedding_cache_size=int(os.getenv("EMBEDDING_CACHE_SIZE", "1024")),
+    decode_max_side=int(os.getenv("DECODE_MAX_SIDE", "1280")),
+    # Отдельный экземпляр YOLO на каждый поток инференса и на фоновую сборку индекса
+    yolo_instances=inference_workers + 1
+)
+
+# JPEG копии изображений для выдачи в результатах: строятся при сборке индекса
+thumbnail_store = ThumbnailStore(
+    os.getenv("THUMBNAIL_DIR", "static/thumbnails"),
+    max_side=int(os.getenv("THUMBNAIL_MAX_SIDE", "800")),
+    quality=int(os.getenv("THUMBNAIL_QUALITY", "85"))
+)
+thumbnail_max_age = int(os.getenv("THUMBNAIL_MAX_AGE", "86400"))
+thumbnail_batch_limit = int(os.getenv("THUMBNAIL_BATCH_LIMIT", "50"))
+
+indexer = IncrementalIndexer(
+    caps_recognizer,
+    workers=int(os.getenv("BUILD_WORKERS", "4")),
+    checkpoint_every=int(os.getenv("BUILD_CHECKPOINT_EVERY", "256")),
+    thumbnails=thumbnail_store
+)
+
+
+def search_batch(queries):
+    """
+    Поиск батча по одному снимку индекса. Возвращает для каждого запроса (результаты, версия индекса),
+    чтобы ответ называл ту сборку, по которой искали, а не загруженную к моменту ответа.
+    """
+    SEARCH_BATCH_SIZE.observe(len(queries))
+    SEARCH_QUEUE_DEPTH.set(search_batcher.pending)
+    snapshot = caps_recognizer.index_holder.get()
+    version = snapshot.version if snapshot else None
+    return [(results, version) for results in caps_recognizer.search_similar_caps_batch(queries, snapshot)]
+
+
+# Наибольший top_k запроса поиска: все запросы батча ищутся с общим fetch_k = max(top_k * overfetch),
+# поэтому один запрос с огромным top_k замедлил бы весь батч
+max_top_k = int(os.getenv("SEARCH_MAX_TOP_K", "50"))
+
+# Запросы на поиск, пришедшие почти одновременно, обрабатываются одним батчем YOLO + CLIP.
+# При переполнении очереди запрос сразу получает 503 с Retry-After вместо роста задержки
+search_batcher = MicroBatcher(
+    search_batch,
+    window_ms=float(os.getenv("SEARCH_BATCH_WINDOW_MS", "10")),
+    max_batch_size=int(os.getenv("SEARCH_MAX_BATCH_SIZE", "16")),
+    workers=inference_workers,
+    max_pending=int(os.getenv("SEARCH_MAX_PENDING", "64")),
+    name="search-batcher"
+)
+
+# Профилирование медленных запросов (по умолчанию выключено): PROFILE_SAMPLE_RATE — доля профилируемых запросов,
+# в PROFILE_DIR сохраняются профили запросов дольше PROFILE_MIN_MS
+request_profiler = RequestProfiler(
+    sample_rate=float(os.getenv("PROFILE_SAMPLE_RATE", "0")),
+    min_ms=float(os.getenv("PROFILE_MIN_MS", "1000")),
+    output_dir=os.getenv("PROFILE_DIR", "profiles"),
+    interval=float(os.getenv("PROFILE_INTERVAL_MS", "5")) / 1000
 )
 
 
-def save_upload_file(upload_file: UploadFile, destination: Path) -> Path:
+# Прогрев повторяется WARMUP_ATTEMPTS раз; если все попытки неудачны, /ready отвечает failed
+warmup_attempts = int(os.getenv("WARMUP_ATTEMPTS", "3"))
+warmup_state = {"status": "pending", "error": None}
+
+
+async def warmup_models():
+    """
+    Прогревает модели с повторами. Ошибка не теряется в фоновой задаче: она пишется в лог и отдаётся в /ready.
+    """
+    for attempt in range(1, warmup_attempts + 1):
+        try:
+            await asyncio.to_thread(caps_recognizer.warmup)
+        except Exception as e:
+            warmup_state["error"] = str(e)
+            logger.exception(f"Прогрев моделей не удался (попытка {attempt} из {warmup_attempts})")
+            if attempt < warmup_attempts:
+                await asyncio.sleep(2 ** attempt)
+            continue
+        warmup_state.update(status="done", error=None)
+        return
+    warmup_state["status"] = "failed"
+    logger.error("Прогрев моделей не удался, воркер не будет готов к работе")
+
+
+@asynccontextmanager
+async def lifespan(_app):
+    """
+    Запуск воркера: потоки инференса и прогрев моделей создаются здесь, уже после fork,
+    а модели и индекс загружаются при импорте — в мастере при запуске gunicorn с preload.
+    """
+    search_batcher.start()
+    warmup_task = asyncio.create_task(warmup_models())
+    yield
+    warmup_task.cancel()
+
+
+app = FastAPI(title="Caps FAISS Search API", lifespan=lifespan)
+
+
+@app.middleware("http")
+async def metrics_middleware(request: Request, call_next):
     """
-    Сохраняет загруженный файл на сервере.
+    Считает запросы, их длительность и число одновременных запросов по маршрутам;
+    при включённом профилировании профилирует часть запросов.
     """
+    profiler = request_profiler.begin()
+    started = time.perf_counter()
+    status = 500
+    HTTP_IN_FLIGHT.inc()
     try:
-        with destination.open("wb") as buffer:
-            shutil.copyfileobj(upload_file.file, buffer)
-        return destination
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Ошибка при сохранении файла: {e}")
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        elapsed = time.perf_counter() - started
+        HTTP_IN_FLIGHT.dec()
+        # Шаблон маршрута, а не сам путь: /thumbnails/{image_path:path} — одна серия, а не по серии на файл
+        route = request.scope.get("route")
+        route = route.path if route is not None else "unmatched"
+        HTTP_REQUESTS.labels(request.method, route, str(status)).inc()
+        HTTP_REQUEST_SECONDS.labels(route).observe(elapsed)
+        if profiler is not None:
+            path = await asyncio.to_thread(request_profiler.finish, profiler, f"{request.method} {route}", elapsed)
+            if path is not None:
+                logger.warning(f"Медленный запрос {request.method} {request.url.path} ({elapsed:.2f} с), "
+                               f"профиль: {path}")
 
 
-@app.post("/build_db")
-def build_database_endpoint():
+def build_database(job):
     """
-    Эндпоинт для создания базы данных:
+    Сборка базы данных в фоне:
     1) Организует zip-файлы
-    2) Извлекает признаки
-    3) Создает FAISS индекс
+    2) Извлекает признаки новых и изменённых изображений
+    3) Обновляет FAISS индекс
+    """
+    job.set_stage("organizing")
+    print("\nОрганизация zip файлов...")
+    caps_recognizer.organize_zip_files()
+
+    print("\nЗапуск обновления базы данных признаков...")
+    return indexer.run(full=job.full, job=job)
+
+
+# Состояние сборок и блокировка общие для всех воркеров gunicorn
+build_jobs = BuildJobManager(
+    build_database, os.getenv("BUILD_STATE_DIR", os.path.join(caps_recognizer.index_dir, "build_jobs"))
+)
+
+
+@app.post("/build_db", status_code=202)
+async def build_database_endpoint(full: bool = False):
+    """
+    Эндпоинт для запуска фоновой сборки базы данных (full=true — пересобрать индекс с нуля).
+    Пока сборка идёт, поиск обслуживается предыдущим индексом.
+    """
+    job, created = await asyncio.to_thread(build_jobs.start, full)
+    message = "Сборка базы данных запущена." if created else "Сборка базы данных уже выполняется."
+    return {"status": "ok", "message": message, "job": job}
+
+
+@app.get("/build_db/{job_id}")
+async def build_status_endpoint(job_id: str):
+    """
+    Эндпоинт для получения этапа, прогресса, скорости и оставшегося времени сборки.
+    """
+    job = await asyncio.to_thread(build_jobs.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Сборка не найдена")
+    return {"status": "ok", "job": job}
+
+
+@app.delete("/build_db/{job_id}")
+async def build_cancel_endpoint(job_id: str):
+    """
+    Эндпоинт для отмены сборки. Обработанные изображения сохраняются в контрольной точке.
+    """
+    job = await asyncio.to_thread(build_jobs.cancel, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Сборка не найдена")
+    return {"status": "ok", "job": job}
+
+
+@app.post("/catalogue/archives", status_code=202)
+async def upload_archive_endpoint(archive: UploadFile = File(...), group: str = "", build: bool = True):
+    """
+    Эндпоинт для добавления zip архива с изображениями группы group (по умолчанию группа — имя архива).
+    Изображения в корне архива попадают в группу group, во вложенных папках — в группу по имени папки.
+    Архив сохраняется без распаковки; при build=true запускается инкрементальная сборка индекса,
+    которая читает изображения прямо из архива. Поиск в это время продолжает работать.
     """
     try:
-        # Организация zip-файлов
-        print("\nОрганизация zip файлов...")
-        caps_recognizer.organize_zip_files()
-
-        # Создание базы данных признаков
-        print("\nЗапуск создания базы данных признаков...")
-        features_matrix, metadata = caps_recognizer.build_feature_database()
-
-        if features_matrix is not None:
-            # Создание FAISS индекса
-            index = caps_recognizer.create_faiss_index(features_matrix)
-            if index is not None:
-                return {"status": "ok", "message": "База данных и индекс успешно созданы."}
-            else:
-                return {"status": "error", "message": "Не удалось создать FAISS индекс."}
-        else:
-            return {"status": "error", "message": "Не удалось создать базу данных признаков."}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        path, images = await asyncio.to_thread(
+            store_archive, archive.file, archive.filename, caps_recognizer.data_dir, group
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    content = {"status": "ok", "archive": os.path.relpath(path, "static"), "images": images}
+    if build:
+        content["job"], _ = await asyncio.to_thread(build_jobs.start, False)
+    return content
 
 
 @app.post("/search_image")
-def search_endpoint(image: UploadFile = File(...), top_k: int = 1):
+async def search_endpoint(image: UploadFile = File(...), top_k: int = Query(1, ge=1, le=max_top_k),
+                          aggregate: str = "none"):
     """
-    Эндпоинт для поиска похожих кепок по изображению и количеству top_k.
+    Эндпоинт для поиска похожих кепок по изображению и количеству top_k (от 1 до SEARCH_MAX_TOP_K).
+    aggregate (max, mean, vote, centroid) возвращает top_k различных моделей кепок вместо отдельных фото.
     """
+    if aggregate not in AGGREGATIONS:
+        raise HTTPException(status_code=400, detail=f"Недопустимый aggregate, допустимые: {', '.join(AGGREGATIONS)}")
+
+    # Изображение декодируется прямо из буфера загрузки, без записи на диск
+    image_bytes = await image.read()
+
     try:
-        # Проверка и сохранение загруженного файла
-        upload_dir = Path("static/uploads")
-        upload_dir.mkdir(parents=True, exist_ok=True)
-        uploaded_image_path = save_upload_file(image, upload_dir / image.filename)
+        future = search_batcher.submit((image_bytes, top_k, aggregate))
+        SEARCH_QUEUE_DEPTH.set(search_batcher.pending)
+    except QueueFull as e:
+        SEARCH_REJECTED.inc()
+        logger.warning(f"Перегрузка: в очереди поиска {search_batcher.pending} запросов")
+        return JSONResponse(
+            status_code=503,
+            content={"status": "error", "message": "Сервис перегружен, повторите запрос позже."},
+            headers={"Retry-After": str(e.retry_after)}
+        )
 
-        # Поиск похожих кепок
-        results = caps_recognizer.search_similar_cap(str(uploaded_image_path), top_k=top_k)
+    try:
+        # Поиск похожих кепок в потоках инференса, не блокируя цикл событий
+        results, index_version = await asyncio.wrap_future(future)
 
         if isinstance(results, str):
             # Если вернулась строка — это сообщение об ошибке или предупреждение
             return {"status": "error", "message": results}
         else:
-            return {"status": "ok", "results": results}
+            return {
+                "status": "ok",
+                "results": results,
+                # id сборки индекса одинаков во всех воркерах (поколение — лишь счётчик перезагрузок в процессе)
+                "index_version": index_version
+            }
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@app.get("/images/{image_path:path}")
-def get_image(image_path: str):
+@app.get("/ready")
+async def readiness_endpoint():
     """
-    Эндпоинт для получения изображения по имени.
+    Эндпоинт готовности: 200 только когда модели прогреты и индекс загружен;
+    failed — прогрев не удался после всех попыток, воркер нужно перезапустить.
+    """
+    snapshot = caps_recognizer.index_holder.get()
+    ready = caps_recognizer.warm and snapshot is not None
+    content = {
+        "status": "ok" if ready else "failed" if warmup_state["status"] == "failed" else "starting",
+        "models_warm": caps_recognizer.warm,
+        "warmup_error": warmup_state["error"],
+        "index_loaded": snapshot is not None,
+        "index_generation": snapshot.generation if snapshot else 0,
+        "index_version": snapshot.version if snapshot else None,
+        "startup_seconds": {stage: round(seconds, 3) for stage, seconds in caps_recognizer.startup_timings.items()},
+    }
+    return JSONResponse(status_code=200 if ready else 503, content=content)
+
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    """
+    Эндпоинт метрик в текстовом формате Prometheus (со всех воркеров gunicorn).
+    """
+    content, content_type = await asyncio.to_thread(render_metrics)
+    return Response(content=content, media_type=content_type)
+
+
+def locate_image_path(image_path):
+    """
+    Проверяет путь изображения из метаданных и возвращает (путь к файлу, имя файла в архиве или None,
+    нормализованный путь относительно static/). Существование файла не проверяется.
     """
     # Базовая директория для хранения изображений
     base_dir = Path("static").resolve()
 
+    # Изображение внутри zip архива каталога: "путь/к/архиву.zip!/файл"
+    image_path, member = split_reference(image_path)
+
     # Путь к запрашиваемому файлу
     file_path = (base_dir / image_path).resolve()
 
@@ -105,10 +341,114 @@ def get_image(image_path: str):
         logger.warning(f"Попытка доступа за пределы директории: {file_path}")
         raise HTTPException(status_code=400, detail="Недопустимый путь")
 
+    if member is not None:
+        member = posixpath.normpath(member.replace('\\', '/'))
+    normalized = join_reference(file_path.relative_to(base_dir).as_posix(), member)
+    return file_path, member, normalized
+
+
+def resolve_image_path(image_path):
+    """
+    Проверяет путь изображения из метаданных и возвращает (путь к файлу, имя файла в архиве или None).
+    """
+    file_path, member, _ = locate_image_path(image_path)
+
     # Проверка существования файла
     if not file_path.exists():
         logger.error(f"Запрошенное изображение не найдено: {file_path}")
         raise HTTPException(status_code=404, detail="Изображение не найдено")
+    return file_path, member
+
+
+def thumbnail_file(image_path):
+    """
+    Путь к JPEG копии изображения. Ключ копии — нормализованный путь, поэтому разные записи одного пути
+    ("a/./b.jpg", "a//b.jpg") дают одну копию. Если копии ещё нет (изображение не проходило сборку индекса),
+    она строится из оригинала один раз и только для изображений из метаданных текущего индекса.
+    """
+    _, _, image_path = locate_image_path(image_path)
+    path = thumbnail_store.path(image_path)
+    if not os.path.exists(path):
+        snapshot = caps_recognizer.index_holder.get()
+        if snapshot is None or not snapshot.metadata.has_image_path(image_path):
+            raise HTTPException(status_code=404, detail="Изображение не найдено")
+        file_path, member = resolve_image_path(image_path)
+        try:
+            data = read_archive_member(file_path, member) if member is not None else file_path.read_bytes()
+        except KeyError:
+            raise HTTPException(status_code=404, detail="Изображение не найдено")
+        thumbnail_store.write(image_path, Image.open(BytesIO(data)))
+    return path
+
+
+def thumbnail_batch(image_paths, boundary):
+    """
+    Собирает тело multipart/mixed: по части на каждую найденную копию, путь — в Content-Location.
+    """
+    parts = []
+    for image_path in image_paths:
+        try:
+            path = thumbnail_file(image_path)
+            with open(path, 'rb') as f:
+                data = f.read()
+        except HTTPException:
+            continue
+        except Exception as e:
+            logger.error(f"Не удалось подготовить копию изображения {image_path}: {e}")
+            continue
+        headers = (f"--{boundary}\r\n"
+                   f"Content-Type: image/jpeg\r\n"
+                   f"Content-Location: {quote(image_path)}\r\n"
+                   f"ETag: {ThumbnailStore.etag(path)}\r\n"
+                   f"Content-Length: {len(data)}\r\n\r\n")
+        parts.append(headers.encode('ascii') + data + b"\r\n")
+    parts.append(f"--{boundary}--\r\n".encode('ascii'))
+    return b"".join(parts)
+
+
+@app.get("/thumbnails/{image_path:path}")
+async def get_thumbnail(image_path: str, request: Request):
+    """
+    Эндпоинт для получения JPEG копии изображения (не больше THUMBNAIL_MAX_SIDE по большей стороне).
+    Поддерживает If-None-Match: если копия не изменилась, отвечает 304 без тела.
+    """
+    path = await asyncio.to_thread(thumbnail_file, image_path)
+    etag = ThumbnailStore.etag(path)
+    headers = {"ETag": etag, "Cache-Control": f"public, max-age={thumbnail_max_age}"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return FileResponse(path=path, media_type="image/jpeg", headers=headers)
+
+
+@app.post("/thumbnails/batch")
+async def get_thumbnails_batch(image_paths: list[str] = Body(..., embed=True)):
+    """
+    Эндпоинт для получения JPEG копий нескольких изображений одним ответом multipart/mixed.
+    Ненайденные изображения пропускаются; клиент сопоставляет части по Content-Location.
+    """
+    if len(image_paths) > thumbnail_batch_limit:
+        raise HTTPException(status_code=400, detail=f"Не больше {thumbnail_batch_limit} изображений за запрос")
+
+    boundary = uuid.uuid4().hex
+    content = await asyncio.to_thread(thumbnail_batch, image_paths, boundary)
+    return Response(content=content, media_type=f"multipart/mixed; boundary={boundary}")
+
+
+@app.get("/images/{image_path:path}")
+async def get_image(image_path: str):
+    """
+    Эндпоинт для получения изображения по имени.
+    """
+    file_path, member = resolve_image_path(image_path)
+
+    if member is not None:
+        try:
+            content = await asyncio.to_thread(read_archive_member, file_path, member)
+        except KeyError:
+            logger.error(f"Запрошенное изображение не найдено в архиве {file_path}: {member}")
+            raise HTTPException(status_code=404, detail="Изображение не найдено")
+        mime_type, _ = mimetypes.guess_type(member)
+        return Response(content=content, media_type=mime_type or "application/octet-stream")
 
     # Определение MIME-типа файла
     mime_type, _ = mimetypes.guess_type(file_path)
@@ -0,0 +1,136 @@
+"""
+Сравнение моделей CLIP на каталоге: top-1 точность по группам и стоимость эмбеддинга.
+
+Кепки вырезаются YOLO один раз, затем каждая модель кодирует те же кепки. Точность считается
+методом leave-one-out: для каждой кепки ищется ближайшая кепка с другого изображения,
+и попадание засчитывается, если она из той же группы. Учитываются только группы,
+в которых больше одного изображения.
+
+Запуск из каталога ai_service:
+    python -m app.tools.backbone_eval --models ViT-L/14 ViT-B/16 ViT-B/32 --limit 1000
+"""
+import argparse
+import json
+import os
+import time
+
+import clip
+import numpy as np
+import torch
+from PIL import Image
+from ultralytics import YOLO
+
+from app.ai.backends import BACKENDS, create_clip_encoder
+from app.tools.backend_parity import catalogue_images
+
+
+def detect_crops(paths, yolo_weights):
+    """
+    Вырезает кепки из изображений каталога. Возвращает кепки, их группы и номера исходных изображений.
+    """
+    yolo_model = YOLO(yolo_weights, task='detect')
+    crops, groups, sources = [], [], []
+    for number, path in enumerate(paths):
+        image = Image.open(path).convert("RGB")
+        result = yolo_model.predict(image, imgsz=640, verbose=False)[0]
+        if result.boxes is None:
+            continue
+        for box in result.boxes.xyxy.cpu().numpy():
+            crops.append(image.crop(tuple(map(int, box))))
+            groups.append(os.path.basename(os.path.dirname(path)))
+            sources.append(number)
+    return crops, np.array(groups), np.array(sources)
+
+
+def leave_one_out_accuracy(features, groups, sources):
+    """
+    Доля кепок, ближайший сосед которых (с другого изображения) из той же группы.
+    """
+    images_per_group = {}
+    for group, source in zip(groups, sources):
+        images_per_group.setdefault(group, set()).add(source)
+
+    similarities = features @ features.T
+    similarities[sources[:, None] == sources[None, :]] = -np.inf
+
+    evaluated = hits = 0
+    for row, group in enumerate(groups):
+        if len(images_per_group[group]) < 2:
+            continue
+        evaluated += 1
+        hits += groups[int(np.argmax(similarities[row]))] == group
+    return hits / evaluated if evaluated else None, evaluated
+
+
+def evaluate_backbone(model_name, crops, groups, sources, backend, batch_size):
+    clip_model, preprocess = clip.load(model_name, device='cpu')
+    clip_model.eval()
+    encoder = create_clip_encoder(backend, clip_model, model_name)
+
+    tensors = [preprocess(crop) for crop in crops]
+
+    # Задержка одиночного запроса — так кодируется кепка на горячем пути поиска
+    single_latencies = []
+    for tensor in tensors[:min(len(tensors), 50)]:
+        start = time.perf_counter()
+        encoder.encode(tensor.unsqueeze(0))
+        single_latencies.append(time.perf_counter() - start)
+
+    features = []
+    start = time.perf_counter()
+    for offset in range(0, len(tensors), batch_size):
+        features.append(encoder.encode(torch.stack(tensors[offset:offset + batch_size])))
+    batch_seconds = time.perf_counter() - start
+
+    features = np.vstack(features).astype('float32')
+    features /= np.linalg.norm(features, axis=1, keepdims=True)
+    accuracy, evaluated = leave_one_out_accuracy(features, groups, sources)
+
+    latencies_ms = np.array(single_latencies) * 1000
+    return {
+        'model': model_name,
+        'backend': backend,
+        'dimension': int(features.shape[1]),
+        'top1_group_accuracy': accuracy,
+        'evaluated_crops': evaluated,
+        'single_p50_ms': float(np.percentile(latencies_ms, 50)),
+        'single_p95_ms': float(np.percentile(latencies_ms, 95)),
+        'batch_crops_per_second': len(tensors) / batch_seconds,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Точность и скорость моделей CLIP на каталоге кепок")
+    parser.add_argument('--models', nargs='+', default=['ViT-L/14', 'ViT-B/16', 'ViT-B/32'])
+    parser.add_argument('--backend', choices=BACKENDS, default='torch')
+    parser.add_argument('--data-dir', default='static/zip_files')
+    parser.add_argument('--yolo-weights', default='static/weights/best.pt')
+    parser.add_argument('--limit', type=int, default=0, help="сколько изображений каталога взять (0 — все)")
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--json', dest='json_file', help="сохранить отчёт в JSON")
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    paths = catalogue_images(args.data_dir, args.limit)
+    crops, groups, sources = detect_crops(paths, args.yolo_weights)
+    print(f"Изображений: {len(paths)}, кепок: {len(crops)}, групп: {len(set(groups))}")
+
+    report = []
+    for model_name in args.models:
+        row = evaluate_backbone(model_name, crops, groups, sources, args.backend, args.batch_size)
+        report.append(row)
+        accuracy = f"{row['top1_group_accuracy']:.3f}" if row['top1_group_accuracy'] is not None else "—"
+        print(f"{model_name:<10} dim={row['dimension']:<4} top-1={accuracy} "
+              f"p50={row['single_p50_ms']:.1f} мс p95={row['single_p95_ms']:.1f} мс "
+              f"батч={row['batch_crops_per_second']:.1f} кепок/с")
+
+    if args.json_file:
+        with open(args.json_file, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
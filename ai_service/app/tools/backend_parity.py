@@ -0,0 +1,83 @@
+"""
+Проверка расхождения эмбеддингов CLIP между PyTorch (fp32) и выбранным бэкендом инференса.
+
+Запуск из каталога ai_service:
+    python -m app.tools.backend_parity --backend onnx_int8 --limit 500
+"""
+import argparse
+import os
+import random
+import time
+
+import clip
+import numpy as np
+import torch
+from PIL import Image
+
+from app.ai.backends import BACKENDS, TorchClipEncoder, create_clip_encoder
+from app.ai.catalogue import SUPPORTED_EXTENSIONS
+
+
+def catalogue_images(data_dir, limit, seed=0):
+    paths = sorted(
+        os.path.join(root, file)
+        for root, _, files in os.walk(data_dir)
+        for file in files
+        if os.path.splitext(file)[1].lower() in SUPPORTED_EXTENSIONS
+    )
+    if limit and len(paths) > limit:
+        paths = random.Random(seed).sample(paths, limit)
+    return paths
+
+
+def normalize(features):
+    return features / np.linalg.norm(features, axis=1, keepdims=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Косинусное расхождение эмбеддингов бэкенда с PyTorch fp32")
+    parser.add_argument('--backend', choices=BACKENDS, default='onnx')
+    parser.add_argument('--clip-model', default='ViT-L/14')
+    parser.add_argument('--data-dir', default='static/zip_files')
+    parser.add_argument('--weights-dir', default='static/weights')
+    parser.add_argument('--limit', type=int, default=0, help="сколько изображений каталога проверить (0 — все)")
+    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--threads', type=int, default=None)
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    clip_model, preprocess = clip.load(args.clip_model, device='cpu')
+    clip_model.eval()
+    reference = TorchClipEncoder(clip_model)
+    candidate = create_clip_encoder(args.backend, clip_model, args.clip_model, weights_dir=args.weights_dir,
+                                    intra_op_threads=args.threads)
+
+    paths = catalogue_images(args.data_dir, args.limit)
+    print(f"Сравниваем torch и {args.backend} на {len(paths)} изображениях.")
+
+    similarities = []
+    timings = {'torch': 0.0, args.backend: 0.0}
+    for start in range(0, len(paths), args.batch_size):
+        batch_paths = paths[start:start + args.batch_size]
+        batch = torch.stack([preprocess(Image.open(path).convert("RGB")) for path in batch_paths])
+
+        begin = time.perf_counter()
+        expected = reference.encode(batch)
+        timings['torch'] += time.perf_counter() - begin
+
+        begin = time.perf_counter()
+        actual = candidate.encode(batch)
+        timings[args.backend] += time.perf_counter() - begin
+
+        similarities.extend(np.sum(normalize(expected) * normalize(actual), axis=1))
+
+    similarities = np.array(similarities)
+    print(f"Косинусная близость: средняя {similarities.mean():.5f}, минимальная {similarities.min():.5f}, "
+          f"1-й перцентиль {np.percentile(similarities, 1):.5f}")
+    for name, seconds in timings.items():
+        print(f"{name}: {len(paths) / seconds:.2f} изображений/с")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,26 @@
+"""
+Однократная конвертация старого static/metadata.pkl в колоночный metadata.bin каталога индекса.
+
+Запуск из каталога ai_service (pickle загружается только здесь, из доверенного файла):
+    python -m app.tools.convert_metadata static/metadata.pkl static/indexes/ViT-L-14/metadata.bin
+"""
+import argparse
+import pickle
+
+from app.ai.metadata_store import MetadataStore
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Конвертация metadata.pkl в metadata.bin")
+    parser.add_argument('source', nargs='?', default='static/metadata.pkl')
+    parser.add_argument('destination', nargs='?', default='static/indexes/ViT-L-14/metadata.bin')
+    args = parser.parse_args()
+
+    with open(args.source, 'rb') as f:
+        records = pickle.load(f)
+    MetadataStore.write(args.destination, records)
+    print(f"Записано {len(records)} строк метаданных в {args.destination}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+"""
+Сравнение типов FAISS индекса с точным перебором: recall@k, задержка поиска и размер индекса.
+
+Запуск из каталога ai_service:
+    python -m app.tools.index_report --index static/indexes/ViT-L-14/faiss_index_vectors.bin --top-k 5
+"""
+import argparse
+import json
+import time
+
+import faiss
+import numpy as np
+
+from app.ai.index_factory import IndexConfig, build_index, configure_search, flat_vectors
+
+NPROBE_VALUES = (1, 4, 16, 64)
+EF_SEARCH_VALUES = (16, 64, 256)
+
+
+def load_vectors(index_file):
+    """
+    Достаёт векторы из сохранённого точного индекса (с id или без).
+    """
+    index = faiss.read_index(index_file)
+    if hasattr(index, 'id_map'):
+        vectors, _ = flat_vectors(index)
+    else:
+        vectors = index.reconstruct_n(0, index.ntotal)
+    return np.ascontiguousarray(vectors, dtype='float32')
+
+
+def measure(index, queries, ground_truth, top_k):
+    """
+    Считает recall@k относительно точного поиска и задержку одиночного запроса.
+    """
+    latencies = []
+    found = []
+    for query in queries:
+        start = time.perf_counter()
+        _, ids = index.search(query.reshape(1, -1), top_k)
+        latencies.append(time.perf_counter() - start)
+        found.append(ids[0])
+
+    hits = sum(len(set(row) & set(expected)) for row, expected in zip(found, ground_truth))
+    latencies_ms = np.array(latencies) * 1000
+    return {
+        'recall': hits / (len(queries) * top_k),
+        'p50_ms': float(np.percentile(latencies_ms, 50)),
+        'p99_ms': float(np.percentile(latencies_ms, 99)),
+        'size_bytes': int(faiss.serialize_index(index).size),
+    }
+
+
+def run_report(vectors, top_k=5, query_fraction=0.1, seed=0, base_config=None):
+    """
+    Делит векторы на базу и запросы, строит каждый тип индекса и сравнивает его с точным перебором.
+    """
+    base_config = base_config or IndexConfig()
+    rng = np.random.default_rng(seed)
+    order = rng.permutation(len(vectors))
+    query_count = max(1, int(len(vectors) * query_fraction))
+    queries = vectors[order[:query_count]]
+    database = vectors[order[query_count:]]
+    ids = np.arange(len(database), dtype='int64')
+
+    flat_config = IndexConfig(index_type='flat')
+    flat = build_index(database, ids, flat_config)
+    _, ground_truth = flat.search(queries, top_k)
+
+    rows = [{'index_type': 'flat', 'params': {}, **measure(flat, queries, ground_truth, top_k)}]
+    sweeps = {
+        'ivf_flat': [{'nprobe': value} for value in NPROBE_VALUES],
+        'ivf_pq': [{'nprobe': value} for value in NPROBE_VALUES],
+        'hnsw': [{'ef_search': value} for value in EF_SEARCH_VALUES],
+    }
+    for index_type, params_list in sweeps.items():
+        config = IndexConfig(**{**base_config.__dict__, 'index_type': index_type})
+        try:
+            index = build_index(database, ids, config)
+        except Exception as e:
+            print(f"Не удалось построить индекс {index_type}: {e}")
+            continue
+        for params in params_list:
+            configure_search(index, IndexConfig(**{**config.__dict__, **params}))
+            rows.append({'index_type': index_type, 'params': params,
+                         **measure(index, queries, ground_truth, top_k)})
+
+    flat_size = rows[0]['size_bytes']
+    for row in rows:
+        row['size_ratio'] = row['size_bytes'] / flat_size
+    return {'vectors': len(database), 'queries': query_count, 'top_k': top_k, 'results': rows}
+
+
+def print_report(report):
+    print(f"База: {report['vectors']} векторов, запросов: {report['queries']}, top_k={report['top_k']}")
+    print(f"{'индекс':<10} {'параметры':<18} {'recall':>8} {'p50, мс':>9} {'p99, мс':>9} "
+          f"{'размер, КБ':>11} {'доля':>6}")
+    for row in report['results']:
+        params = ', '.join(f"{key}={value}" for key, value in row['params'].items())
+        print(f"{row['index_type']:<10} {params:<18} {row['recall']:>8.3f} {row['p50_ms']:>9.3f} "
+              f"{row['p99_ms']:>9.3f} {row['size_bytes'] / 1024:>11.1f} {row['size_ratio']:>6.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recall и задержка ANN индексов относительно точного перебора")
+    parser.add_argument('--index', default='static/indexes/ViT-L-14/faiss_index_vectors.bin',
+                        help="точный индекс с векторами каталога")
+    parser.add_argument('--top-k', type=int, default=5)
+    parser.add_argument('--query-fraction', type=float, default=0.1)
+    parser.add_argument('--json', dest='json_file', help="сохранить отчёт в JSON")
+    args = parser.parse_args()
+
+    report = run_report(load_vectors(args.index), top_k=args.top_k, query_fraction=args.query_fraction,
+                        base_config=IndexConfig.from_env())
+    print_report(report)
+    if args.json_file:
+        with open(args.json_file, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,350 @@
+"""
+Задержка поиска CapsRecognizer по этапам и скорость индексации на выборке изображений каталога.
+
+Каждое изображение ищется настоящим CapsRecognizer.search_similar_caps_batch, а длительности этапов
+(decode, hash, cache, detect, embed, search, aggregate — те же, что в метрике caps_search_stage_seconds)
+приходят через recognizer.stage_observer; end_to_end — время всего вызова. Кэши результатов
+и эмбеддингов отключены, поиск идёт по закреплённому снимку с индексом нужного типа.
+Скорость индексации — изображений/с через этапы decode → detect → embed IncrementalIndexer
+(без записи индекса). Конфигурации — все сочетания --threads, --batch-sizes и --index-types;
+каждая замеряется в отдельном процессе, поэтому пиковая память (ru_maxrss) относится к ней одной.
+Отчёт в JSON можно сравнить с отчётом прошлого релиза через --baseline.
+
+Работает без сети на CPU: веса CLIP должны быть уже скачаны (в образе это делает Dockerfile).
+
+Запуск из каталога ai_service:
+    python -m app.tools.stage_benchmark --limit 200 --threads 1 4 --batch-sizes 8 32 \\
+        --index-types flat hnsw --json benchmark.json --baseline benchmark_prev.json
+"""
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+os.environ.setdefault('YOLO_OFFLINE', 'True')
+
+import faiss  # noqa: E402
+import numpy as np  # noqa: E402
+import torch  # noqa: E402
+
+from app.ai.backends import BACKENDS  # noqa: E402
+from app.ai.caps_recognizer import CapsRecognizer  # noqa: E402
+from app.ai.catalogue import ArchiveReader, scan_catalogue  # noqa: E402
+from app.ai.index_factory import INDEX_TYPES, IndexConfig, build_index, flat_vectors  # noqa: E402
+from app.ai.index_holder import IndexSnapshot  # noqa: E402
+from app.ai.indexer import IncrementalIndexer  # noqa: E402
+from app.ai.pipeline import pipeline_stage  # noqa: E402
+
+STAGES = ('decode', 'hash', 'cache', 'detect', 'embed', 'search', 'aggregate')
+PERCENTILES = (50, 95, 99)
+
+
+def sample_catalogue(data_dir, limit, seed=0):
+    """
+    Случайная (воспроизводимая по seed) выборка изображений каталога, включая файлы в zip архивах.
+    """
+    images = scan_catalogue(data_dir)
+    if limit and len(images) > limit:
+        images = random.Random(seed).sample(images, limit)
+    return images
+
+
+def summarize(seconds):
+    """
+    Перцентили и среднее списка длительностей в миллисекундах.
+    """
+    if not seconds:
+        return None
+    milliseconds = np.array(seconds) * 1000
+    summary = {f'p{percentile}_ms': float(np.percentile(milliseconds, percentile)) for percentile in PERCENTILES}
+    summary['mean_ms'] = float(milliseconds.mean())
+    summary['count'] = len(seconds)
+    return summary
+
+
+@contextlib.contextmanager
+def quiet():
+    """
+    Глушит отладочный вывод CapsRecognizer, чтобы он не смешивался с отчётом.
+    """
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+
+def peak_rss_mb():
+    # ru_maxrss в Linux — в килобайтах, в macOS — в байтах
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def run_isolated(function, *args):
+    """
+    Выполняет замер в отдельном процессе (spawn): пиковая память ru_maxrss процесса относится только
+    к этой конфигурации, а не ко всем, замеренным раньше в том же процессе.
+    """
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+        return executor.submit(function, *args).result()
+
+
+def load_recognizer(args, threads):
+    faiss.omp_set_num_threads(threads)
+    # Кэши отключены: замеряется полный путь запроса
+    with quiet():
+        recognizer = CapsRecognizer(
+            yolo_weights=args.yolo_weights, clip_model_name=args.clip_model, backend=args.backend,
+            intra_op_threads=threads, result_cache_size=0, embedding_cache_size=0
+        )
+        recognizer.warmup()
+    return recognizer
+
+
+def run_search(recognizer, payloads, snapshot, top_k, warmup):
+    """
+    Ищет каждое изображение по одному через search_similar_caps_batch по снимку snapshot
+    и собирает длительности этапов из stage_observer.
+    """
+    for data in payloads[:warmup]:
+        recognizer.search_similar_caps_batch([(data, top_k, 'none')], snapshot)
+
+    timings = {stage: [] for stage in (*STAGES, 'end_to_end')}
+    request_stages = {}
+    recognizer.stage_observer = request_stages.__setitem__
+    results = 0
+    started = time.perf_counter()
+    try:
+        for data in payloads:
+            request_stages.clear()
+            request_started = time.perf_counter()
+            response = recognizer.search_similar_caps_batch([(data, top_k, 'none')], snapshot)[0]
+            timings['end_to_end'].append(time.perf_counter() - request_started)
+            for stage, seconds in request_stages.items():
+                timings[stage].append(seconds)
+            if not isinstance(response, str):
+                results += len(response)
+    finally:
+        recognizer.stage_observer = None
+    seconds = time.perf_counter() - started
+
+    end_to_end = timings.pop('end_to_end')
+    return {
+        'stages': {stage: summarize(values) for stage, values in timings.items()},
+        'end_to_end': summarize(end_to_end),
+        'images_per_second': len(payloads) / seconds,
+        'results_per_image': results / len(payloads),
+    }
+
+
+def run_indexing(recognizer, images, batch_size, workers):
+    """
+    Прогоняет изображения через этапы конвейера индексации, ничего не записывая.
+    Возвращает (строку отчёта, матрицу эмбеддингов кепок или None).
+    """
+    indexer = IncrementalIndexer(recognizer, workers=workers, chunk_size=batch_size)
+    features, crops, failed = [], 0, 0
+    started = time.perf_counter()
+    with ArchiveReader() as reader:
+        decoded = pipeline_stage(images, lambda image: indexer._decode(image, None, reader),
+                                 workers=workers, maxsize=batch_size * 2, name="bench-decode")
+        detected = pipeline_stage(decoded, indexer._detect, batch_size=batch_size, name="bench-detect")
+        embedded = pipeline_stage(detected, indexer._embed, name="bench-embed")
+        try:
+            for records, chunk_features in embedded:
+                failed += sum(1 for *_, error in records if error is not None)
+                if chunk_features is not None:
+                    crops += len(chunk_features)
+                    features.append(chunk_features)
+        finally:
+            embedded.close()
+    seconds = time.perf_counter() - started
+
+    row = {
+        'batch_size': batch_size,
+        'workers': workers,
+        'seconds': seconds,
+        'images_per_second': len(images) / seconds,
+        'crops_per_second': crops / seconds,
+        'failed': failed,
+    }
+    return row, np.vstack(features) if features else None
+
+
+def catalogue_index(recognizer):
+    """
+    Точные векторы, их id и метаданные опубликованного индекса каталога или None, если индекс ещё не собран.
+    """
+    vectors_file = IncrementalIndexer(recognizer).vectors_file
+    snapshot = recognizer.index_holder.get()
+    if snapshot is None or not os.path.exists(vectors_file):
+        return None
+    vectors, ids = flat_vectors(faiss.read_index(vectors_file))
+    return np.ascontiguousarray(vectors, dtype='float32'), ids, snapshot.metadata
+
+
+def indexing_job(args, threads, images, batch_size):
+    """
+    Замер индексации одной конфигурации (выполняется в отдельном процессе).
+    """
+    recognizer = load_recognizer(args, threads)
+    with quiet():
+        row, features = run_indexing(recognizer, images, batch_size, args.workers)
+    return {'threads': threads, **row, 'peak_rss_mb': peak_rss_mb()}, features
+
+
+def search_job(args, threads, index_type, payloads, sample_vectors):
+    """
+    Замер поиска одной конфигурации (выполняется в отдельном процессе). Поиск идёт по векторам
+    собранного каталога, а если его нет — по кепкам выборки. Возвращает строку отчёта или None.
+    """
+    recognizer = load_recognizer(args, threads)
+    catalogue = catalogue_index(recognizer)
+    if catalogue is not None:
+        vectors, ids, metadata = catalogue
+    elif sample_vectors is not None:
+        vectors, ids = sample_vectors, np.arange(len(sample_vectors), dtype='int64')
+        metadata = [{'cap_name': 'sample', 'image_path': ''}] * len(sample_vectors)
+    else:
+        return None
+
+    config = IndexConfig(**{**IndexConfig.from_env().__dict__, 'index_type': index_type})
+    index = build_index(vectors, ids, config)
+    snapshot = IndexSnapshot(index, metadata, generation=0, build_id=f"benchmark-{index_type}")
+    with quiet():
+        row = run_search(recognizer, payloads, snapshot, args.top_k, args.warmup)
+    return {'threads': threads, 'index_type': index_type, 'vectors': len(vectors), **row,
+            'peak_rss_mb': peak_rss_mb()}
+
+
+def compare(report, baseline, tolerance):
+    """
+    Сравнивает отчёт с отчётом прошлого релиза: p95 end_to_end и изображения/с индексации
+    для совпадающих конфигураций. Возвращает список регрессий хуже tolerance (доля).
+    """
+    regressions = []
+    previous_search = {(row['threads'], row['index_type']): row for row in baseline.get('search', [])}
+    for row in report['search']:
+        previous = previous_search.get((row['threads'], row['index_type']))
+        if previous is None or not row['end_to_end'] or not previous['end_to_end']:
+            continue
+        before, after = previous['end_to_end']['p95_ms'], row['end_to_end']['p95_ms']
+        if after > before * (1 + tolerance):
+            regressions.append(f"поиск threads={row['threads']} {row['index_type']}: "
+                               f"p95 {before:.1f} → {after:.1f} мс")
+
+    previous_indexing = {(row['threads'], row['batch_size']): row for row in baseline.get('indexing', [])}
+    for row in report['indexing']:
+        previous = previous_indexing.get((row['threads'], row['batch_size']))
+        if previous is None:
+            continue
+        before, after = previous['images_per_second'], row['images_per_second']
+        if after < before * (1 - tolerance):
+            regressions.append(f"индексация threads={row['threads']} batch={row['batch_size']}: "
+                               f"{before:.1f} → {after:.1f} изображений/с")
+    return regressions
+
+
+def print_report(report):
+    print(f"Изображений: {report['images']}, пиковая память конфигураций: до {report['peak_rss_mb']:.0f} МБ")
+    for row in report['search']:
+        end_to_end = row['end_to_end']
+        if end_to_end is None:
+            continue
+        print(f"\nПоиск threads={row['threads']} index={row['index_type']}: "
+              f"p50={end_to_end['p50_ms']:.1f} p95={end_to_end['p95_ms']:.1f} p99={end_to_end['p99_ms']:.1f} мс, "
+              f"{row['images_per_second']:.2f} изображений/с, результатов на изображение "
+              f"{row['results_per_image']:.2f}, память {row['peak_rss_mb']:.0f} МБ")
+        for stage, summary in row['stages'].items():
+            if summary is not None:
+                print(f"  {stage:<11} p50={summary['p50_ms']:>9.2f} p95={summary['p95_ms']:>9.2f} "
+                      f"p99={summary['p99_ms']:>9.2f} мс")
+    print()
+    for row in report['indexing']:
+        print(f"Индексация threads={row['threads']} batch={row['batch_size']}: "
+              f"{row['images_per_second']:.2f} изображений/с, {row['crops_per_second']:.2f} кепок/с, "
+              f"память {row['peak_rss_mb']:.0f} МБ")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Задержка поиска по этапам и скорость индексации CapsRecognizer")
+    parser.add_argument('--data-dir', default='static/zip_files')
+    parser.add_argument('--yolo-weights', default='static/weights/best.pt')
+    parser.add_argument('--clip-model', default=os.getenv("CLIP_MODEL_NAME", "ViT-L/14"))
+    parser.add_argument('--backend', choices=BACKENDS, default=os.getenv("INFERENCE_BACKEND", "torch"))
+    parser.add_argument('--limit', type=int, default=200, help="сколько изображений каталога взять (0 — все)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--warmup', type=int, default=3, help="сколько первых поисков не учитывать")
+    parser.add_argument('--top-k', type=int, default=5)
+    parser.add_argument('--threads', type=int, nargs='+', default=[os.cpu_count()])
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[16])
+    parser.add_argument('--index-types', nargs='+', choices=INDEX_TYPES, default=['flat'])
+    parser.add_argument('--workers', type=int, default=4, help="потоков декодирования при индексации")
+    parser.add_argument('--json', dest='json_file', help="сохранить отчёт в JSON")
+    parser.add_argument('--baseline', help="отчёт прошлого релиза для сравнения")
+    parser.add_argument('--tolerance', type=float, default=0.1, help="допустимое ухудшение (доля)")
+    args = parser.parse_args()
+
+    images = sample_catalogue(args.data_dir, args.limit, args.seed)
+    if not images:
+        parser.error(f"В {args.data_dir} нет изображений")
+    # Файлы читаются заранее: этап decode — только декодирование, без чтения с диска
+    with ArchiveReader() as reader:
+        payloads = [reader.read(image) for image in images]
+
+    report = {
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'torch': torch.__version__,
+            'faiss': getattr(faiss, '__version__', None),
+        },
+        'settings': {key: value for key, value in vars(args).items() if key not in ('json_file', 'baseline')},
+        'images': len(images),
+        'search': [],
+        'indexing': [],
+    }
+
+    for threads in args.threads:
+        sample_vectors = None
+        for batch_size in args.batch_sizes:
+            row, features = run_isolated(indexing_job, args, threads, images, batch_size)
+            report['indexing'].append(row)
+            if sample_vectors is None:
+                sample_vectors = features
+
+        for index_type in args.index_types:
+            try:
+                row = run_isolated(search_job, args, threads, index_type, payloads, sample_vectors)
+            except Exception as e:
+                print(f"Не удалось замерить поиск по индексу {index_type}: {e}")
+                continue
+            if row is None:
+                print("Нет векторов для индекса: каталог не собран, а на выборке не найдено ни одной кепки.")
+                break
+            report['search'].append(row)
+
+    rows = report['indexing'] + report['search']
+    report['peak_rss_mb'] = max((row['peak_rss_mb'] for row in rows), default=0.0)
+    print_report(report)
+    if args.json_file:
+        with open(args.json_file, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        if regressions:
+            print("\nРегрессии относительно " + args.baseline + ":\n  " + "\n  ".join(regressions))
+            sys.exit(1)
+        print(f"\nРегрессий относительно {args.baseline} нет.")
+
+
+if __name__ == '__main__':
+    main()
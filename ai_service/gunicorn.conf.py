@@ -0,0 +1,40 @@
+"""
+Запуск нескольких воркеров uvicorn под gunicorn.
+
+С preload_app модели YOLO/CLIP и индекс загружаются один раз в мастер-процессе, а воркеры
+получают их через fork: страницы с весами остаются общими (copy-on-write), пока их никто
+не изменяет. Потоки инференса и прогрев запускаются в каждом воркере после fork (см. lifespan).
+"""
+import gc
+import os
+import shutil
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+worker_class = "uvicorn.workers.UvicornWorker"
+timeout = 120
+
+# ONNX Runtime создаёт пулы потоков вместе с сессией, а потоки не переживают fork,
+# поэтому с ONNX бэкендами каждый воркер загружает модели сам
+preload_app = os.getenv("PRELOAD_MODELS", "1") == "1" and not os.getenv("INFERENCE_BACKEND", "torch").startswith("onnx")
+
+# Метрики воркеров пишутся в файлы общего каталога, и /metrics любого воркера отдаёт сумму по всем.
+# Переменная задаётся до импорта приложения (и prometheus_client), каталог очищается при каждом запуске
+metrics_dir = os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", "/tmp/prometheus_multiproc")
+shutil.rmtree(metrics_dir, ignore_errors=True)
+os.makedirs(metrics_dir, exist_ok=True)
+
+
+def when_ready(server):
+    # Объекты, созданные при загрузке моделей, переносятся в постоянное поколение GC,
+    # чтобы сборщик мусора в воркерах не трогал их заголовки и не копировал общие страницы
+    if preload_app:
+        gc.freeze()
+        server.log.info("Модели загружены в мастер-процессе, запуск воркеров")
+
+
+def child_exit(server, worker):
+    # Счётчики завершившегося воркера остаются в сумме, а его живые показатели (gauge) больше не учитываются
+    from prometheus_client import multiprocess
+
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Тесты импортируют сервис как пакет app, как его запускает gunicorn из корня ai_service
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,86 @@
+import threading
+import time
+
+import pytest
+
+from app.ai.batcher import MicroBatcher, QueueFull
+
+
+def wait_until(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("Условие не выполнилось за отведённое время")
+        time.sleep(0.001)
+
+
+def test_requests_are_split_into_batches_of_max_batch_size():
+    batches = []
+
+    def handler(items):
+        batches.append(list(items))
+        return [item * 10 for item in items]
+
+    batcher = MicroBatcher(handler, window_ms=200, max_batch_size=2)
+    futures = [batcher.submit(item) for item in range(5)]
+
+    assert [future.result(timeout=2) for future in futures] == [0, 10, 20, 30, 40]
+    assert all(len(batch) <= 2 for batch in batches)
+    assert [item for batch in batches for item in batch] == list(range(5))
+
+
+def test_handler_exception_is_delivered_to_every_request_of_the_batch():
+    batches = []
+
+    def handler(items):
+        batches.append(list(items))
+        raise ValueError("модель упала")
+
+    batcher = MicroBatcher(handler, window_ms=200, max_batch_size=3)
+    futures = [batcher.submit(item) for item in range(3)]
+
+    for future in futures:
+        with pytest.raises(ValueError, match="модель упала"):
+            future.result(timeout=2)
+    assert batches == [[0, 1, 2]]
+
+
+def test_worker_survives_a_failed_batch():
+    def handler(items):
+        if "плохой" in items:
+            raise ValueError("плохой запрос")
+        return items
+
+    batcher = MicroBatcher(handler, window_ms=1, max_batch_size=1)
+    with pytest.raises(ValueError):
+        batcher("плохой")
+    assert batcher("хороший") == "хороший"
+
+
+def test_submit_raises_queue_full_when_max_pending_requests_wait():
+    release = threading.Event()
+    batcher = MicroBatcher(lambda items: release.wait(2) and items, window_ms=1, max_batch_size=1, max_pending=2)
+
+    first = batcher.submit(0)
+    # Первый запрос уже у обработчика, в очереди ждут ещё два
+    wait_until(lambda: batcher.pending == 0)
+    queued = [batcher.submit(1), batcher.submit(2)]
+
+    with pytest.raises(QueueFull) as error:
+        batcher.submit(3)
+    assert error.value.retry_after >= 1
+
+    release.set()
+    assert [future.result(timeout=2) for future in [first, *queued]] == [0, 1, 2]
+    # Очередь освободилась — запросы снова принимаются
+    assert batcher(4) == 4
+
+
+def test_retry_after_grows_with_the_queue():
+    batcher = MicroBatcher(lambda items: items, max_batch_size=2)
+    batcher.batch_seconds = 0.5
+    for item in range(8):
+        batcher._queue.put((item, None))
+
+    # 8 запросов — 4 батча по 0.5 с
+    assert batcher.retry_after() == 2
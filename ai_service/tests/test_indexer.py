@@ -0,0 +1,170 @@
+import json
+import os
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from app.ai.build_jobs import BuildCancelled, BuildJob
+from app.ai.index_factory import IndexConfig
+from app.ai.index_holder import write_generation
+from app.ai.indexer import IncrementalIndexer
+from app.ai.metadata_store import MetadataStore
+
+RED, GREEN, BLUE, WHITE = (255, 0, 0), (0, 255, 0), (0, 0, 255), (255, 255, 255)
+
+
+class FakeRecognizer:
+    """
+    Распознаватель без моделей: каждое изображение — одна кепка, вектор кепки — её цвет.
+    """
+
+    def __init__(self, root):
+        self.data_dir = os.path.join(root, 'static', 'data')
+        self.index_dir = os.path.join(root, 'index')
+        os.makedirs(self.data_dir)
+        os.makedirs(self.index_dir)
+        self.generation_file = self.index_path('index_generation.json')
+        self.manifest_file = self.index_path('index_manifest.json')
+        self.index_config = IndexConfig()
+
+        self.fail_detect = set()
+        self.fail_embed = 0
+        self.embedded = []
+        self.published = []
+
+    def index_path(self, name):
+        return os.path.join(self.index_dir, name)
+
+    def add_image(self, group, name, color):
+        folder = os.path.join(self.data_dir, group)
+        os.makedirs(folder, exist_ok=True)
+        Image.new('RGB', (8, 8), color).save(os.path.join(folder, name))
+
+    def resize_image_if_needed(self, image):
+        return image
+
+    def detect_caps_batch(self, images):
+        if any(image.getpixel((0, 0)) in self.fail_detect for image in images):
+            raise RuntimeError("YOLO упал")
+        return [[image] for image in images]
+
+    def extract_features_clip_batch(self, crops):
+        if self.fail_embed:
+            self.fail_embed -= 1
+            raise RuntimeError("CLIP упал")
+        colors = [crop.getpixel((0, 0)) for crop in crops]
+        self.embedded.extend(colors)
+        return np.array([[*color, 1.0] for color in colors], dtype='float32')
+
+    def publish_index(self, search_index, metadata, vectors=None, ids=None):
+        name = f'metadata.{len(self.published)}.bin'
+        MetadataStore.write(self.index_path(name), metadata)
+        write_generation(self.generation_file, {'build_id': str(len(self.published)), 'metadata': name})
+        self.published.append((search_index.ntotal, [record for record in metadata if record is not None]))
+
+
+class CancelAfterFirstChunk(BuildJob):
+    def advance(self, count):
+        super().advance(count)
+        self.cancel()
+
+
+@pytest.fixture
+def recognizer(tmp_path):
+    recognizer = FakeRecognizer(str(tmp_path))
+    recognizer.add_image('a', '1.png', RED)
+    recognizer.add_image('a', '2.png', GREEN)
+    recognizer.add_image('b', '1.png', BLUE)
+    return recognizer
+
+
+def checkpoint_exists(indexer):
+    return any(os.path.exists(path) for path in indexer.state_files(checkpoint=True))
+
+
+def read_manifest(recognizer):
+    with open(recognizer.manifest_file, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def test_first_run_indexes_and_publishes_the_catalogue(recognizer):
+    indexer = IncrementalIndexer(recognizer, workers=2, chunk_size=2)
+    stats = indexer.run()
+
+    assert stats['added'] == 3 and stats['failed'] == 0 and stats['vectors'] == 3
+    vectors, records = recognizer.published[-1]
+    assert vectors == 3
+    assert sorted((record['cap_name'], record['image_path']) for record in records) == [
+        ('a', 'data/a/1.png'), ('a', 'data/a/2.png'), ('b', 'data/b/1.png')
+    ]
+    assert set(read_manifest(recognizer)['images']) == {
+        os.path.join(recognizer.data_dir, 'a', '1.png'),
+        os.path.join(recognizer.data_dir, 'a', '2.png'),
+        os.path.join(recognizer.data_dir, 'b', '1.png'),
+    }
+    assert not checkpoint_exists(indexer)
+
+
+def test_next_run_processes_only_changes(recognizer):
+    IncrementalIndexer(recognizer).run()
+    recognizer.embedded.clear()
+    os.remove(os.path.join(recognizer.data_dir, 'a', '2.png'))
+    recognizer.add_image('c', '1.png', WHITE)
+
+    stats = IncrementalIndexer(recognizer).run()
+
+    assert (stats['added'], stats['removed'], stats['unchanged']) == (1, 1, 2)
+    assert recognizer.embedded == [WHITE]
+    vectors, records = recognizer.published[-1]
+    assert vectors == 3
+    assert sorted(record['image_path'] for record in records) == ['data/a/1.png', 'data/b/1.png', 'data/c/1.png']
+
+
+def test_cancelled_build_resumes_from_checkpoint(recognizer, tmp_path):
+    job = CancelAfterFirstChunk(str(tmp_path))
+    indexer = IncrementalIndexer(recognizer, workers=1, chunk_size=1)
+    with pytest.raises(BuildCancelled):
+        indexer.run(job=job)
+
+    assert checkpoint_exists(indexer)
+    assert not recognizer.published
+    with open(indexer.state_files(checkpoint=True)[2], encoding='utf-8') as f:
+        assert len(json.load(f)['images']) == 1
+
+    recognizer.embedded.clear()
+    stats = IncrementalIndexer(recognizer, workers=1, chunk_size=1).run()
+
+    # Изображение из контрольной точки не кодируется заново
+    assert (stats['unchanged'], stats['added']) == (1, 2)
+    assert sorted(recognizer.embedded) == sorted([GREEN, BLUE])
+    vectors, records = recognizer.published[-1]
+    assert vectors == 3 and len(records) == 3
+    assert not checkpoint_exists(indexer)
+
+
+def test_detection_failure_skips_only_its_chunk(recognizer):
+    recognizer.fail_detect = {GREEN}
+    stats = IncrementalIndexer(recognizer, workers=1, chunk_size=1).run()
+
+    assert (stats['added'], stats['failed']) == (2, 1)
+    failed = os.path.join(recognizer.data_dir, 'a', '2.png')
+    assert failed not in read_manifest(recognizer)['images']
+
+    # Упавшее изображение не попало в манифест и обрабатывается следующей сборкой
+    recognizer.fail_detect = set()
+    stats = IncrementalIndexer(recognizer, workers=1, chunk_size=1).run()
+    assert (stats['added'], stats['unchanged'], stats['failed']) == (1, 2, 0)
+    assert recognizer.published[-1][0] == 3
+
+
+def test_embedding_failure_skips_only_its_chunk(recognizer):
+    recognizer.fail_embed = 1
+    stats = IncrementalIndexer(recognizer, workers=1, chunk_size=1).run()
+
+    assert (stats['added'], stats['failed']) == (2, 1)
+    assert recognizer.published[-1][0] == 2
+
+    stats = IncrementalIndexer(recognizer, workers=1, chunk_size=1).run()
+    assert (stats['added'], stats['unchanged']) == (1, 2)
+    assert recognizer.published[-1][0] == 3
@@ -0,0 +1,88 @@
+import pytest
+
+from app.ai.metadata_store import MetadataStore
+
+
+def write_and_open(tmp_path, records):
+    path = tmp_path / "metadata.bin"
+    MetadataStore.write(str(path), records)
+    return MetadataStore.open(str(path))
+
+
+def test_round_trip_keeps_records_and_deleted_rows(tmp_path):
+    records = [
+        {'cap_name': 'Yankees', 'image_path': 'data/Yankees/1.jpg'},
+        None,
+        {'cap_name': 'Lakers', 'image_path': 'data/Lakers/1.jpg'},
+        {'cap_name': 'Yankees', 'image_path': 'data/Yankees/2.jpg'},
+        None,
+    ]
+    store = write_and_open(tmp_path, records)
+
+    assert len(store) == len(records)
+    assert store.to_list() == records
+    assert store[1] is None
+    assert store.cap_name(1) is None
+    assert store.cap_names == ['Yankees', 'Lakers']
+    assert store.group_id(2) == 1
+
+
+def test_round_trip_of_non_ascii_paths_and_names(tmp_path):
+    records = [
+        {'cap_name': 'Кепки «Спартак»', 'image_path': 'data/Кепки «Спартак»/фото 1.webp'},
+        {'cap_name': '帽子', 'image_path': 'data/帽子/帽子.zip!/帽子/1.png'},
+        {'cap_name': 'Кепки «Спартак»', 'image_path': 'data/Кепки «Спартак»/😀.jpg'},
+    ]
+    store = write_and_open(tmp_path, records)
+
+    assert store.to_list() == records
+    assert store.has_image_path('data/帽子/帽子.zip!/帽子/1.png')
+    assert not store.has_image_path('data/帽子/2.png')
+
+
+def test_empty_metadata(tmp_path):
+    store = write_and_open(tmp_path, [])
+
+    assert len(store) == 0
+    assert store.to_list() == []
+    assert store.cap_names == []
+    assert not store.has_image_path('data/a.jpg')
+
+
+def test_only_deleted_rows(tmp_path):
+    store = write_and_open(tmp_path, [None, None])
+
+    assert store.to_list() == [None, None]
+    assert store.cap_names == []
+
+
+def test_group_rows_skip_deleted_rows(tmp_path):
+    records = [
+        {'cap_name': 'a', 'image_path': '1'},
+        {'cap_name': 'b', 'image_path': '2'},
+        None,
+        {'cap_name': 'a', 'image_path': '3'},
+    ]
+    store = write_and_open(tmp_path, records)
+
+    assert store.group_rows(0).tolist() == [0, 3]
+    assert store.group_rows(1).tolist() == [1]
+
+
+def test_deleted_paths_are_not_found(tmp_path):
+    store = write_and_open(tmp_path, [None, {'cap_name': 'a', 'image_path': 'data/a/2.jpg'}])
+
+    assert store.has_image_path('data/a/2.jpg')
+    assert not store.has_image_path('')
+
+
+def test_open_rejects_foreign_and_empty_files(tmp_path):
+    foreign = tmp_path / "foreign.bin"
+    foreign.write_bytes(b'\0' * 64)
+    with pytest.raises(ValueError):
+        MetadataStore.open(str(foreign))
+
+    empty = tmp_path / "empty.bin"
+    empty.write_bytes(b'')
+    with pytest.raises(ValueError):
+        MetadataStore.open(str(empty))
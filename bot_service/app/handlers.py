@@ -1,25 +1,39 @@
+import asyncio
 import json
 import logging
+import time
+from io import BytesIO
 from pathlib import Path
 
-import aiofiles
-import aiohttp
 from aiogram import Bot, Dispatcher, F
+from aiogram.exceptions import TelegramAPIError, TelegramBadRequest
 from aiogram.fsm.storage.memory import MemoryStorage
-from aiogram.types import FSInputFile, Message
-from PIL import Image
+from aiogram.types import BufferedInputFile, InputMediaPhoto, Message
 
-from utils import TempFileManager
+from metrics import (HANDLE_IMAGE_SECONDS, PHOTO_DOWNLOAD_SECONDS, PHOTO_UPLOAD_SECONDS, RESULT_CACHE_REQUESTS,
+                     TELEGRAM_FILE_REQUESTS)
+from utils import TTLCache
 
 logger = logging.getLogger(__name__)
 
+# Telegram принимает в альбоме от 2 до 10 фото
+MEDIA_GROUP_LIMIT = 10
+
 
 class TelegramBot:
-    def __init__(self, api_token, analysis_service, rabbitmq_handler):
+    def __init__(self, api_token, analysis_service, rabbitmq_handler, telegram_files, result_cache_size=1024,
+                 result_cache_ttl=600, fetch_concurrency=4):
         self.bot = Bot(token=api_token)
         self.dp = Dispatcher(storage=MemoryStorage())
         self.analysis_service = analysis_service
         self.rabbitmq_handler = rabbitmq_handler
+        # file_id уже загруженных в Telegram фотографий каталога
+        self.telegram_files = telegram_files
+        # Сколько копий изображений загружается из сервиса анализа одновременно
+        self.fetch_concurrency = fetch_concurrency
+
+        # Результаты анализа по file_unique_id: пересланное фото не скачивается и не анализируется повторно
+        self.result_cache = TTLCache(result_cache_size, ttl=result_cache_ttl)
 
         # Регистрация хендлеров
         self._register_handlers()
@@ -48,30 +62,49 @@ class TelegramBot:
             "username": message.from_user.username,
             "message": "Фото",
         }
+        started = time.perf_counter()
+        outcome = "error"
 
         try:
-            # Скачиваем изображение
             photo = message.photo[-1]
-            file_info = await self.bot.get_file(photo.file_id)
-            file_path = file_info.file_path
-
-            # Работа с временным файлом
-            with TempFileManager(suffix=".jpg") as temp_file:
-                await self.bot.download_file(file_path, temp_file)
+            analysis_result = self.result_cache.get(photo.file_unique_id)
+            RESULT_CACHE_REQUESTS.labels("miss" if analysis_result is None else "hit").inc()
+            if analysis_result is None:
+                # Скачиваем изображение в память, без временного файла и блокирующего чтения с диска
+                with PHOTO_DOWNLOAD_SECONDS.time():
+                    file_info = await self.bot.get_file(photo.file_id)
+                    image_buffer = await self.bot.download_file(file_info.file_path, BytesIO())
 
                 # Анализ изображения
-                analysis_result = await self.analysis_service.analyze_image(temp_file)
-                user_data["analysis_result"] = analysis_result
+                analysis_result = await self.analysis_service.analyze_image(image_buffer.getvalue())
 
-                # Отправка результатов пользователю
-                await self.process_analysis_result(message, analysis_result)
+                if analysis_result.get("status") == "ok":
+                    self.result_cache.put(photo.file_unique_id, analysis_result)
+            else:
+                logger.info(f"Результат для фото {photo.file_unique_id} взят из кэша")
+            user_data["analysis_result"] = analysis_result
 
-            # Отправка данных в RabbitMQ
-            await self.rabbitmq_handler.send_to_queue(json.dumps(user_data))
+            # Отправка результатов пользователю
+            await self.process_analysis_result(message, analysis_result)
+            outcome = "ok" if analysis_result.get("status") == "ok" else "analysis_error"
 
         except Exception as e:
             logger.error(f"Ошибка обработки изображения: {e}")
             await message.reply("Произошла ошибка при обработке изображения. 😞")
+        finally:
+            # Результат анализа попадает в историю, даже если отправить его пользователю не удалось
+            if "analysis_result" in user_data:
+                await self.publish_history(user_data)
+            HANDLE_IMAGE_SECONDS.labels(outcome).observe(time.perf_counter() - started)
+
+    async def publish_history(self, user_data: dict):
+        """
+        Отправляет запрос пользователя и результат анализа в RabbitMQ для истории.
+        """
+        try:
+            await self.rabbitmq_handler.send_to_queue(json.dumps(user_data))
+        except Exception as e:
+            logger.error(f"Не удалось сохранить запрос пользователя {user_data['telegram_id']} в истории: {e}")
 
     async def process_analysis_result(self, message: Message, analysis_result: dict):
         """
@@ -86,73 +119,125 @@ class TelegramBot:
             await message.reply("Извините, похожие объекты не найдены.")
             return
 
-        for res in results:
-            await self.send_result(message, res)
-
-        await message.reply("Вот похожие объекты, которые я нашел для вас! 😊")
+        index_version = analysis_result.get("index_version")
+        photos = await self.prepare_photos(message, results, index_version)
 
-    from io import BytesIO
+        # Результаты уходят одним альбомом (в альбоме не больше MEDIA_GROUP_LIMIT фото)
+        for offset in range(0, len(photos), MEDIA_GROUP_LIMIT):
+            await self.send_photos(message, photos[offset:offset + MEDIA_GROUP_LIMIT], index_version)
 
-    from aiogram.types import FSInputFile
-    from PIL import Image
+        await message.reply("Вот похожие объекты, которые я нашел для вас! 😊")
 
-    async def send_result(self, message: Message, result: dict):
+    async def prepare_photos(self, message: Message, results: list, index_version):
         """
-        Скачивает изображение из другого сервиса, сохраняет его локально, а затем отправляет пользователю.
+        Готовит фотографии результатов: уже загруженные в Telegram отправляются по file_id, копии остальных
+        загружаются из сервиса анализа одним запросом, а не попавшие в него — параллельно по одной.
         """
-        cap_name = result.get("cap_name", "Без имени")
-        similarity_score = result.get("similarity_score", 0.0)
-        image_path = result.get("image_path")
-
-        if not image_path:
-            logger.warning(f"У объекта {cap_name} отсутствует путь к изображению.")
+        photos = []
+        for res in results:
+            cap_name = res.get("cap_name", "Без имени")
+            if not res.get("image_path"):
+                logger.warning(f"У объекта {cap_name} отсутствует путь к изображению.")
+                continue
+            photos.append({
+                "image_path": res["image_path"].replace("\\", "/"),  # Исправляем обратные слэши
+                "cap_name": cap_name,
+                "caption": f"Название: {cap_name}\nСхожесть: {res.get('similarity_score', 0.0):.2f}",
+            })
+
+        file_ids = await asyncio.gather(
+            *(self.telegram_files.get(photo["image_path"], index_version) for photo in photos)
+        )
+        for photo, file_id in zip(photos, file_ids):
+            photo["file_id"] = file_id
+            TELEGRAM_FILE_REQUESTS.labels("miss" if file_id is None else "hit").inc()
+
+        missing = [photo["image_path"] for photo in photos if photo["file_id"] is None]
+        thumbnails = await self.analysis_service.fetch_thumbnails(missing)
+
+        semaphore = asyncio.Semaphore(self.fetch_concurrency)
+
+        async def fetch(image_path):
+            async with semaphore:
+                return await self.analysis_service.fetch_thumbnail(image_path)
+
+        retry = [image_path for image_path in missing if image_path not in thumbnails]
+        for image_path, image_bytes in zip(retry, await asyncio.gather(*(fetch(path) for path in retry))):
+            if image_bytes is not None:
+                thumbnails[image_path] = image_bytes
+
+        ready = []
+        for photo in photos:
+            photo["image_bytes"] = thumbnails.get(photo["image_path"])
+            if photo["file_id"] is None and photo["image_bytes"] is None:
+                await message.reply(f"Не удалось обработать изображение: {photo['cap_name']}")
+                continue
+            ready.append(photo)
+        return ready
+
+    async def send_photos(self, message: Message, photos: list, index_version):
+        """
+        Отправляет фотографии одним альбомом и запоминает file_id загруженных.
+        Если альбом не отправился (устаревший file_id, сетевая ошибка, ограничение частоты),
+        фотографии отправляются по одной.
+        """
+        if len(photos) == 1:
+            await self.send_result(message, photos[0], index_version)
             return
 
-        # Формируем полный URL для загрузки изображения
-        image_url = f"{self.analysis_service.service_url}/images/{image_path.lstrip('/')}"
-        image_url = image_url.replace("\\", "/")  # Исправляем обратные слэши
+        media = [
+            InputMediaPhoto(media=photo["file_id"] or self.photo_file(photo), caption=photo["caption"])
+            for photo in photos
+        ]
+        try:
+            with PHOTO_UPLOAD_SECONDS.labels("media_group").time():
+                sent = await self.bot.send_media_group(chat_id=message.chat.id, media=media)
+        except TelegramAPIError as e:
+            logger.warning(f"Не удалось отправить альбом, отправляем фото по одному: {e}")
+            for photo in photos:
+                await self.send_result(message, photo, index_version)
+            return
 
-        # Путь для временного сохранения загруженного изображения
-        temp_dir = Path("temp_images")
-        temp_dir.mkdir(parents=True, exist_ok=True)
-        local_image_path = temp_dir / Path(image_path).name
+        for photo, sent_message in zip(photos, sent):
+            if photo["file_id"] is None:
+                await self.telegram_files.put(photo["image_path"], index_version, sent_message.photo[-1].file_id)
 
+    async def send_result(self, message: Message, photo: dict, index_version):
+        """
+        Отправляет одну фотографию результата: по file_id, если оно уже загружено в Telegram,
+        иначе JPEG копию из сервиса анализа.
+        """
+        image_path = photo["image_path"]
         try:
-            # Скачиваем изображение
-            async with aiohttp.ClientSession() as session:
-                async with session.get(image_url) as response:
-                    if response.status == 200:
-                        async with aiofiles.open(local_image_path, "wb") as f:
-                            await f.write(await response.read())
-                    else:
-                        logger.warning(f"Не удалось загрузить изображение: {image_url}, статус: {response.status}")
-                        return
-
-            # Конвертируем изображение, если оно в формате WEBP
-            if local_image_path.suffix.lower() == ".webp":
-                converted_path = temp_dir / f"{local_image_path.stem}.jpg"
-                with Image.open(local_image_path) as img:
-                    img.convert("RGB").save(converted_path, "JPEG")
-                local_image_path = converted_path
-
-            # Отправляем изображение пользователю
-            photo_file = FSInputFile(local_image_path)
-            await self.bot.send_photo(
-                chat_id=message.chat.id,
-                photo=photo_file,
-                caption=f"Название: {cap_name}\nСхожесть: {similarity_score:.2f}"
-            )
+            if photo["file_id"] is not None:
+                try:
+                    with PHOTO_UPLOAD_SECONDS.labels("file_id").time():
+                        await self.bot.send_photo(chat_id=message.chat.id, photo=photo["file_id"],
+                                                  caption=photo["caption"])
+                    return
+                except TelegramBadRequest as e:
+                    logger.warning(f"Telegram не принял file_id для {image_path}: {e}")
+                    self.telegram_files.forget(image_path, index_version)
+
+            if photo["image_bytes"] is None:
+                photo["image_bytes"] = await self.analysis_service.fetch_thumbnail(image_path)
+            if photo["image_bytes"] is None:
+                await message.reply(f"Не удалось обработать изображение: {photo['cap_name']}")
+                return
+
+            # Отправляем изображение пользователю прямо из памяти и запоминаем его file_id
+            with PHOTO_UPLOAD_SECONDS.labels("photo").time():
+                sent = await self.bot.send_photo(chat_id=message.chat.id, photo=self.photo_file(photo),
+                                                 caption=photo["caption"])
+            await self.telegram_files.put(image_path, index_version, sent.photo[-1].file_id)
 
         except Exception as e:
-            logger.error(f"Ошибка при обработке изображения {image_url}: {e}")
-            await message.reply(f"Не удалось обработать изображение: {cap_name}")
-        finally:
-            # Удаляем временные файлы
-            try:
-                if local_image_path.exists():
-                    local_image_path.unlink()
-            except Exception as cleanup_error:
-                logger.warning(f"Не удалось удалить временный файл {local_image_path}: {cleanup_error}")
+            logger.error(f"Ошибка при отправке изображения {image_path}: {e}")
+            await message.reply(f"Не удалось обработать изображение: {photo['cap_name']}")
+
+    @staticmethod
+    def photo_file(photo: dict):
+        return BufferedInputFile(photo["image_bytes"], filename=f"{Path(photo['image_path']).stem}.jpg")
 
     async def run(self):
         """
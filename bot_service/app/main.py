@@ -4,12 +4,35 @@ import os
 from dotenv import load_dotenv
 
 from handlers import TelegramBot
+from metrics import start_metrics_server
 from services.analysis import ImageAnalysisService
-from services.rabbitmq import RabbitMQHandler
+from services.http_client import CircuitBreaker, HttpClient
+from services.rabbitmq import RabbitMQHandler, RabbitMQPublisher
+from services.telegram_files import TelegramFileStore
 
 load_dotenv()
 
 
+def create_http_client(base_url, name):
+    """
+    Общий HTTP клиент сервиса с настройками пула, таймаутов, повторов и предохранителя из окружения.
+    """
+    return HttpClient(
+        base_url,
+        name=name,
+        limit=int(os.getenv("HTTP_POOL_LIMIT", "100")),
+        limit_per_host=int(os.getenv("HTTP_POOL_LIMIT_PER_HOST", "20")),
+        keepalive_timeout=float(os.getenv("HTTP_KEEPALIVE_TIMEOUT", "30")),
+        total_timeout=float(os.getenv("HTTP_TIMEOUT", "30")),
+        connect_timeout=float(os.getenv("HTTP_CONNECT_TIMEOUT", "5")),
+        retries=int(os.getenv("HTTP_RETRIES", "2")),
+        circuit_breaker=CircuitBreaker(
+            failure_threshold=int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5")),
+            reset_timeout=float(os.getenv("CIRCUIT_RESET_TIMEOUT", "30"))
+        )
+    )
+
+
 async def main():
     # Проверка обязательных переменных окружения
     api_token = os.getenv("TELEGRAM_API_TOKEN")
@@ -18,13 +41,49 @@ async def main():
 
     if not all([api_token, analysis_service_url, rabbitmq_url]):
         raise ValueError("Необходимо указать TELEGRAM_API_TOKEN, ANALYSIS_SERVICE_URL и RABBITMQ_URL в .env файле")
+    database_service_url = os.getenv("DATABASE_SERVICE_URL")
+    database_api_token = os.getenv("DATABASE_API_TOKEN")
+    if database_service_url and not database_api_token:
+        raise ValueError("Необходимо указать DATABASE_API_TOKEN в .env файле: без него сервис базы данных отвечает 401")
+
+    # Метрики для Prometheus: http://<бот>:METRICS_PORT/metrics
+    start_metrics_server(int(os.getenv("METRICS_PORT", "9100")))
 
     # Инициализация сервисов
-    analysis_service = ImageAnalysisService(analysis_service_url)
-    rabbitmq_handler = RabbitMQHandler(rabbitmq_url, queue_name="database_queue")
-    telegram_bot = TelegramBot(api_token, analysis_service, rabbitmq_handler)
+    analysis_service = ImageAnalysisService(
+        analysis_service_url, create_http_client(analysis_service_url, "ai_service")
+    )
+    # Одно соединение с RabbitMQ на всё время работы бота; сообщения публикуются порциями с подтверждением
+    rabbitmq_publisher = RabbitMQPublisher(
+        rabbitmq_url,
+        batch_size=int(os.getenv("RABBITMQ_BATCH_SIZE", "50")),
+        flush_interval=float(os.getenv("RABBITMQ_FLUSH_INTERVAL", "0.2")),
+        max_buffer=int(os.getenv("RABBITMQ_MAX_BUFFER", "10000")),
+        # Файл на томе bot_data, чтобы неотправленные сообщения пережили пересоздание контейнера
+        spill_file=os.getenv("RABBITMQ_SPILL_FILE", "/bot_service/data/rabbitmq_spill.jsonl") or None
+    )
+    await rabbitmq_publisher.start()
+    rabbitmq_handler = RabbitMQHandler(rabbitmq_publisher, queue_name="database_queue")
+    # file_id загруженных фотографий каталога сохраняются в сервисе базы данных
+    telegram_files = TelegramFileStore(
+        database_service_url,
+        RabbitMQHandler(rabbitmq_publisher, queue_name="telegram_files_queue"),
+        http_client=create_http_client(database_service_url, "database_service"),
+        api_token=database_api_token
+    )
+    telegram_bot = TelegramBot(
+        api_token, analysis_service, rabbitmq_handler, telegram_files,
+        result_cache_size=int(os.getenv("BOT_RESULT_CACHE_SIZE", "1024")),
+        result_cache_ttl=float(os.getenv("BOT_RESULT_CACHE_TTL", "600")),
+        fetch_concurrency=int(os.getenv("IMAGE_FETCH_CONCURRENCY", "4"))
+    )
 
-    await telegram_bot.run()
+    try:
+        await telegram_bot.run()
+    finally:
+        await analysis_service.close()
+        await telegram_files.close()
+        await rabbitmq_publisher.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,45 @@
+"""
+Метрики бота в формате Prometheus. Отдаются HTTP сервером prometheus_client на порту METRICS_PORT.
+"""
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+# От десятков миллисекунд (file_id, кэш) до минуты (поиск под нагрузкой, загрузка альбома)
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+HANDLE_IMAGE_SECONDS = Histogram(
+    'bot_handle_image_seconds', "Полное время обработки фото пользователя", ['outcome'], buckets=LATENCY_BUCKETS
+)
+PHOTO_DOWNLOAD_SECONDS = Histogram(
+    'bot_photo_download_seconds', "Время скачивания фото пользователя из Telegram", buckets=LATENCY_BUCKETS
+)
+PHOTO_UPLOAD_SECONDS = Histogram(
+    'bot_photo_upload_seconds', "Время отправки результатов в Telegram: альбомом или одним фото", ['kind'],
+    buckets=LATENCY_BUCKETS
+)
+RESULT_CACHE_REQUESTS = Counter('bot_result_cache_requests', "Обращения к кэшу результатов анализа", ['result'])
+TELEGRAM_FILE_REQUESTS = Counter(
+    'bot_telegram_file_requests', "Фото результатов: отправлено по file_id или загружено заново", ['result']
+)
+
+HTTP_REQUESTS = Counter(
+    'bot_http_requests', "Запросы к сервисам по итогу: код ответа, error или circuit_open", ['service', 'status']
+)
+HTTP_REQUEST_SECONDS = Histogram(
+    'bot_http_request_seconds', "Время запроса к сервису с учётом повторов", ['service'], buckets=LATENCY_BUCKETS
+)
+HTTP_RETRIES = Counter('bot_http_retries', "Повторы запросов к сервисам", ['service'])
+CIRCUIT_STATE = Gauge('bot_circuit_state', "Состояние предохранителя: 0 — замкнут, 1 — пробный запрос, 2 — разомкнут",
+                      ['service'])
+
+RABBITMQ_PUBLISHED = Counter('bot_rabbitmq_published', "Сообщения, подтверждённые брокером", ['queue'])
+RABBITMQ_PUBLISH_ERRORS = Counter('bot_rabbitmq_publish_errors', "Неудачные попытки отправить порцию в RabbitMQ")
+RABBITMQ_SPILLED = Counter('bot_rabbitmq_spilled', "Сообщения, записанные в файл из-за переполнения или остановки")
+RABBITMQ_BUFFER = Gauge('bot_rabbitmq_buffer', "Сообщения в буфере публикации")
+
+
+def start_metrics_server(port):
+    """
+    Запускает HTTP сервер /metrics в фоновом потоке (port=0 — метрики не отдаются).
+    """
+    if port:
+        start_http_server(port)
@@ -1,27 +1,88 @@
+import asyncio
 import logging
+from urllib.parse import unquote
 
 import aiohttp
 
+from .http_client import HttpClient
+
 logger = logging.getLogger(__name__)
 
 
 class ImageAnalysisService:
-    def __init__(self, service_url: str):
+    def __init__(self, service_url: str, http_client: HttpClient = None):
         self.service_url = service_url
+        # Общая сессия с пулом соединений, повторами и предохранителем на все запросы к сервису анализа
+        self.http = http_client or HttpClient(service_url, name="ai_service")
+
+    async def close(self):
+        await self.http.close()
+
+    async def analyze_image(self, image_bytes: bytes, top_k: int = 2, aggregate: str = "max"):
+        """
+        Отправляет изображение из памяти на поиск похожих кепок.
+        """
+        def form_data():
+            data = aiohttp.FormData()
+            data.add_field("image", image_bytes, filename="image.jpg", content_type="image/jpeg")
+            return data
+
+        async def read_result(resp):
+            if resp.status != 200:
+                logger.error(f"Ошибка анализа изображения, код: {resp.status}")
+                return {"status": "error", "message": "Ошибка анализа изображения"}
+            return await resp.json()
 
-    async def analyze_image(self, file_path: str, top_k: int = 2):
         try:
-            async with aiohttp.ClientSession() as session:
-                with open(file_path, "rb") as f:
-                    form_data = aiohttp.FormData()
-                    form_data.add_field("image", f, filename=file_path, content_type="image/jpeg")
-                    form_data.add_field("top_k", str(top_k))
-
-                    async with session.post(f"{self.service_url}/search_image", data=form_data) as resp:
-                        if resp.status != 200:
-                            logger.error(f"Ошибка анализа изображения, код: {resp.status}")
-                            return {"status": "error", "message": "Ошибка анализа изображения"}
-                        return await resp.json()
-        except aiohttp.ClientError as e:
-            logger.error(f"Ошибка соединения с сервисом анализа: {e}")
+            # top_k и aggregate — query-параметры эндпоинта; aggregate возвращает разные модели кепок
+            params = {"top_k": top_k, "aggregate": aggregate}
+            return await self.http.request("POST", "/search_image", read_result, data=form_data, params=params)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.error(f"Ошибка соединения с сервисом анализа: {e!r}")
             return {"status": "error", "message": "Сервис анализа временно недоступен"}
+
+    async def fetch_thumbnails(self, image_paths):
+        """
+        Загружает JPEG копии изображений результатов одним запросом. Возвращает {image_path: bytes};
+        изображений, которых не удалось получить, в ответе нет.
+        """
+        if not image_paths:
+            return {}
+
+        async def read_thumbnails(resp):
+            thumbnails = {}
+            if resp.status != 200:
+                logger.error(f"Ошибка загрузки копий изображений, код: {resp.status}")
+                return thumbnails
+            reader = aiohttp.MultipartReader.from_response(resp)
+            while True:
+                part = await reader.next()
+                if part is None:
+                    break
+                image_path = unquote(part.headers.get("Content-Location", ""))
+                thumbnails[image_path] = await part.read(decode=False)
+            return thumbnails
+
+        try:
+            # POST только ради тела запроса: чтение копий безопасно повторять
+            return await self.http.request("POST", "/thumbnails/batch", read_thumbnails, idempotent=True,
+                                           json={"image_paths": image_paths})
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.error(f"Ошибка соединения с сервисом анализа: {e!r}")
+            return {}
+
+    async def fetch_thumbnail(self, image_path):
+        """
+        Загружает JPEG копию одного изображения или возвращает None.
+        """
+        async def read_thumbnail(resp):
+            if resp.status != 200:
+                logger.warning(f"Не удалось загрузить изображение: {image_path}, статус: {resp.status}")
+                return None
+            return await resp.read()
+
+        try:
+            return await self.http.request("GET", f"/thumbnails/{image_path.lstrip('/')}", read_thumbnail)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.error(f"Ошибка соединения с сервисом анализа: {e!r}")
+            return None
@@ -0,0 +1,197 @@
+import asyncio
+import logging
+import random
+import time
+
+import aiohttp
+
+from metrics import CIRCUIT_STATE, HTTP_REQUEST_SECONDS, HTTP_REQUESTS, HTTP_RETRIES
+
+logger = logging.getLogger(__name__)
+
+# Ответы, после которых запрос имеет смысл повторить: сервис перегружен или перезапускается
+RETRY_STATUSES = {502, 503, 504}
+
+# Методы, повтор которых безопасен. Прочие запросы (поиск по фото — дорогой POST) повторяются,
+# только если сервис их точно не обрабатывал: соединение не установлено или 503 с Retry-After
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+
+# Значения метрики состояния предохранителя
+CIRCUIT_STATES = ("closed", "half-open", "open")
+
+
+class CircuitOpenError(aiohttp.ClientError):
+    """
+    Запрос не отправлен: сервис недавно раз за разом не отвечал, и предохранитель разомкнут.
+    """
+
+
+class CircuitBreaker:
+    """
+    Предохранитель: после failure_threshold неудач подряд запросы сразу отклоняются на reset_timeout секунд,
+    затем пропускается один пробный запрос. Удачный пробный запрос замыкает предохранитель.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._probe_in_flight = False
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def allow(self):
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half-open" and not self._probe_in_flight:
+            self._probe_in_flight = True
+            return True
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self._probe_in_flight = False
+
+    def record_failure(self):
+        self.failures += 1
+        self._probe_in_flight = False
+        if self.opened_at is not None or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+
+    def release_probe(self):
+        """
+        Пробный запрос завершился без результата (отменён или упал не на стороне сервиса):
+        следующий запрос снова может стать пробным.
+        """
+        self._probe_in_flight = False
+
+
+class HttpClient:
+    """
+    Общий HTTP клиент для одного сервиса: долгоживущая сессия с пулом keep-alive соединений,
+    таймауты, повторы с экспоненциальной задержкой и случайным разбросом, предохранитель.
+
+    Сессия создаётся при первом запросе (внутри работающего цикла событий) и закрывается в close().
+    """
+
+    def __init__(self, base_url, name="http", limit=100, limit_per_host=20, keepalive_timeout=30.0,
+                 total_timeout=30.0, connect_timeout=5.0, retries=2, backoff=0.2, max_backoff=5.0,
+                 circuit_breaker=None):
+        self.base_url = base_url.rstrip("/") if base_url else base_url
+        self.name = name
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.timeout = aiohttp.ClientTimeout(total=total_timeout, connect=connect_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.circuit_breaker = circuit_breaker or CircuitBreaker()
+        CIRCUIT_STATE.labels(name).set_function(lambda: CIRCUIT_STATES.index(self.circuit_breaker.state))
+
+        self._session = None
+
+    @property
+    def session(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                keepalive_timeout=self.keepalive_timeout,
+                ttl_dns_cache=300
+            )
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+    async def request(self, method, path, handler, data=None, idempotent=None, **kwargs):
+        """
+        Выполняет запрос и возвращает результат handler(response).
+
+        Идемпотентные запросы (по умолчанию — по методу, см. IDEMPOTENT_METHODS) повторяются до retries раз
+        при ошибках соединения, таймаутах и ответах 502/503/504. Остальные — только если сервис запрос
+        не обрабатывал: соединение не установлено или ответ 503 с Retry-After. Retry-After учитывается,
+        если не превышает max_backoff. data может быть функцией, которая создаёт тело
+        запроса заново для каждой попытки (FormData нельзя отправить дважды).
+        Если предохранитель разомкнут, сразу выбрасывает CircuitOpenError.
+        """
+        if idempotent is None:
+            idempotent = method.upper() in IDEMPOTENT_METHODS
+        with HTTP_REQUEST_SECONDS.labels(self.name).time():
+            return await self._request(method, path, handler, data, idempotent, **kwargs)
+
+    async def _request(self, method, path, handler, data, idempotent, **kwargs):
+        url = f"{self.base_url}{path}"
+        for attempt in range(self.retries + 1):
+            # Запрос при не замкнутом предохранителе — пробный; его нужно вернуть, чем бы попытка ни закончилась
+            probe = self.circuit_breaker.state != "closed"
+            if not self.circuit_breaker.allow():
+                HTTP_REQUESTS.labels(self.name, "circuit_open").inc()
+                raise CircuitOpenError(f"Сервис {self.name} временно недоступен")
+
+            retry_after = None
+            recorded = False
+            try:
+                try:
+                    body = data() if callable(data) else data
+                    async with self.session.request(method, url, data=body, **kwargs) as response:
+                        if response.status not in RETRY_STATUSES:
+                            self.circuit_breaker.record_success()
+                            recorded = True
+                            HTTP_REQUESTS.labels(self.name, str(response.status)).inc()
+                            return await handler(response)
+                        retry_after = response.headers.get("Retry-After")
+                        error = aiohttp.ClientResponseError(
+                            response.request_info, response.history, status=response.status,
+                            message=response.reason
+                        )
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    error = e
+                self.circuit_breaker.record_failure()
+                recorded = True
+            finally:
+                # Отмена или ошибка вне запроса (например, при сборке тела) не должна навсегда занять пробный запрос
+                if probe and not recorded:
+                    self.circuit_breaker.release_probe()
+
+            retryable = idempotent or self._not_processed(error, retry_after)
+            delay = self._delay(attempt, retry_after) if retryable and attempt < self.retries else None
+            if delay is None:
+                HTTP_REQUESTS.labels(self.name, "error").inc()
+                raise error
+            HTTP_RETRIES.labels(self.name).inc()
+            logger.warning(f"Запрос к {self.name} не удался ({error!r}), повтор через {delay:.2f} с")
+            await asyncio.sleep(delay)
+
+    @staticmethod
+    def _not_processed(error, retry_after):
+        """
+        Сервис точно не начинал обрабатывать запрос: не удалось соединиться или он явно отказал с Retry-After.
+        Таймаут или обрыв соединения после отправки ничего не гарантируют — запрос мог уже выполняться.
+        """
+        if isinstance(error, aiohttp.ClientConnectorError):
+            return True
+        return isinstance(error, aiohttp.ClientResponseError) and error.status == 503 and retry_after is not None
+
+    def _delay(self, attempt, retry_after):
+        if retry_after is not None:
+            try:
+                retry_after = float(retry_after)
+            except ValueError:
+                retry_after = None
+        if retry_after is not None:
+            return retry_after if retry_after <= self.max_backoff else None
+        # Полный случайный разброс: одновременные неудачные запросы не повторяются синхронно
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
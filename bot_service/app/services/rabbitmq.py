@@ -1,25 +1,228 @@
+import asyncio
+import json
 import logging
+import os
+import threading
+from collections import deque
 
 import aio_pika
 
+from metrics import RABBITMQ_BUFFER, RABBITMQ_PUBLISH_ERRORS, RABBITMQ_PUBLISHED, RABBITMQ_SPILLED
+
 logger = logging.getLogger(__name__)
 
 
-class RabbitMQHandler:
-    def __init__(self, rabbitmq_url: str, queue_name: str):
+class RabbitMQPublisher:
+    """
+    Долгоживущее соединение с RabbitMQ для публикации сообщений бота.
+
+    Соединение и канал с подтверждениями публикации (publisher confirms) открываются один раз при запуске,
+    очереди объявляются один раз. Сообщения сначала попадают в буфер и публикуются фоновой задачей
+    порциями до batch_size не реже раза в flush_interval секунд; сообщение удаляется из буфера только
+    после подтверждения брокера. Пока брокер недоступен, сообщения копятся в буфере на max_buffer
+    сообщений, а сверх него — дописываются в spill_file (если задан) и возвращаются в буфер позже.
+    Файл читается и пишется в отдельном потоке, чтобы не блокировать цикл событий бота.
+    """
+
+    def __init__(self, rabbitmq_url, batch_size=50, flush_interval=0.2, max_buffer=10000, spill_file=None,
+                 retry_delay=5.0):
         self.rabbitmq_url = rabbitmq_url
-        self.queue_name = queue_name
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self.spill_file = spill_file
+        if spill_file and os.path.dirname(spill_file):
+            os.makedirs(os.path.dirname(spill_file), exist_ok=True)
+        self.retry_delay = retry_delay
 
-    async def send_to_queue(self, data: str):
+        self._buffer = deque()
+        self._connection = None
+        self._channel = None
+        self._declared = set()
+        self._wakeup = asyncio.Event()
+        self._flusher = None
+        self._closing = False
+        # Запись в spill_file и его перенос на восстановление не должны пересекаться
+        self._spill_lock = threading.Lock()
+        RABBITMQ_BUFFER.set_function(lambda: len(self._buffer))
+
+    async def start(self):
+        """
+        Запускает фоновую публикацию. Соединение устанавливается в ней же, поэтому бот стартует
+        и копит сообщения в буфере, даже если брокер ещё недоступен.
+        """
+        if self._flusher is None:
+            self._flusher = asyncio.create_task(self._run())
+
+    async def close(self, timeout=10.0):
+        """
+        Публикует оставшиеся сообщения (не дольше timeout секунд), неотправленные сохраняет в spill_file.
+        """
+        self._closing = True
+        self._wakeup.set()
+        if self._flusher is not None:
+            try:
+                await asyncio.wait_for(self._flusher, timeout)
+            except asyncio.TimeoutError:
+                logger.warning(f"Не все сообщения отправлены в RabbitMQ до остановки: {len(self._buffer)}")
+        await asyncio.to_thread(self._spill, list(self._buffer))
+        self._buffer.clear()
+        if self._connection is not None:
+            await self._connection.close()
+
+    async def publish(self, queue_name, body):
+        """
+        Ставит сообщение в буфер публикации и сразу возвращается.
+        """
+        if len(self._buffer) >= self.max_buffer:
+            if self.spill_file:
+                await asyncio.to_thread(self._spill, [(queue_name, body)])
+            else:
+                logger.error(f"Буфер RabbitMQ переполнен, сообщение для {queue_name} отброшено")
+            return
+        self._buffer.append((queue_name, body))
+        if len(self._buffer) >= self.batch_size:
+            self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            try:
+                if not await self._flush_once():
+                    return
+            except Exception as e:
+                # Фоновая задача не должна умирать: иначе буфер больше никогда не отправится
+                logger.exception(f"Ошибка фоновой публикации в RabbitMQ, повтор через {self.retry_delay} с: {e}")
+                if self._closing:
+                    return
+                await asyncio.sleep(self.retry_delay)
+
+    async def _flush_once(self):
+        """
+        Одна итерация фоновой публикации. Возвращает False, когда публикация завершена при остановке.
+        """
+        if not self._buffer and not self._closing:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+        if not self._buffer:
+            await self._restore_spilled()
+        if not self._buffer:
+            return not self._closing
+
+        batch = [self._buffer[position] for position in range(min(self.batch_size, len(self._buffer)))]
         try:
-            connection = await aio_pika.connect_robust(self.rabbitmq_url)
-            async with connection:
-                channel = await connection.channel()
-                queue = await channel.declare_queue(self.queue_name, durable=True)
-                await channel.default_exchange.publish(
-                    aio_pika.Message(body=data.encode()),
-                    routing_key=queue.name,
-                )
-            logger.info("Данные успешно отправлены в RabbitMQ")
+            await self._publish_batch(batch)
         except Exception as e:
-            logger.error(f"Ошибка при отправке в RabbitMQ: {e}")
+            RABBITMQ_PUBLISH_ERRORS.inc()
+            logger.error(f"Ошибка при отправке в RabbitMQ, повтор через {self.retry_delay} с: {e}")
+            if self._closing:
+                return False
+            await asyncio.sleep(self.retry_delay)
+            return True
+
+        for queue_name, _ in batch:
+            self._buffer.popleft()
+            RABBITMQ_PUBLISHED.labels(queue_name).inc()
+        logger.info(f"Отправлено в RabbitMQ сообщений: {len(batch)}")
+        return True
+
+    async def _publish_batch(self, batch):
+        channel = await self._get_channel()
+        for queue_name in {queue_name for queue_name, _ in batch} - self._declared:
+            await channel.declare_queue(queue_name, durable=True)
+            self._declared.add(queue_name)
+
+        # Подтверждения брокера ждём для всей порции сразу, а не по одному сообщению
+        await asyncio.gather(*(
+            channel.default_exchange.publish(
+                aio_pika.Message(body=body.encode(), delivery_mode=aio_pika.DeliveryMode.PERSISTENT),
+                routing_key=queue_name,
+            )
+            for queue_name, body in batch
+        ))
+
+    async def _get_channel(self):
+        if self._connection is None:
+            self._connection = await aio_pika.connect_robust(self.rabbitmq_url)
+        if self._channel is None or self._channel.is_closed:
+            self._channel = await self._connection.channel(publisher_confirms=True)
+            self._declared.clear()
+        return self._channel
+
+    def _spill(self, messages):
+        if not messages:
+            return
+        if not self.spill_file:
+            logger.error(f"Потеряно сообщений RabbitMQ: {len(messages)}")
+            return
+        with self._spill_lock, open(self.spill_file, "a", encoding="utf-8") as f:
+            for queue_name, body in messages:
+                f.write(json.dumps({"queue": queue_name, "body": body}, ensure_ascii=False) + "\n")
+        RABBITMQ_SPILLED.inc(len(messages))
+
+    async def _restore_spilled(self):
+        """
+        Возвращает в буфер сообщения, сохранённые на диск при переполнении или остановке, —
+        не больше, чем помещается в буфер (max_buffer); остальные остаются на диске до следующего раза.
+        Файл удаляется только после того, как все сообщения из него попали в буфер.
+        """
+        limit = self.max_buffer - len(self._buffer)
+        if not self.spill_file or limit <= 0:
+            return
+        restoring_file, messages, remaining = await asyncio.to_thread(self._read_spilled, limit)
+        if restoring_file is None:
+            return
+        self._buffer.extend(messages)
+        if not remaining:
+            await asyncio.to_thread(os.remove, restoring_file)
+        logger.info(f"Восстановлено из {self.spill_file} сообщений: {len(messages)}, осталось на диске: {remaining}")
+
+    def _read_spilled(self, limit):
+        """
+        Переносит spill_file в файл восстановления (новые сообщения пишутся уже в новый spill_file) и читает
+        из него до limit сообщений; непрочитанные строки переписываются обратно в файл восстановления.
+        Файл восстановления, оставшийся с прошлого раза, читается первым.
+        Повреждённые строки (например, недописанные при падении) пропускаются.
+        Возвращает (файл восстановления или None, сообщения, число сообщений, оставшихся на диске).
+        """
+        restoring_file = f"{self.spill_file}.restoring"
+        with self._spill_lock:
+            if not os.path.exists(restoring_file):
+                if not os.path.exists(self.spill_file):
+                    return None, [], 0
+                os.replace(self.spill_file, restoring_file)
+
+        messages = []
+        remaining = 0
+        rest_file = f"{restoring_file}.tmp"
+        with open(restoring_file, encoding="utf-8") as f, open(rest_file, "w", encoding="utf-8") as rest:
+            for line_number, line in enumerate(f, 1):
+                if len(messages) >= limit:
+                    rest.write(line)
+                    remaining += 1
+                    continue
+                try:
+                    message = json.loads(line)
+                    messages.append((message["queue"], message["body"]))
+                except (ValueError, KeyError, TypeError) as e:
+                    logger.warning(f"Пропущена повреждённая строка {line_number} в {restoring_file}: {e}")
+        if remaining:
+            os.replace(rest_file, restoring_file)
+        else:
+            os.remove(rest_file)
+        return restoring_file, messages, remaining
+
+
+class RabbitMQHandler:
+    """
+    Отправка сообщений в одну очередь через общий RabbitMQPublisher.
+    """
+
+    def __init__(self, publisher: RabbitMQPublisher, queue_name: str):
+        self.publisher = publisher
+        self.queue_name = queue_name
+
+    async def send_to_queue(self, data: str):
+        await self.publisher.publish(self.queue_name, data)
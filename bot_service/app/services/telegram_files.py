@@ -0,0 +1,117 @@
+import asyncio
+import json
+import logging
+import time
+
+import aiohttp
+
+from .http_client import HttpClient
+
+logger = logging.getLogger(__name__)
+
+
+class TelegramFileStore:
+    """
+    file_id фотографий каталога, уже загруженных в Telegram, по (image_path, index_version).
+
+    Повторно найденная кепка отправляется по file_id: без загрузки из сервиса анализа и без повторной
+    выгрузки в Telegram. Новые file_id сохраняются в сервисе базы данных через RabbitMQ, а при первой
+    встрече с версией индекса все известные для неё file_id загружаются оттуда одним запросом.
+    В памяти хранятся только последние keep_versions версий индекса. Неудачная загрузка не кэшируется:
+    следующая попытка — не раньше чем через retry_interval секунд, до тех пор file_id известны только новые.
+    """
+
+    def __init__(self, database_service_url, rabbitmq_handler, keep_versions=2, http_client=None, api_token=None,
+                 retry_interval=30.0):
+        self.database_service_url = database_service_url
+        # Токен API сервиса базы данных (DATABASE_API_TOKEN)
+        self.headers = {"Authorization": f"Bearer {api_token}"} if api_token else {}
+        self.rabbitmq_handler = rabbitmq_handler
+        self.http = http_client or HttpClient(database_service_url, name="database_service")
+        self.keep_versions = keep_versions
+        self.retry_interval = retry_interval
+
+        self._versions = {}
+        # Версии, загрузить которые не удалось: {index_version: (file_id, полученные после неудачи; время неудачи)}
+        self._failed = {}
+        self._lock = asyncio.Lock()
+
+    async def get(self, image_path, index_version):
+        if not index_version:
+            return None
+        file_ids = await self._load_version(index_version)
+        return file_ids.get(image_path)
+
+    async def put(self, image_path, index_version, file_id):
+        if not index_version:
+            return
+        file_ids = await self._load_version(index_version)
+        if file_ids.get(image_path) == file_id:
+            return
+        file_ids[image_path] = file_id
+        await self.rabbitmq_handler.send_to_queue(json.dumps({
+            "image_path": image_path,
+            "index_version": index_version,
+            "file_id": file_id,
+        }))
+
+    async def close(self):
+        await self.http.close()
+
+    def forget(self, image_path, index_version):
+        """
+        Убирает file_id, который Telegram больше не принимает.
+        """
+        self._versions.get(index_version, {}).pop(image_path, None)
+        failed = self._failed.get(index_version)
+        if failed is not None:
+            failed[0].pop(image_path, None)
+
+    async def _load_version(self, index_version):
+        file_ids = self._versions.get(index_version)
+        if file_ids is not None:
+            return file_ids
+
+        async with self._lock:
+            file_ids = self._versions.get(index_version)
+            if file_ids is not None:
+                return file_ids
+            pending, failed_at = self._failed.get(index_version, ({}, None))
+            if failed_at is not None and time.monotonic() - failed_at < self.retry_interval:
+                return pending
+
+            file_ids = await self._fetch(index_version)
+            if file_ids is None:
+                self._failed[index_version] = (pending, time.monotonic())
+                while len(self._failed) > self.keep_versions:
+                    self._failed.pop(next(iter(self._failed)))
+                return pending
+            # file_id, полученные, пока сервис был недоступен, дополняют загруженные
+            file_ids.update(pending)
+            self._failed.pop(index_version, None)
+            self._versions[index_version] = file_ids
+            while len(self._versions) > self.keep_versions:
+                self._versions.pop(next(iter(self._versions)))
+            return file_ids
+
+    async def _fetch(self, index_version):
+        """
+        Загружает file_id версии индекса. Возвращает None, если загрузить не удалось.
+        """
+        if not self.database_service_url:
+            return {}
+
+        async def read_files(resp):
+            if resp.status != 200:
+                logger.warning(f"Не удалось загрузить file_id для индекса {index_version}, код: {resp.status}")
+                return None
+            data = await resp.json()
+            logger.info(f"Загружено {len(data['files'])} file_id для индекса {index_version}")
+            return data["files"]
+
+        try:
+            return await self.http.request("GET", "/api/telegram-files/", read_files,
+                                           params={"index_version": index_version}, headers=self.headers)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.error(f"Ошибка соединения с сервисом базы данных: {e!r}")
+            return None
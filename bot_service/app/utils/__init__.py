@@ -1,2 +1 @@
-from .convert_to_jpg import convert_webp_to_jpg
-from .temp_file import TempFileManager
+from .ttl_cache import TTLCache
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Бот запускается как python app/main.py: его модули импортируются из каталога app
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app"))
@@ -0,0 +1,169 @@
+import asyncio
+
+import aiohttp
+import pytest
+
+from services import http_client
+from services.http_client import CircuitBreaker, CircuitOpenError, HttpClient
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(http_client.time, "monotonic", clock.monotonic)
+    return clock
+
+
+def test_breaker_opens_after_threshold_failures(clock):
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=30)
+    for _ in range(2):
+        breaker.record_failure()
+        assert breaker.state == "closed" and breaker.allow()
+
+    breaker.record_failure()
+    assert breaker.state == "open"
+    assert not breaker.allow()
+
+
+def test_success_resets_failure_count(clock):
+    breaker = CircuitBreaker(failure_threshold=2)
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+
+    assert breaker.state == "closed"
+
+
+def test_half_open_lets_through_a_single_probe(clock):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30)
+    breaker.record_failure()
+    clock.now += 30
+
+    assert breaker.state == "half-open"
+    assert breaker.allow()
+    assert not breaker.allow()
+
+
+def test_successful_probe_closes_the_breaker(clock):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30)
+    breaker.record_failure()
+    clock.now += 30
+    assert breaker.allow()
+
+    breaker.record_success()
+    assert breaker.state == "closed"
+    assert breaker.allow() and breaker.allow()
+
+
+def test_failed_probe_opens_the_breaker_again(clock):
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=30)
+    for _ in range(3):
+        breaker.record_failure()
+    clock.now += 30
+    assert breaker.allow()
+
+    # Одной неудачи пробного запроса достаточно, и отсчёт reset_timeout начинается заново
+    breaker.record_failure()
+    assert breaker.state == "open"
+    clock.now += 29
+    assert not breaker.allow()
+    clock.now += 1
+    assert breaker.allow()
+
+
+def test_released_probe_can_be_taken_again(clock):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30)
+    breaker.record_failure()
+    clock.now += 30
+    assert breaker.allow()
+
+    breaker.release_probe()
+    assert breaker.state == "half-open"
+    assert breaker.allow()
+
+
+class FakeResponse:
+    def __init__(self, status, headers=None):
+        self.status = status
+        self.headers = headers or {}
+        self.reason = "reason"
+        self.request_info = None
+        self.history = ()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+
+class FakeSession:
+    """
+    Сессия aiohttp, отвечающая заранее заданными статусами (или исключениями) по порядку.
+    """
+
+    closed = False
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.calls = 0
+
+    def request(self, method, url, **kwargs):
+        self.calls += 1
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+def make_client(*responses, **kwargs):
+    client = HttpClient("http://service", name="test", backoff=0, **kwargs)
+    client._session = FakeSession(*responses)
+    return client
+
+
+async def read_status(response):
+    return response.status
+
+
+def test_idempotent_request_is_retried_on_gateway_errors():
+    client = make_client(FakeResponse(502), FakeResponse(504), FakeResponse(200))
+
+    assert asyncio.run(client.request("GET", "/", read_status)) == 200
+    assert client._session.calls == 3
+    assert client.circuit_breaker.failures == 0
+
+
+def test_post_is_not_retried_after_it_may_have_been_processed():
+    client = make_client(FakeResponse(504), FakeResponse(200))
+
+    with pytest.raises(aiohttp.ClientResponseError):
+        asyncio.run(client.request("POST", "/search_image", read_status))
+    assert client._session.calls == 1
+    assert client.circuit_breaker.failures == 1
+
+
+def test_post_is_retried_after_503_with_retry_after():
+    client = make_client(FakeResponse(503, {"Retry-After": "0"}), FakeResponse(200))
+
+    assert asyncio.run(client.request("POST", "/search_image", read_status)) == 200
+    assert client._session.calls == 2
+
+
+def test_open_breaker_rejects_requests_without_sending_them():
+    client = make_client(asyncio.TimeoutError(), asyncio.TimeoutError(),
+                         circuit_breaker=CircuitBreaker(failure_threshold=2), retries=1)
+
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(client.request("GET", "/", read_status))
+    with pytest.raises(CircuitOpenError):
+        asyncio.run(client.request("GET", "/", read_status))
+    assert client._session.calls == 2
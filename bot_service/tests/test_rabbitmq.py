@@ -0,0 +1,128 @@
+import asyncio
+import json
+import os
+
+import pytest
+
+from services.rabbitmq import RabbitMQPublisher
+
+
+@pytest.fixture
+def spill_file(tmp_path):
+    return str(tmp_path / "spill" / "rabbitmq_spill.jsonl")
+
+
+def make_publisher(spill_file=None, **kwargs):
+    return RabbitMQPublisher("amqp://localhost", spill_file=spill_file, retry_delay=0, **kwargs)
+
+
+def read_lines(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+async def publish_all(publisher, bodies, queue_name="history"):
+    for body in bodies:
+        await publisher.publish(queue_name, body)
+
+
+def test_messages_over_max_buffer_are_spilled_to_disk(spill_file):
+    publisher = make_publisher(spill_file, max_buffer=2)
+    asyncio.run(publish_all(publisher, ["1", "2", "сообщение 3"]))
+
+    assert list(publisher._buffer) == [("history", "1"), ("history", "2")]
+    assert read_lines(spill_file) == [{"queue": "history", "body": "сообщение 3"}]
+
+
+def test_messages_over_max_buffer_are_dropped_without_spill_file():
+    publisher = make_publisher(max_buffer=1)
+    asyncio.run(publish_all(publisher, ["1", "2"]))
+
+    assert list(publisher._buffer) == [("history", "1")]
+
+
+def test_restore_takes_at_most_free_buffer_space(spill_file):
+    publisher = make_publisher(spill_file, max_buffer=2)
+    publisher._spill([("history", str(number)) for number in range(5)])
+
+    restored = []
+    for expected in (["0", "1"], ["2", "3"], ["4"]):
+        asyncio.run(publisher._restore_spilled())
+        assert [body for _, body in publisher._buffer] == expected
+        restored.extend(publisher._buffer)
+        publisher._buffer.clear()
+
+    assert [body for _, body in restored] == ["0", "1", "2", "3", "4"]
+    assert not os.path.exists(spill_file)
+    assert not os.path.exists(f"{spill_file}.restoring")
+
+
+def test_restore_does_nothing_when_buffer_is_full(spill_file):
+    publisher = make_publisher(spill_file, max_buffer=1)
+    asyncio.run(publish_all(publisher, ["1", "2"]))
+    asyncio.run(publisher._restore_spilled())
+
+    assert list(publisher._buffer) == [("history", "1")]
+    assert len(read_lines(spill_file)) == 1
+
+
+def test_messages_spilled_during_restore_follow_the_older_ones(spill_file):
+    publisher = make_publisher(spill_file, max_buffer=1)
+    publisher._spill([("history", "старое 1"), ("history", "старое 2")])
+    asyncio.run(publisher._restore_spilled())
+    publisher._spill([("history", "новое")])
+
+    bodies = [publisher._buffer.popleft()[1]]
+    for _ in range(2):
+        asyncio.run(publisher._restore_spilled())
+        bodies.append(publisher._buffer.popleft()[1])
+
+    assert bodies == ["старое 1", "старое 2", "новое"]
+
+
+def test_corrupted_lines_are_skipped(spill_file):
+    publisher = make_publisher(spill_file)
+    publisher._spill([("history", "1")])
+    with open(spill_file, "a", encoding="utf-8") as f:
+        f.write('{"queue": "history"}\n{"queue": "hist')
+    asyncio.run(publisher._restore_spilled())
+
+    assert list(publisher._buffer) == [("history", "1")]
+    assert not os.path.exists(f"{spill_file}.restoring")
+
+
+def test_close_spills_unsent_messages(spill_file):
+    publisher = make_publisher(spill_file)
+
+    async def publish_and_close():
+        await publish_all(publisher, ["1", "2"])
+        await publisher.close()
+
+    asyncio.run(publish_and_close())
+
+    assert not publisher._buffer
+    assert [line["body"] for line in read_lines(spill_file)] == ["1", "2"]
+
+
+def test_messages_leave_the_buffer_only_after_confirmed_publish(spill_file):
+    publisher = make_publisher(spill_file, batch_size=2)
+    published = []
+    failures = [ConnectionError("брокер недоступен")]
+
+    async def publish_batch(batch):
+        if failures:
+            raise failures.pop()
+        published.append(list(batch))
+
+    publisher._publish_batch = publish_batch
+
+    async def flush():
+        await publish_all(publisher, ["1", "2", "3"])
+        assert await publisher._flush_once()
+        assert len(publisher._buffer) == 3
+        while publisher._buffer:
+            assert await publisher._flush_once()
+
+    asyncio.run(flush())
+
+    assert published == [[("history", "1"), ("history", "2")], [("history", "3")]]
@@ -1,6 +1,32 @@
 from django.contrib import admin
+from django.core.paginator import Paginator
+from django.db import connection
+from django.utils.functional import cached_property
 
-from .models import MessageHistory, User
+from .models import (AnalysisMatch, CapDailyStats, MessageHistory, ScoreHistogram, TelegramFile, User,
+                     UserDailyStats)
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Пагинатор без COUNT(*) по всей таблице: для списка без фильтров число строк берётся
+    из статистики PostgreSQL (pg_class.reltuples), с фильтрами считается как обычно.
+    """
+
+    @cached_property
+    def count(self):
+        query = self.object_list.query
+        if not query.where and connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "SELECT reltuples::bigint FROM pg_class WHERE relname = %s",
+                    [self.object_list.model._meta.db_table]
+                )
+                row = cursor.fetchone()
+            # reltuples = -1, пока таблица ни разу не анализировалась
+            if row and row[0] > 0:
+                return row[0]
+        return super().count
 
 
 @admin.register(User)
@@ -9,7 +35,70 @@ class UserAdmin(admin.ModelAdmin):
     search_fields = ('telegram_id', 'username')
 
 
+class AnalysisMatchInline(admin.TabularInline):
+    model = AnalysisMatch
+    fields = ('rank', 'cap_name', 'similarity_score', 'image_path')
+    readonly_fields = fields
+    extra = 0
+    can_delete = False
+
+
 @admin.register(MessageHistory)
 class MessageHistoryAdmin(admin.ModelAdmin):
-    list_display = ('user', 'message', 'created_at', 'analysis_result')
-    search_fields = ('user__telegram_id', 'message')
+    list_display = ('user', 'message', 'created_at', 'top_match')
+    list_select_related = ('user',)
+    # Точный поиск по telegram_id идёт по уникальному индексу, а не сканированием таблицы
+    search_fields = ('=user__telegram_id',)
+    raw_id_fields = ('user',)
+    ordering = ('-created_at',)
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    inlines = (AnalysisMatchInline,)
+
+    @admin.display(description='Лучшее совпадение')
+    def top_match(self, obj):
+        results = obj.analysis_result.get('results') if isinstance(obj.analysis_result, dict) else None
+        if not results or not isinstance(results, list) or not isinstance(results[0], dict):
+            return obj.analysis_result.get('message', '—') if isinstance(obj.analysis_result, dict) else '—'
+        return f"{results[0].get('cap_name')} ({results[0].get('similarity_score', 0):.2f})"
+
+
+@admin.register(AnalysisMatch)
+class AnalysisMatchAdmin(admin.ModelAdmin):
+    list_display = ('cap_name', 'similarity_score', 'rank', 'created_at', 'message')
+    list_select_related = ('message__user',)
+    search_fields = ('=cap_name',)
+    raw_id_fields = ('message',)
+    ordering = ('-created_at',)
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+
+@admin.register(TelegramFile)
+class TelegramFileAdmin(admin.ModelAdmin):
+    list_display = ('image_path', 'index_version', 'file_id', 'created_at')
+    search_fields = ('image_path',)
+    list_filter = ('index_version',)
+
+
+@admin.register(CapDailyStats)
+class CapDailyStatsAdmin(admin.ModelAdmin):
+    list_display = ('day', 'cap_name', 'matches', 'top_matches', 'score_sum')
+    search_fields = ('=cap_name',)
+    ordering = ('-day', '-matches')
+    date_hierarchy = 'day'
+
+
+@admin.register(UserDailyStats)
+class UserDailyStatsAdmin(admin.ModelAdmin):
+    list_display = ('day', 'user', 'messages', 'matches')
+    list_select_related = ('user',)
+    search_fields = ('=user__telegram_id',)
+    raw_id_fields = ('user',)
+    ordering = ('-day',)
+
+
+@admin.register(ScoreHistogram)
+class ScoreHistogramAdmin(admin.ModelAdmin):
+    list_display = ('day', 'bucket', 'count')
+    ordering = ('-day', 'bucket')
@@ -0,0 +1,25 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from bot_data.retention import prune_history
+
+
+class Command(BaseCommand):
+    help = "Удаляет историю сообщений старше срока хранения порциями, не блокируя таблицу надолго"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=settings.HISTORY_RETENTION_DAYS,
+                            help="срок хранения в днях (по умолчанию HISTORY_RETENTION_DAYS)")
+        parser.add_argument('--batch-size', type=int, default=5000)
+
+    def handle(self, *args, **options):
+        days = options['days']
+        if not days:
+            self.stdout.write("Срок хранения не задан, очистка пропущена.")
+            return
+
+        deleted = prune_history(timezone.now() - timedelta(days=days), options['batch_size'])
+        self.stdout.write(f"Удалено сообщений старше {days} дней: {deleted}")
@@ -0,0 +1,128 @@
+import ast
+import json
+
+import django.db.models.deletion
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+BATCH_SIZE = 5000
+
+
+def parse_text_result(value):
+    """
+    Раньше в TextField попадал repr словаря Python, а не JSON.
+    """
+    if not value:
+        return {}
+    try:
+        return json.loads(value)
+    except ValueError:
+        pass
+    try:
+        return ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        return {'raw': value}
+
+
+def iterate_batches(queryset):
+    last_pk = 0
+    while True:
+        rows = list(queryset.filter(pk__gt=last_pk).order_by('pk')[:BATCH_SIZE])
+        if not rows:
+            return
+        yield rows
+        last_pk = rows[-1].pk
+
+
+def convert_results(apps, schema_editor):
+    MessageHistory = apps.get_model('bot_data', 'MessageHistory')
+    for rows in iterate_batches(MessageHistory.objects.only('pk', 'analysis_result')):
+        for row in rows:
+            row.analysis_result_json = parse_text_result(row.analysis_result)
+        MessageHistory.objects.bulk_update(rows, ['analysis_result_json'])
+
+
+def restore_text_results(apps, schema_editor):
+    MessageHistory = apps.get_model('bot_data', 'MessageHistory')
+    for rows in iterate_batches(MessageHistory.objects.only('pk', 'analysis_result_json')):
+        for row in rows:
+            row.analysis_result = json.dumps(row.analysis_result_json, ensure_ascii=False)
+        MessageHistory.objects.bulk_update(rows, ['analysis_result'])
+
+
+def populate_matches(apps, schema_editor):
+    MessageHistory = apps.get_model('bot_data', 'MessageHistory')
+    AnalysisMatch = apps.get_model('bot_data', 'AnalysisMatch')
+    for rows in iterate_batches(MessageHistory.objects.only('pk', 'created_at', 'analysis_result')):
+        matches = []
+        for row in rows:
+            result = row.analysis_result
+            if not isinstance(result, dict) or result.get('status') != 'ok':
+                continue
+            for rank, item in enumerate(result.get('results') or [], start=1):
+                if not isinstance(item, dict) or not item.get('cap_name'):
+                    continue
+                matches.append(AnalysisMatch(
+                    message_id=row.pk,
+                    rank=rank,
+                    cap_name=str(item['cap_name'])[:255],
+                    similarity_score=float(item.get('similarity_score') or 0.0),
+                    image_path=str(item.get('image_path') or '')[:1024],
+                    created_at=row.created_at,
+                ))
+        AnalysisMatch.objects.bulk_create(matches, ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+    # Данные переносятся порциями с отдельными коммитами, а индексы на большой таблице
+    # строятся CONCURRENTLY, не блокируя запись из consumer
+    atomic = False
+
+    dependencies = [
+        ('bot_data', '0002_telegramfile'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='messagehistory',
+            name='analysis_result_json',
+            field=models.JSONField(default=dict),
+        ),
+        migrations.RunPython(convert_results, restore_text_results),
+        migrations.RemoveField(
+            model_name='messagehistory',
+            name='analysis_result',
+        ),
+        migrations.RenameField(
+            model_name='messagehistory',
+            old_name='analysis_result_json',
+            new_name='analysis_result',
+        ),
+        AddIndexConcurrently(
+            model_name='messagehistory',
+            index=models.Index(fields=['created_at'], name='history_created_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='messagehistory',
+            index=models.Index(fields=['user', '-created_at'], name='history_user_created_idx'),
+        ),
+        migrations.CreateModel(
+            name='AnalysisMatch',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('rank', models.PositiveSmallIntegerField()),
+                ('cap_name', models.CharField(max_length=255)),
+                ('similarity_score', models.FloatField()),
+                ('image_path', models.CharField(blank=True, max_length=1024)),
+                ('created_at', models.DateTimeField(db_index=True)),
+                ('message', models.ForeignKey(
+                    on_delete=django.db.models.deletion.CASCADE, related_name='matches', to='bot_data.messagehistory'
+                )),
+            ],
+            options={
+                'indexes': [models.Index(fields=['cap_name', '-created_at'], name='match_cap_created_idx')],
+                'constraints': [models.UniqueConstraint(fields=('message', 'rank'), name='unique_match_rank')],
+            },
+        ),
+        migrations.RunPython(populate_matches, migrations.RunPython.noop),
+    ]
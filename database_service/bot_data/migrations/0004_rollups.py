@@ -0,0 +1,109 @@
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count, F, FloatField, Q, Sum, Value
+from django.db.models.functions import Cast, Floor, Greatest, Least, TruncDate
+
+BATCH_SIZE = 5000
+SCORE_BUCKETS = 20
+
+
+def bulk_insert(model, rows):
+    batch = []
+    for row in rows:
+        batch.append(model(**row))
+        if len(batch) >= BATCH_SIZE:
+            model.objects.bulk_create(batch)
+            batch = []
+    model.objects.bulk_create(batch)
+
+
+def backfill_rollups(apps, schema_editor):
+    """
+    Считает агрегаты по уже накопленной истории; дальше consumer обновляет их инкрементально.
+    """
+    MessageHistory = apps.get_model('bot_data', 'MessageHistory')
+    AnalysisMatch = apps.get_model('bot_data', 'AnalysisMatch')
+    CapDailyStats = apps.get_model('bot_data', 'CapDailyStats')
+    UserDailyStats = apps.get_model('bot_data', 'UserDailyStats')
+    ScoreHistogram = apps.get_model('bot_data', 'ScoreHistogram')
+
+    bulk_insert(CapDailyStats, (
+        AnalysisMatch.objects.annotate(day=TruncDate('created_at')).values('day', 'cap_name')
+        .annotate(matches=Count('id'), top_matches=Count('id', filter=Q(rank=1)), score_sum=Sum('similarity_score'))
+        .order_by().iterator()
+    ))
+
+    matches_per_user_day = {
+        (row['message__user'], row['day']): row['matches']
+        for row in AnalysisMatch.objects.annotate(day=TruncDate('created_at')).values('message__user', 'day')
+        .annotate(matches=Count('id')).order_by().iterator()
+    }
+    bulk_insert(UserDailyStats, (
+        {
+            'user_id': row['user'],
+            'day': row['day'],
+            'messages': row['messages'],
+            'matches': matches_per_user_day.get((row['user'], row['day']), 0),
+        }
+        for row in MessageHistory.objects.annotate(day=TruncDate('created_at')).values('user', 'day')
+        .annotate(messages=Count('id')).order_by().iterator()
+    ))
+
+    clamped = Least(Greatest(F('similarity_score'), Value(0.0)), Value(1.0 - 1e-9))
+    bulk_insert(ScoreHistogram, (
+        AnalysisMatch.objects.annotate(
+            day=TruncDate('created_at'),
+            bucket=Cast(Floor(clamped * Value(float(SCORE_BUCKETS), output_field=FloatField())),
+                        models.IntegerField()),
+        ).values('day', 'bucket').annotate(count=Count('id')).order_by().iterator()
+    ))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot_data', '0003_structured_history'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CapDailyStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('cap_name', models.CharField(max_length=255)),
+                ('matches', models.PositiveIntegerField(default=0)),
+                ('top_matches', models.PositiveIntegerField(default=0)),
+                ('score_sum', models.FloatField(default=0.0)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('day', 'cap_name'), name='unique_cap_day')],
+            },
+        ),
+        migrations.CreateModel(
+            name='UserDailyStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('messages', models.PositiveIntegerField(default=0)),
+                ('matches', models.PositiveIntegerField(default=0)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='bot_data.user')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('user', 'day'), name='unique_user_day')],
+            },
+        ),
+        migrations.CreateModel(
+            name='ScoreHistogram',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('bucket', models.PositiveSmallIntegerField()),
+                ('count', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('day', 'bucket'), name='unique_score_bucket')],
+            },
+        ),
+        migrations.RunPython(backfill_rollups, migrations.RunPython.noop),
+    ]
@@ -13,7 +13,106 @@ class MessageHistory(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     message = models.TextField()
     created_at = models.DateTimeField(auto_now_add=True)
-    analysis_result = models.TextField()
+    analysis_result = models.JSONField(default=dict)
+
+    class Meta:
+        indexes = [
+            # Очистка старой истории и выборки за период
+            models.Index(fields=['created_at'], name='history_created_idx'),
+            # История пользователя: фильтр по user и сортировка по времени одним индексом
+            models.Index(fields=['user', '-created_at'], name='history_user_created_idx'),
+        ]
 
     def __str__(self):
         return f"Message from {self.user.username or self.user.telegram_id}"
+
+
+class AnalysisMatch(models.Model):
+    """
+    Одна найденная кепка из результата анализа: отдельная строка, чтобы запросы по группам кепок
+    и оценкам не разбирали JSON каждой записи истории.
+    """
+    message = models.ForeignKey(MessageHistory, on_delete=models.CASCADE, related_name='matches')
+    rank = models.PositiveSmallIntegerField()
+    cap_name = models.CharField(max_length=255)
+    similarity_score = models.FloatField()
+    image_path = models.CharField(max_length=1024, blank=True)
+    created_at = models.DateTimeField(db_index=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['cap_name', '-created_at'], name='match_cap_created_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['message', 'rank'], name='unique_match_rank'),
+        ]
+
+    def __str__(self):
+        return f"{self.cap_name} ({self.similarity_score:.2f})"
+
+
+class TelegramFile(models.Model):
+    """
+    file_id фотографии каталога, уже загруженной ботом в Telegram.
+    Действителен для изображения image_path в версии индекса index_version.
+    """
+    image_path = models.CharField(max_length=1024)
+    index_version = models.CharField(max_length=64)
+    file_id = models.CharField(max_length=255)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['image_path', 'index_version'], name='unique_telegram_file'),
+        ]
+
+    def __str__(self):
+        return f"{self.image_path} ({self.index_version})"
+
+
+class CapDailyStats(models.Model):
+    """
+    Сколько раз группа кепок попала в результаты за день (и сколько раз — первой), сумма оценок.
+    Обновляется consumer в той же транзакции, что и вставка истории.
+    """
+    day = models.DateField()
+    cap_name = models.CharField(max_length=255)
+    matches = models.PositiveIntegerField(default=0)
+    top_matches = models.PositiveIntegerField(default=0)
+    score_sum = models.FloatField(default=0.0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['day', 'cap_name'], name='unique_cap_day'),
+        ]
+
+
+class UserDailyStats(models.Model):
+    """
+    Активность пользователя за день: число запросов и найденных кепок.
+    """
+    day = models.DateField()
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    messages = models.PositiveIntegerField(default=0)
+    matches = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'day'], name='unique_user_day'),
+        ]
+
+
+class ScoreHistogram(models.Model):
+    """
+    Распределение оценок схожести за день: bucket — номер интервала ширины 1 / SCORE_BUCKETS.
+    """
+    SCORE_BUCKETS = 20
+
+    day = models.DateField()
+    bucket = models.PositiveSmallIntegerField()
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['day', 'bucket'], name='unique_score_bucket'),
+        ]
@@ -0,0 +1,22 @@
+def extract_matches(analysis_result):
+    """
+    Найденные кепки из результата анализа в порядке выдачи: словари с rank, cap_name,
+    similarity_score и image_path. Для ошибок анализа и результатов без кепок — пустой список.
+    """
+    if not isinstance(analysis_result, dict) or analysis_result.get('status') != 'ok':
+        return []
+    results = analysis_result.get('results')
+    if not isinstance(results, list):
+        return []
+
+    matches = []
+    for rank, result in enumerate(results, start=1):
+        if not isinstance(result, dict) or not result.get('cap_name'):
+            continue
+        matches.append({
+            'rank': rank,
+            'cap_name': str(result['cap_name'])[:255],
+            'similarity_score': float(result.get('similarity_score') or 0.0),
+            'image_path': str(result.get('image_path') or '')[:1024],
+        })
+    return matches
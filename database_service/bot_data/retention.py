@@ -0,0 +1,18 @@
+from .models import MessageHistory
+
+
+def prune_history(cutoff, batch_size=5000):
+    """
+    Удаляет сообщения (и их найденные кепки) старше cutoff порциями по индексам created_at.
+    """
+    deleted = 0
+    while True:
+        ids = list(
+            MessageHistory.objects.filter(created_at__lt=cutoff).order_by('created_at')
+            .values_list('pk', flat=True)[:batch_size]
+        )
+        if not ids:
+            return deleted
+        # Найденные кепки удаляются тем же запросом каскада (без сигналов Django удаляет их одним DELETE)
+        MessageHistory.objects.filter(pk__in=ids).delete()
+        deleted += len(ids)
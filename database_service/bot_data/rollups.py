@@ -0,0 +1,69 @@
+from collections import defaultdict
+
+from django.db import connection
+
+from .models import CapDailyStats, ScoreHistogram, UserDailyStats
+
+
+def score_bucket(score):
+    clamped = min(max(score, 0.0), 1.0 - 1e-9)
+    return int(clamped * ScoreHistogram.SCORE_BUCKETS)
+
+
+def increment_counters(model, key_fields, counters):
+    """
+    Прибавляет счётчики к строкам агрегатной таблицы одним INSERT ... ON CONFLICT DO UPDATE.
+    counters — {ключ (значения key_fields): {поле: приращение}}; все словари с одинаковым набором полей.
+    Строки вставляются в порядке ключей, чтобы параллельные транзакции не блокировали друг друга крест-накрест.
+    """
+    if not counters:
+        return
+    quote = connection.ops.quote_name
+    table = quote(model._meta.db_table)
+    counter_fields = list(next(iter(counters.values())))
+    key_columns = [model._meta.get_field(field).column for field in key_fields]
+    counter_columns = [model._meta.get_field(field).column for field in counter_fields]
+
+    columns = ", ".join(quote(column) for column in key_columns + counter_columns)
+    row = "(" + ", ".join(["%s"] * (len(key_columns) + len(counter_columns))) + ")"
+    updates = ", ".join(f"{quote(column)} = {table}.{quote(column)} + EXCLUDED.{quote(column)}"
+                        for column in counter_columns)
+    params = []
+    for key in sorted(counters):
+        params.extend(key)
+        params.extend(counters[key][field] for field in counter_fields)
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"INSERT INTO {table} ({columns}) VALUES {', '.join([row] * len(counters))} "
+            f"ON CONFLICT ({', '.join(quote(column) for column in key_columns)}) DO UPDATE SET {updates}",
+            params
+        )
+
+
+def update_rollups(history, matches):
+    """
+    Обновляет дневные агрегаты по только что вставленным сообщениям и найденным кепкам.
+    Вызывается внутри транзакции вставки, поэтому агрегаты всегда согласованы с историей.
+    """
+    days = {row.pk: row.created_at.date() for row in history}
+
+    users = defaultdict(lambda: {'messages': 0, 'matches': 0})
+    for row in history:
+        users[(row.user_id, days[row.pk])]['messages'] += 1
+
+    caps = defaultdict(lambda: {'matches': 0, 'top_matches': 0, 'score_sum': 0.0})
+    scores = defaultdict(lambda: {'count': 0})
+    user_of_message = {row.pk: row.user_id for row in history}
+    for match in matches:
+        day = days[match.message_id]
+        cap = caps[(day, match.cap_name)]
+        cap['matches'] += 1
+        cap['top_matches'] += match.rank == 1
+        cap['score_sum'] += match.similarity_score
+        scores[(day, score_bucket(match.similarity_score))]['count'] += 1
+        users[(user_of_message[match.message_id], day)]['matches'] += 1
+
+    increment_counters(CapDailyStats, ['day', 'cap_name'], caps)
+    increment_counters(UserDailyStats, ['user', 'day'], users)
+    increment_counters(ScoreHistogram, ['day', 'bucket'], scores)
@@ -0,0 +1,211 @@
+import base64
+import hmac
+import json
+from datetime import datetime, timedelta
+from functools import wraps
+
+from django.conf import settings
+from django.db.models import Q, Sum
+from django.http import JsonResponse
+from django.shortcuts import get_object_or_404
+from django.utils import timezone
+from django.views.decorators.http import require_GET
+
+from .models import CapDailyStats, MessageHistory, ScoreHistogram, TelegramFile, User, UserDailyStats
+
+HISTORY_PAGE_SIZE = 50
+MAX_HISTORY_PAGE_SIZE = 200
+MAX_STATS_DAYS = 366
+
+
+def api_auth_required(view):
+    """
+    Пропускает к API только сервисы с токеном API_TOKEN (Authorization: Bearer) и сотрудников,
+    вошедших через админку. Остальным отвечает 401.
+    """
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+        token_valid = (
+            settings.API_TOKEN and scheme.lower() == 'bearer'
+            and hmac.compare_digest(token.encode(), settings.API_TOKEN.encode())
+        )
+        if not token_valid and not (request.user.is_authenticated and request.user.is_staff):
+            return JsonResponse({'error': 'Требуется авторизация'}, status=401)
+        return view(request, *args, **kwargs)
+    return wrapper
+
+
+def int_param(request, name, default, maximum):
+    """
+    Целый положительный query-параметр не больше maximum; ValueError, если передан не числом.
+    """
+    value = int(request.GET.get(name, default))
+    if value < 1:
+        raise ValueError(name)
+    return min(value, maximum)
+
+
+def encode_cursor(row):
+    raw = json.dumps([row.created_at.isoformat(), row.pk])
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor):
+    created_at, pk = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    return datetime.fromisoformat(created_at), int(pk)
+
+
+def since(days):
+    return timezone.now().date() - timedelta(days=days - 1)
+
+
+@require_GET
+@api_auth_required
+def telegram_files(request):
+    """
+    file_id фотографий каталога, уже загруженных в Telegram, для одной версии индекса.
+    """
+    index_version = request.GET.get('index_version')
+    if not index_version:
+        return JsonResponse({'error': 'Не указан index_version'}, status=400)
+
+    files = dict(
+        TelegramFile.objects.filter(index_version=index_version).values_list('image_path', 'file_id')
+    )
+    return JsonResponse({'index_version': index_version, 'files': files})
+
+
+@require_GET
+@api_auth_required
+def history(request):
+    """
+    История запросов от новых к старым с постраничной выдачей по курсору.
+
+    Страница продолжается с (created_at, id) последней строки предыдущей, поэтому запрос идёт по индексу
+    и не зависит от глубины страницы, в отличие от OFFSET. ?user=<telegram_id> — история одного пользователя.
+    """
+    try:
+        limit = int_param(request, 'limit', HISTORY_PAGE_SIZE, MAX_HISTORY_PAGE_SIZE)
+        cursor = request.GET.get('cursor')
+        position = decode_cursor(cursor) if cursor else None
+        telegram_id = request.GET.get('user')
+        telegram_id = int(telegram_id) if telegram_id else None
+    except (ValueError, TypeError):
+        return JsonResponse({'error': 'Некорректные параметры запроса'}, status=400)
+
+    rows = MessageHistory.objects.select_related('user').prefetch_related('matches').order_by('-created_at', '-id')
+    if telegram_id is not None:
+        rows = rows.filter(user__telegram_id=telegram_id)
+    if position is not None:
+        created_at, pk = position
+        rows = rows.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=pk))
+
+    page = list(rows[:limit + 1])
+    has_more = len(page) > limit
+    page = page[:limit]
+    return JsonResponse({
+        'results': [
+            {
+                'id': row.pk,
+                'telegram_id': row.user.telegram_id,
+                'username': row.user.username,
+                'message': row.message,
+                'created_at': row.created_at.isoformat(),
+                'matches': [
+                    {
+                        'rank': match.rank,
+                        'cap_name': match.cap_name,
+                        'similarity_score': match.similarity_score,
+                        'image_path': match.image_path,
+                    }
+                    for match in sorted(row.matches.all(), key=lambda match: match.rank)
+                ],
+            }
+            for row in page
+        ],
+        'next_cursor': encode_cursor(page[-1]) if has_more else None,
+    })
+
+
+@require_GET
+@api_auth_required
+def cap_stats(request):
+    """
+    Самые частые группы кепок за последние days дней по дневным агрегатам.
+    """
+    try:
+        days = int_param(request, 'days', 7, MAX_STATS_DAYS)
+        limit = int_param(request, 'limit', 20, 1000)
+    except ValueError:
+        return JsonResponse({'error': 'Некорректные параметры запроса'}, status=400)
+
+    caps = (
+        CapDailyStats.objects.filter(day__gte=since(days))
+        .values('cap_name')
+        .annotate(total_matches=Sum('matches'), total_top_matches=Sum('top_matches'), total_score=Sum('score_sum'))
+        .order_by('-total_matches', 'cap_name')[:limit]
+    )
+    return JsonResponse({
+        'days': days,
+        'caps': [
+            {
+                'cap_name': cap['cap_name'],
+                'matches': cap['total_matches'],
+                'top_matches': cap['total_top_matches'],
+                'average_score': cap['total_score'] / cap['total_matches'] if cap['total_matches'] else None,
+            }
+            for cap in caps
+        ],
+    })
+
+
+@require_GET
+@api_auth_required
+def user_stats(request, telegram_id):
+    """
+    Активность пользователя по дням за последние days дней.
+    """
+    try:
+        days = int_param(request, 'days', 30, MAX_STATS_DAYS)
+    except ValueError:
+        return JsonResponse({'error': 'Некорректные параметры запроса'}, status=400)
+
+    user = get_object_or_404(User, telegram_id=telegram_id)
+    rows = list(
+        UserDailyStats.objects.filter(user=user, day__gte=since(days))
+        .order_by('day').values('day', 'messages', 'matches')
+    )
+    return JsonResponse({
+        'telegram_id': user.telegram_id,
+        'username': user.username,
+        'days': days,
+        'messages': sum(row['messages'] for row in rows),
+        'matches': sum(row['matches'] for row in rows),
+        'daily': [{**row, 'day': row['day'].isoformat()} for row in rows],
+    })
+
+
+@require_GET
+@api_auth_required
+def score_stats(request):
+    """
+    Распределение оценок схожести за последние days дней: число совпадений в каждом интервале.
+    """
+    try:
+        days = int_param(request, 'days', 7, MAX_STATS_DAYS)
+    except ValueError:
+        return JsonResponse({'error': 'Некорректные параметры запроса'}, status=400)
+
+    counts = dict(
+        ScoreHistogram.objects.filter(day__gte=since(days))
+        .values('bucket').annotate(total=Sum('count')).values_list('bucket', 'total')
+    )
+    width = 1 / ScoreHistogram.SCORE_BUCKETS
+    return JsonResponse({
+        'days': days,
+        'buckets': [
+            {'from': round(bucket * width, 4), 'to': round((bucket + 1) * width, 4), 'count': counts.get(bucket, 0)}
+            for bucket in range(ScoreHistogram.SCORE_BUCKETS)
+        ],
+    })
@@ -1,6 +1,7 @@
 import os
 from pathlib import Path
 
+from django.core.exceptions import ImproperlyConfigured
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -103,3 +104,12 @@ STATIC_URL = '/static/'
 
 # Конфигурация RabbitMQ
 RABBITMQ_URL = os.getenv("RABBITMQ_URL")
+
+# Токен доступа к JSON API (/api/...): заголовок "Authorization: Bearer <токен>"; тот же токен отправляет бот.
+# Без токена сервис не запускается, иначе бот молча получал бы 401 на каждый запрос
+API_TOKEN = os.getenv("DATABASE_API_TOKEN", "")
+if not API_TOKEN:
+    raise ImproperlyConfigured("Не задан DATABASE_API_TOKEN: токен доступа к API сервиса базы данных")
+
+# Срок хранения истории сообщений в днях (0 — хранить бессрочно), см. команду prune_history
+HISTORY_RETENTION_DAYS = int(os.getenv("HISTORY_RETENTION_DAYS", "0"))
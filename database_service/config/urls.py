@@ -1,6 +1,13 @@
 from django.contrib import admin
 from django.urls import path
 
+from bot_data import views
+
 urlpatterns = [
     path('admin/', admin.site.urls),
+    path('api/telegram-files/', views.telegram_files, name='telegram_files'),
+    path('api/history/', views.history, name='history'),
+    path('api/stats/caps/', views.cap_stats, name='cap_stats'),
+    path('api/stats/users/<int:telegram_id>/', views.user_stats, name='user_stats'),
+    path('api/stats/scores/', views.score_stats, name='score_stats'),
 ]
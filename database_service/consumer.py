@@ -1,58 +1,342 @@
 import asyncio
 import html
 import json
+import logging
 import os
+import time
+from datetime import timedelta
 
 import aio_pika
 import django
 from asgiref.sync import sync_to_async
 from dotenv import load_dotenv
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 RABBITMQ_URL = os.getenv("RABBITMQ_URL")
 
+# Сколько неподтверждённых сообщений брокер отдаёт потребителю заранее
+PREFETCH_COUNT = int(os.getenv("CONSUMER_PREFETCH_COUNT", "500"))
+# Сообщения сохраняются порциями: до BATCH_SIZE штук или раз в BATCH_TIMEOUT секунд
+BATCH_SIZE = int(os.getenv("CONSUMER_BATCH_SIZE", "200"))
+BATCH_TIMEOUT = float(os.getenv("CONSUMER_BATCH_TIMEOUT", "0.5"))
+# Пауза перед повторной доставкой порции, если база данных недоступна
+RETRY_DELAY = float(os.getenv("CONSUMER_RETRY_DELAY", "5"))
+# Сколько раз сообщение, которое база не принимает (при доступной базе), пробуется сохранить до очереди ошибок
+MAX_ATTEMPTS = int(os.getenv("CONSUMER_MAX_ATTEMPTS", "5"))
+# Заголовок с числом неудачных попыток сохранить сообщение
+ATTEMPTS_HEADER = "x-attempts"
+PRUNE_INTERVAL = float(os.getenv("HISTORY_PRUNE_INTERVAL", "3600"))
+# Порт HTTP сервера метрик Prometheus (0 — метрики не отдаются)
+METRICS_PORT = int(os.getenv("CONSUMER_METRICS_PORT", "9101"))
+
+CONSUMED = Counter('consumer_messages', "Сохранённые сообщения", ['queue'])
+DEAD_LETTERED = Counter('consumer_dead_lettered', "Сообщения, отправленные в очередь ошибок", ['queue'])
+FAILED_BATCHES = Counter('consumer_failed_batches', "Порции, возвращённые в очередь для повтора", ['queue'])
+BATCH_MESSAGES = Histogram('consumer_batch_size', "Сообщений в порции", ['queue'],
+                           buckets=(1, 5, 10, 25, 50, 100, 200, 500, 1000))
+COMMIT_SECONDS = Histogram('consumer_commit_seconds', "Время сохранения порции (транзакция до commit)", ['queue'],
+                           buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0))
+PENDING = Gauge('consumer_pending_messages', "Полученные от брокера, но ещё не сохранённые сообщения", ['queue'])
+PRUNED = Counter('consumer_pruned_history', "Удалённые по сроку хранения сообщения истории")
+
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
 django.setup()
 
-from bot_data.models import MessageHistory, User
+from django.conf import settings  # noqa: E402
+from django.db import connection as db_connection  # noqa: E402
+from django.db import transaction  # noqa: E402
+from django.utils import timezone  # noqa: E402
 
+from bot_data.models import AnalysisMatch, MessageHistory, TelegramFile, User  # noqa: E402
+from bot_data.results import extract_matches  # noqa: E402
+from bot_data.retention import prune_history  # noqa: E402
+from bot_data.rollups import update_rollups  # noqa: E402
+
+# telegram_id -> id пользователя в базе, чтобы не искать пользователя на каждое сообщение
+user_ids = {}
 
-async def save_message_to_db(telegram_id, username, text, analysis_result):
-    # Используем sync_to_async для работы с базой данных
-    user, _ = await sync_to_async(User.objects.get_or_create)(
-        telegram_id=telegram_id, defaults={"username": username}
-    )
 
+def parse_message(data):
     decoded_result = {k: html.unescape(v) if isinstance(v, str) else v
-                      for k, v in analysis_result.items()}
-    await MessageHistory.objects.acreate(
-        user=user,
-        message=text,
-        analysis_result=decoded_result
+                      for k, v in data["analysis_result"].items()}
+    return {
+        "telegram_id": int(data["telegram_id"]),
+        "username": data["username"],
+        "message": data["message"],
+        "analysis_result": decoded_result,
+    }
+
+
+def resolve_user_ids(messages):
+    """
+    Находит или создаёт пользователей порции двумя запросами и кладёт их id в кэш.
+    """
+    usernames = {message["telegram_id"]: message["username"] for message in messages}
+    missing = [telegram_id for telegram_id in usernames if telegram_id not in user_ids]
+    if not missing:
+        return
+
+    user_ids.update(User.objects.filter(telegram_id__in=missing).values_list("telegram_id", "id"))
+    new_users = [
+        User(telegram_id=telegram_id, username=usernames[telegram_id])
+        for telegram_id in missing if telegram_id not in user_ids
+    ]
+    if new_users:
+        User.objects.bulk_create(new_users, ignore_conflicts=True)
+        user_ids.update(
+            User.objects.filter(telegram_id__in=[user.telegram_id for user in new_users])
+            .values_list("telegram_id", "id")
+        )
+
+
+def save_messages_to_db(messages):
+    """
+    Сохраняет порцию сообщений одной транзакцией.
+    """
+    try:
+        with transaction.atomic():
+            resolve_user_ids(messages)
+            history = MessageHistory.objects.bulk_create([
+                MessageHistory(
+                    user_id=user_ids[message["telegram_id"]],
+                    message=message["message"],
+                    analysis_result=message["analysis_result"]
+                )
+                for message in messages
+            ])
+            # Найденные кепки — отдельными строками для запросов по группам и оценкам
+            matches = AnalysisMatch.objects.bulk_create([
+                AnalysisMatch(message_id=row.pk, created_at=row.created_at, **match)
+                for row in history
+                for match in extract_matches(row.analysis_result)
+            ])
+            # Дневные агрегаты обновляются в той же транзакции, что и сама история
+            update_rollups(history, matches)
+    except Exception:
+        # Пользователи, созданные в откатившейся транзакции, не существуют
+        user_ids.clear()
+        raise
+
+
+def database_available():
+    """
+    Проверяет, что база данных отвечает: отличает недоступную базу от сообщений, которые база не принимает.
+    """
+    try:
+        db_connection.close_if_unusable_or_obsolete()
+        with db_connection.cursor() as cursor:
+            cursor.execute("SELECT 1")
+    except Exception:
+        return False
+    return True
+
+
+def prune_old_history():
+    return prune_history(timezone.now() - timedelta(days=settings.HISTORY_RETENTION_DAYS))
+
+
+async def retention_loop():
+    """
+    Раз в PRUNE_INTERVAL секунд удаляет историю старше HISTORY_RETENTION_DAYS (если срок задан).
+    """
+    if not settings.HISTORY_RETENTION_DAYS:
+        return
+    while True:
+        try:
+            deleted = await sync_to_async(prune_old_history)()
+            PRUNED.inc(deleted)
+            if deleted:
+                logger.info(f"Удалено старых сообщений истории: {deleted}")
+        except Exception as e:
+            logger.error(f"Ошибка очистки истории: {e}")
+        await asyncio.sleep(PRUNE_INTERVAL)
+
+
+def parse_telegram_file(data):
+    return {"image_path": data["image_path"], "index_version": data["index_version"], "file_id": data["file_id"]}
+
+
+def save_telegram_files_to_db(files):
+    # В одной вставке с update_conflicts ключ не может повторяться: остаётся последний file_id
+    files = {(file["image_path"], file["index_version"]): file for file in files}
+    TelegramFile.objects.bulk_create(
+        [TelegramFile(**file) for file in files.values()],
+        update_conflicts=True,
+        unique_fields=["image_path", "index_version"],
+        update_fields=["file_id"]
     )
 
 
+class BatchConsumer:
+    """
+    Потребитель очереди, сохраняющий сообщения порциями.
+
+    Сообщения копятся до batch_size штук или batch_timeout секунд и сохраняются одним вызовом save
+    (в потоке Django). Подтверждение брокеру отправляется одним ack на всю порцию и только после commit;
+    если база недоступна, порция возвращается в очередь. Сообщения, которые не удаётся разобрать,
+    перекладываются в очередь "<queue>.dlq" и больше не доставляются. Сообщения, которые доступная база
+    не принимает, публикуются в очередь заново со счётчиком попыток ATTEMPTS_HEADER и после max_attempts
+    попыток тоже уходят в очередь ошибок.
+    """
+
+    def __init__(self, connection, queue_name, parse, save, batch_size=BATCH_SIZE, batch_timeout=BATCH_TIMEOUT,
+                 max_attempts=MAX_ATTEMPTS, retry_delay=RETRY_DELAY):
+        self.connection = connection
+        self.queue_name = queue_name
+        self.dead_letter_queue = f"{queue_name}.dlq"
+        self.parse = parse
+        self.save = sync_to_async(save)
+        self.batch_size = batch_size
+        self.batch_timeout = batch_timeout
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.database_available = sync_to_async(database_available)
+        self._incoming = asyncio.Queue()
+        PENDING.labels(queue_name).set_function(self._incoming.qsize)
+
+    async def run(self):
+        # Отдельный канал на очередь: ack с multiple=True подтверждает только сообщения этой очереди.
+        # Подтверждения публикации нужны очереди ошибок: исходное сообщение подтверждается, только когда брокер
+        # принял его копию в "<queue>.dlq"
+        self.channel = await self.connection.channel(publisher_confirms=True)
+        await self.channel.set_qos(prefetch_count=PREFETCH_COUNT)
+        queue = await self.channel.declare_queue(self.queue_name, durable=True)
+        await self.channel.declare_queue(self.dead_letter_queue, durable=True)
+        await queue.consume(self._incoming.put)
+
+        while True:
+            batch = await self._collect_batch()
+            await self._process_batch(batch)
+
+    async def _collect_batch(self):
+        batch = [await self._incoming.get()]
+        deadline = asyncio.get_running_loop().time() + self.batch_timeout
+        while len(batch) < self.batch_size:
+            timeout = deadline - asyncio.get_running_loop().time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._incoming.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _process_batch(self, batch):
+        parsed, delivered = [], []
+        for message in batch:
+            try:
+                parsed.append(self.parse(json.loads(message.body.decode())))
+                delivered.append(message)
+            except (ValueError, KeyError, TypeError, AttributeError) as e:
+                await self._dead_letter(message, e)
+        if not delivered:
+            return
+
+        BATCH_MESSAGES.labels(self.queue_name).observe(len(parsed))
+        try:
+            started = time.perf_counter()
+            await self.save(parsed)
+            COMMIT_SECONDS.labels(self.queue_name).observe(time.perf_counter() - started)
+        except Exception as e:
+            logger.error(f"Не удалось сохранить порцию из {len(parsed)} сообщений {self.queue_name}: {e}")
+            saved, failed = await self._save_one_by_one(parsed, delivered)
+            if not saved:
+                FAILED_BATCHES.labels(self.queue_name).inc()
+                await asyncio.sleep(self.retry_delay)
+                if not await self.database_available():
+                    # База недоступна: порция повторяется целиком, попытки сообщений не считаются
+                    await delivered[-1].nack(multiple=True, requeue=True)
+                    return
+                for message, error in failed:
+                    await self._retry_or_dead_letter(message, error)
+                return
+            for message, error in failed:
+                await self._dead_letter(message, error)
+            delivered = saved
+
+        await delivered[-1].ack(multiple=True)
+        CONSUMED.labels(self.queue_name).inc(len(delivered))
+
+    async def _save_one_by_one(self, parsed, delivered):
+        """
+        Сохраняет сообщения порции по одному, чтобы отделить сообщение, которое база не принимает.
+        Возвращает (сохранённые сообщения, [(несохранённое сообщение, ошибка), ...]).
+        """
+        saved, failed = [], []
+        for data, message in zip(parsed, delivered):
+            try:
+                await self.save([data])
+                saved.append(message)
+            except Exception as e:
+                failed.append((message, e))
+        return saved, failed
+
+    async def _retry_or_dead_letter(self, message, error):
+        """
+        Публикует сообщение в очередь заново с увеличенным счётчиком попыток (requeue счётчика не ведёт)
+        и подтверждает исходное; после max_attempts попыток отправляет его в очередь ошибок.
+        """
+        headers = dict(message.headers or {})
+        attempts = int(headers.get(ATTEMPTS_HEADER, 0)) + 1
+        if attempts >= self.max_attempts:
+            await self._dead_letter(message, error)
+            return
+        headers[ATTEMPTS_HEADER] = attempts
+        try:
+            await self.channel.default_exchange.publish(
+                aio_pika.Message(body=message.body, headers=headers, delivery_mode=aio_pika.DeliveryMode.PERSISTENT),
+                routing_key=self.queue_name,
+            )
+        except Exception as e:
+            logger.error(f"Не удалось вернуть сообщение в {self.queue_name}: {e}")
+            await message.nack(requeue=True)
+            return
+        logger.warning(f"Сообщение из {self.queue_name} не сохранено (попытка {attempts} из {self.max_attempts}): "
+                       f"{error}")
+        await message.ack()
+
+    async def _dead_letter(self, message, error):
+        """
+        Перекладывает сообщение в очередь ошибок и подтверждает исходное только после того, как брокер
+        подтвердил публикацию копии. Если копию опубликовать не удалось, сообщение возвращается в очередь.
+        """
+        try:
+            await self.channel.default_exchange.publish(
+                aio_pika.Message(
+                    body=message.body,
+                    headers={"x-error": str(error)[:1000]},
+                    delivery_mode=aio_pika.DeliveryMode.PERSISTENT
+                ),
+                routing_key=self.dead_letter_queue,
+            )
+        except Exception as e:
+            logger.error(f"Не удалось отправить сообщение из {self.queue_name} в {self.dead_letter_queue}: {e}")
+            await message.nack(requeue=True)
+            return
+        DEAD_LETTERED.labels(self.queue_name).inc()
+        logger.warning(f"Сообщение из {self.queue_name} не обработано и отправлено в {self.dead_letter_queue}: {error}")
+        await message.ack()
+
+
 async def main():
+    # Метрики для Prometheus: скорость сохранения, размеры порций, время commit, очередь ошибок
+    if METRICS_PORT:
+        start_http_server(METRICS_PORT)
     connection = await aio_pika.connect_robust(RABBITMQ_URL)
-    queue_name = "database_queue"
 
     async with connection:
-        channel = await connection.channel()
-        queue = await channel.declare_queue(queue_name, durable=True)
-
-        async with queue.iterator() as queue_iter:
-            async for message in queue_iter:
-                async with message.process():
-                    data = json.loads(message.body.decode())
-                    telegram_id = data["telegram_id"]
-                    username = data["username"]
-                    text = data["message"]
-                    analysis_result = data["analysis_result"]
-
-                    # Сохраняем данные в базе данных через асинхронный вызов
-                    await save_message_to_db(telegram_id, username, text, analysis_result)
+        await asyncio.gather(
+            BatchConsumer(connection, "database_queue", parse_message, save_messages_to_db).run(),
+            # file_id фотографий каталога, загруженных ботом в Telegram
+            BatchConsumer(connection, "telegram_files_queue", parse_telegram_file, save_telegram_files_to_db).run(),
+            retention_loop(),
+        )
 
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
     asyncio.run(main())
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# consumer.py запускается из корня database_service и сам настраивает Django
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "config.settings")
+os.environ.setdefault("DATABASE_API_TOKEN", "test-token")
@@ -0,0 +1,151 @@
+import asyncio
+import json
+
+import pytest
+
+from consumer import ATTEMPTS_HEADER, BatchConsumer
+
+
+class FakeMessage:
+    def __init__(self, data, headers=None):
+        self.body = data if isinstance(data, bytes) else json.dumps(data).encode()
+        self.headers = headers or {}
+        self.acks = []
+        self.nacks = []
+
+    async def ack(self, multiple=False):
+        self.acks.append(multiple)
+
+    async def nack(self, multiple=False, requeue=True):
+        self.nacks.append((multiple, requeue))
+
+
+class FakeExchange:
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.published = []
+
+    async def publish(self, message, routing_key):
+        if self.fail:
+            raise ConnectionError("брокер недоступен")
+        self.published.append((routing_key, message))
+
+
+class FakeChannel:
+    def __init__(self, fail=False):
+        self.default_exchange = FakeExchange(fail)
+
+
+class Storage:
+    """
+    save для BatchConsumer: сохраняет порцию целиком или падает, если в ней есть отвергнутое сообщение.
+    """
+
+    def __init__(self, rejected=(), available=True):
+        self.rejected = set(rejected)
+        self.available = available
+        self.saved = []
+        self.calls = 0
+
+    def __call__(self, batch):
+        self.calls += 1
+        if not self.available or self.rejected & {item["id"] for item in batch}:
+            raise RuntimeError("ошибка базы данных")
+        self.saved.extend(item["id"] for item in batch)
+
+
+def make_consumer(storage, channel=None, max_attempts=3):
+    consumer = BatchConsumer(None, "history", parse=lambda data: {"id": data["id"]}, save=storage,
+                             max_attempts=max_attempts, retry_delay=0)
+    consumer.channel = channel or FakeChannel()
+
+    async def database_available():
+        return storage.available
+
+    consumer.database_available = database_available
+    return consumer
+
+
+def routed(channel):
+    return [routing_key for routing_key, _ in channel.default_exchange.published]
+
+
+def test_batch_is_saved_at_once_and_acked_with_one_ack():
+    storage = Storage()
+    consumer = make_consumer(storage)
+    messages = [FakeMessage({"id": number}) for number in range(3)]
+    asyncio.run(consumer._process_batch(messages))
+
+    assert storage.saved == [0, 1, 2] and storage.calls == 1
+    assert messages[-1].acks == [True]
+    assert not any(message.acks for message in messages[:-1])
+
+
+def test_undecodable_message_goes_to_dead_letter_queue():
+    storage = Storage()
+    consumer = make_consumer(storage)
+    broken, good = FakeMessage(b"not json"), FakeMessage({"id": 1})
+    asyncio.run(consumer._process_batch([broken, good]))
+
+    assert storage.saved == [1]
+    assert routed(consumer.channel) == ["history.dlq"]
+    assert broken.acks == [False] and good.acks == [True]
+
+
+def test_rejected_message_is_dead_lettered_and_the_rest_is_saved():
+    storage = Storage(rejected={1})
+    consumer = make_consumer(storage)
+    messages = [FakeMessage({"id": number}) for number in range(3)]
+    asyncio.run(consumer._process_batch(messages))
+
+    assert storage.saved == [0, 2]
+    assert routed(consumer.channel) == ["history.dlq"]
+    _, dead_letter = consumer.channel.default_exchange.published[0]
+    assert json.loads(dead_letter.body) == {"id": 1}
+    assert "ошибка базы данных" in dead_letter.headers["x-error"]
+    assert messages[1].acks == [False]
+    assert messages[2].acks == [True]
+
+
+def test_batch_is_requeued_while_database_is_unavailable():
+    storage = Storage(available=False)
+    consumer = make_consumer(storage)
+    messages = [FakeMessage({"id": number}) for number in range(3)]
+    asyncio.run(consumer._process_batch(messages))
+
+    assert messages[-1].nacks == [(True, True)]
+    assert not any(message.acks for message in messages)
+    assert not consumer.channel.default_exchange.published
+
+
+def test_batch_rejected_by_available_database_is_retried_with_attempt_counter():
+    storage = Storage(rejected={0, 1})
+    consumer = make_consumer(storage)
+    messages = [FakeMessage({"id": 0}), FakeMessage({"id": 1}, headers={ATTEMPTS_HEADER: 1})]
+    asyncio.run(consumer._process_batch(messages))
+
+    published = consumer.channel.default_exchange.published
+    assert [routing_key for routing_key, _ in published] == ["history", "history"]
+    assert [message.headers[ATTEMPTS_HEADER] for _, message in published] == [1, 2]
+    assert all(message.acks == [False] and not message.nacks for message in messages)
+
+
+def test_message_is_dead_lettered_after_max_attempts():
+    storage = Storage(rejected={0})
+    consumer = make_consumer(storage, max_attempts=3)
+    message = FakeMessage({"id": 0}, headers={ATTEMPTS_HEADER: 2})
+    asyncio.run(consumer._process_batch([message]))
+
+    assert routed(consumer.channel) == ["history.dlq"]
+    assert message.acks == [False]
+
+
+@pytest.mark.parametrize("available", [True, False])
+def test_message_is_requeued_when_broker_does_not_confirm_the_copy(available):
+    storage = Storage(rejected={0}, available=available)
+    consumer = make_consumer(storage, channel=FakeChannel(fail=True))
+    message = FakeMessage({"id": 0})
+    asyncio.run(consumer._process_batch([message]))
+
+    assert not message.acks
+    assert message.nacks == [(not available, True)]